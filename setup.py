@@ -27,6 +27,20 @@ setup(
         ],
         'webview': [
             'cefpython'
+        ],
+        'asgi': [
+            'uvicorn'
+        ],
+        'udev': [
+            'pyudev'
+        ],
+        'fast-json': [
+            'orjson'
+        ]
+    },
+    entry_points={
+        'console_scripts': [
+            'workbench-server-reupload = workbench_server.reupload:main'
         ]
     },
     keywords='eReuse.org Workbench devices reuse recycle it asset management',
@@ -0,0 +1,166 @@
+import gzip
+import os
+from contextlib import suppress
+from datetime import datetime
+from pathlib import Path
+from sys import stderr
+from threading import Lock, Thread
+from time import sleep
+from typing import Iterator, Tuple
+
+from ereuse_utils.naming import Naming
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from workbench_server.codec import JSONCodec, stdlib
+
+
+class Archive:
+    """
+    Keeps every finished snapshot, so they can be found later
+    without going through thousands of files.
+
+    Snapshots are gzipped and appended to segment files, one for
+    every month of the date of the snapshots (``2018-01.seg``),
+    and indexed in a Mongo collection by uuid, ``serialNumber``,
+    ``hid``, date and ``status``, which is one of:
+
+    - ``pending``: waiting to be uploaded to DeviceHub.
+    - ``uploaded``: with the ``uploaded`` id that DeviceHub gave.
+    - ``failed``: with the ``error``.
+
+    Like :class:`workbench_server.persistence.WriteBehind`, snapshots
+    are written every ``interval`` seconds in a background thread,
+    the index in a single ``bulk_write``.
+
+    Segments are append-only: archiving again a snapshot appends
+    it again and points the index to the new copy.
+    """
+
+    def __init__(self, collection: Collection, folder: Path, codec: JSONCodec = stdlib,
+                 interval: float = 1) -> None:
+        self.collection = collection
+        self.folder = folder
+        self.folder.mkdir(exist_ok=True)
+        self.codec = codec
+        self.interval = interval
+        self.dirty = {}
+        """The uuid and the snapshot, or ``None``, and the index changes."""
+        self._lock = Lock()
+        self._write_lock = Lock()
+        with suppress(PyMongoError):
+            for field in 'serialNumber', 'hid', 'status':
+                self.collection.create_index([(field, ASCENDING), ('date', DESCENDING)])
+            self.collection.create_index([('date', DESCENDING)])
+        Thread(target=self._flush_periodically, daemon=True).start()
+
+    def put(self, snapshot: dict, status: str = 'pending', **info):
+        """
+        Archives the snapshot later.
+
+        The snapshot must not be modified after.
+        """
+        device = snapshot['device']
+        un = 'Unknown'
+        date = snapshot.get('date')
+        if isinstance(date, datetime):
+            # Like DeviceHubJSONEncoder, so we can query by the start of it
+            date = date.strftime('%Y-%m-%dT%H:%M:%S')
+        index = {
+            'serialNumber': device.get('serialNumber'),
+            'hid': Naming.hid(device.get('manufacturer') or un,
+                              device.get('serialNumber') or un,
+                              device.get('model') or un),
+            'date': date,
+            'status': status
+        }
+        index.update(info)
+        with self._lock:
+            self.dirty[str(snapshot['_uuid'])] = snapshot, index
+
+    def set_status(self, _uuid: str, status: str, **info):
+        """
+        Changes the status of an archived snapshot, or one
+        waiting to be archived. Snapshots we did not archive, like
+        the ones we upload again from ``Failed Snapshots``, are
+        not indexed.
+        """
+        with self._lock:
+            snapshot, index = self.dirty.get(_uuid, (None, {}))
+            self.dirty[_uuid] = snapshot, dict(index, status=status, **info)
+
+    def get(self, _uuid: str) -> dict:
+        """Gets an archived snapshot, or ``None``."""
+        with self._lock:
+            snapshot, _ = self.dirty.get(_uuid, (None, None))
+        if snapshot is not None:
+            return snapshot
+        index = self.collection.find_one({'_id': _uuid}, {'segment': 1, 'offset': 1,
+                                                          'length': 1})
+        if index is None or 'segment' not in index:
+            return None
+        with self.folder.joinpath(index['segment']).open('rb') as f:
+            f.seek(index['offset'])
+            return self.codec.loads(gzip.decompress(f.read(index['length'])))
+
+    def find(self, query: dict, page: int = 1, max_results: int = 25) -> Tuple[Iterator, int]:
+        """
+        Gets the index of the archived snapshots that match the
+        Mongo ``query``, newest first, one page at a time.
+
+        :return: The index of the snapshots of the page, without
+        where they are stored, and how many snapshots match.
+        """
+        projection = {'segment': 0, 'offset': 0, 'length': 0}
+        cursor = self.collection.find(query, projection) \
+            .sort('date', DESCENDING) \
+            .skip((page - 1) * max_results) \
+            .limit(max_results)
+        return cursor, self.collection.count(query)
+
+    def flush(self):
+        """Archives the snapshots now."""
+        with self._write_lock:
+            with self._lock:
+                dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return
+            written = {}
+            """The index of the snapshots, with where they are."""
+            try:
+                for _uuid, (snapshot, index) in dirty.items():
+                    if snapshot is not None:
+                        index = dict(index, **self._append(snapshot, index['date']))
+                    written[_uuid] = index
+                # Only the snapshots we archived create their index
+                requests = [UpdateOne({'_id': _uuid}, {'$set': index}, upsert='segment' in index)
+                            for _uuid, index in written.items()]
+                self.collection.bulk_write(requests, ordered=False)
+            except (OSError, PyMongoError) as e:
+                print('Could not archive, trying later: {!r}'.format(e), file=stderr)
+                with self._lock:
+                    for _uuid, (snapshot, index) in dirty.items():
+                        if _uuid in written:  # Already in a segment
+                            snapshot, index = None, written[_uuid]
+                        # Keep newer changes that happened meanwhile
+                        newer_snapshot, newer_index = self.dirty.get(_uuid, (None, {}))
+                        if newer_snapshot is not None:
+                            snapshot = newer_snapshot
+                        self.dirty[_uuid] = snapshot, dict(index, **newer_index)
+
+    def _append(self, snapshot: dict, date: str) -> dict:
+        """Appends the snapshot to its segment, returning where."""
+        segment = '{}.seg'.format((date or 'undated')[:7])
+        data = gzip.compress(self.codec.dumps(snapshot))
+        with self.folder.joinpath(segment).open('ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return {'segment': segment, 'offset': offset, 'length': len(data)}
+
+    def _flush_periodically(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
@@ -0,0 +1,389 @@
+"""
+WorkbenchServer as an ASGI application, so thousands of clients
+keeping their connections open, waiting in ``/events`` or polling
+``/info``, cost no threads.
+
+The routes Workbench and DeviceHubClient use the most are served
+from the event loop, with the logic of the views of
+:class:`workbench_server.flaskapp.WorkbenchServer`; what blocks
+(Mongo, files, pen-drives) runs in a pool of threads. The other
+routes go to the Flask app in the same pool.
+
+Execute it with ``python -m workbench_server.asgi``, which needs
+the ``asgi`` extra (uvicorn), or with any ASGI server using
+:func:`.create_app`.
+"""
+import asyncio
+import re
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+from uuid import UUID
+
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError
+from werkzeug.http import parse_accept_header, parse_etags, parse_options_header
+
+from workbench_server.compression import compress, gunzip
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.views.snapshots import parse_base
+
+UUID_PATH = '[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}'
+
+
+class Request:
+    """The part of an ASGI HTTP request our routes use."""
+
+    def __init__(self, scope: dict, body: bytes, receive: Callable[[], Awaitable[dict]],
+                 send: Callable[[dict], Awaitable[None]]) -> None:
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'),
+                                        keep_blank_values=True))
+        self.headers = Headers([(k.decode('latin-1'), v.decode('latin-1'))
+                                for k, v in scope.get('headers', ())])
+        self.body = body
+        self.receive = receive
+        self.send = send
+
+
+class Response:
+    def __init__(self, body: bytes = b'', status: int = 200,
+                 content_type: Optional[str] = 'application/json', headers: dict = None) -> None:
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type is not None:
+            self.headers['Content-Type'] = content_type
+
+
+class AsyncWorkbenchServer:
+    """
+    An ASGI 3 application serving the API of a
+    :class:`workbench_server.flaskapp.WorkbenchServer`.
+
+    The routes served from the event loop are:
+
+    - ``GET /info`` and ``/info/stats``.
+    - ``GET`` and ``PATCH /snapshots/<uuid>``, and
+      ``PATCH /snapshots/batch``.
+    - ``GET /usbs``, ``POST /usbs/named`` and
+      ``POST`` and ``DELETE /usbs/plugged/<hid>``.
+    - ``GET`` and ``POST /config``.
+    - ``GET /events``, waiting without a thread.
+
+    Mongo is still used through pymongo in the threads, as reading
+    the state is in-memory and writing it is in the background (see
+    :class:`workbench_server.persistence.WriteBehind`); snapshots
+    are still uploaded to DeviceHub by the process of the submitter.
+    """
+
+    def __init__(self, app: WorkbenchServer = None, **kwargs) -> None:
+        """
+        :param app: The WorkbenchServer to serve, or ``None`` to
+        create one with ``kwargs``.
+        """
+        self.app = app or WorkbenchServer(**kwargs)
+        self.executor = ThreadPoolExecutor(self.app.config['ASGI_THREADS'])
+        """Runs what blocks, like Mongo, files and the Flask app."""
+        routes = [
+            ('/info', '/info', {'GET': self.info}),
+            ('/info/stats', '/info/stats', {'GET': self.stats}),
+            ('/snapshots/batch', '/snapshots/batch', {'PATCH': self.batch}),
+            ('/snapshots/<uuid:_uuid>', '/snapshots/(?P<_uuid>{})'.format(UUID_PATH),
+             {'GET': self.get_snapshot, 'PATCH': self.patch_snapshot}),
+            ('/usbs', '/usbs', {'GET': self.usbs}),
+            ('/usbs/named', '/usbs/named', {'POST': self.name_usb}),
+            ('/usbs/plugged/<usb_hid>', '/usbs/plugged/(?P<usb_hid>[^/]+)',
+             {'POST': self.client_plug, 'DELETE': self.client_plug}),
+            ('/config', '/config', {'GET': self.config, 'POST': self.config}),
+            ('/events', '/events', {'GET': self.events})
+        ]
+        self.routes = [(rule, re.compile(path + '$'), methods) for rule, path, methods in routes]
+        """The rule of the route in Flask, its regex and its handlers."""
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        request = Request(scope, body, receive, send)
+        rule, handler, params = self.match(request)
+        if handler is None:
+            response = await self.run(self.wsgi, request)
+        else:
+            started = perf_counter()
+            try:
+                response = await handler(request, **params)
+            except HTTPException as e:
+                response = self.error(e)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                response = self.error(InternalServerError())
+            if response is not None:
+                self.app.request_time.observe(perf_counter() - started, request.method, rule,
+                                              str(response.status))
+        if response is not None:  # Or the handler already sent it
+            if 'Origin' in request.headers and handler is not None:
+                response.headers.update(self.CORS)
+            await self.send(send, response)
+
+    CORS = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'Authorization, ETag'
+    }
+    """
+    The headers that flask_cors adds to the responses of
+    :class:`workbench_server.flaskapp.WorkbenchServer`. Preflight
+    requests go to it.
+    """
+
+    def match(self, request: Request) -> Tuple[str, Optional[Callable], dict]:
+        for rule, path, methods in self.routes:
+            match = path.match(request.path)
+            if match:
+                return rule, methods.get(request.method), match.groupdict()
+        return None, None, {}
+
+    async def run(self, function: Callable, *args):
+        """Runs ``function`` in :attr:`.executor`."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # So /info does not block the loop reading them
+                await self.run(self.app.usbs.get_named)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def send(send, response: Response):
+        headers = [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                   for k, v in response.headers.items()]
+        headers.append((b'content-length', str(len(response.body)).encode()))
+        await send({'type': 'http.response.start', 'status': response.status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    def json(self, obj, status: int = 200) -> Response:
+        return Response(self.app.codec.dumps(obj), status)
+
+    def get_json(self, request: Request):
+        """Like :meth:`workbench_server.flaskapp.JSONRequest.get_json`."""
+        mimetype = mimetype_of(request)
+        if not (mimetype == 'application/json'
+                or mimetype.startswith('application/') and mimetype.endswith('+json')):
+            return None
+        try:
+            body = request.body
+            if request.headers.get('Content-Encoding') == 'gzip':
+                body = gunzip(body, self.app.config['GZIP_MAX_SIZE'])
+            return self.app.codec.loads(body)
+        except ValueError as e:
+            raise BadRequest('Failed to decode JSON object: {}'.format(e))
+
+    @staticmethod
+    def error(e: HTTPException) -> Response:
+        """Responds like Flask does."""
+        response = e.get_response()
+        return Response(response.get_data(), e.code, response.content_type)
+
+    async def info(self, request: Request):
+        """See :meth:`workbench_server.views.info.Info.view_info`."""
+        info = self.app.info
+        if 'device-hub' in request.args:
+            await self.run(info.set_credentials, request.args['device-hub'], request.args['db'],
+                           request.headers['Authorization'])
+        if_none_match = parse_etags(request.headers.get('If-None-Match'))
+        etag, data = info.info(request.args.get('since', type=int), if_none_match)
+        headers = {'ETag': '"{}"'.format(etag)}
+        if data is None:
+            return Response(status=304, content_type=None, headers=headers)
+        return Response(data, headers=headers)
+
+    async def stats(self, request: Request):
+        # Measuring the memory of the snapshots walks all of them
+        return self.json(await self.run(self.app.info.stats))
+
+    async def get_snapshot(self, request: Request, _uuid: str):
+        """See :meth:`workbench_server.views.snapshots.Snapshots.view_phase`."""
+        _uuid = str(UUID(_uuid))
+        snapshots = self.app.snapshots
+        if _uuid in snapshots.snapshots:
+            data = snapshots.get_public(_uuid)
+        else:  # From Mongo or the archive
+            data = await self.run(snapshots.get_public, _uuid)
+        version = snapshots.version(_uuid)
+        return self.compressed(request, data,
+                               {} if version is None else {'ETag': '"{}"'.format(version)})
+
+    async def patch_snapshot(self, request: Request, _uuid: str):
+        version = await self.run(self.app.snapshots.patch, str(UUID(_uuid)),
+                                 self.get_json(request), mimetype_of(request),
+                                 parse_base(request.headers.get('If-Match')))
+        return Response(status=204, content_type=None, headers={'ETag': '"{}"'.format(version)})
+
+    async def batch(self, request: Request):
+        result = await self.run(self.app.snapshots.batch, self.get_json(request))
+        return self.compressed(request, self.app.codec.dumps(result))
+
+    def compressed(self, request: Request, data: bytes, headers: dict = None) -> Response:
+        """A JSON response, gzipped if the client accepts it."""
+        accept = parse_accept_header(request.headers.get('Accept-Encoding'))
+        data, compression = compress(data, accept, self.app.config['GZIP_MIN_SIZE'])
+        return Response(data, headers=dict(headers or {}, **compression))
+
+    async def usbs(self, request: Request):
+        return self.json(await self.run(self.app.usbs.usbs))
+
+    async def name_usb(self, request: Request):
+        await self.run(self.app.usbs.name, self.get_json(request))
+        return Response(status=204, content_type=None)
+
+    async def client_plug(self, request: Request, usb_hid: str):
+        if request.method == 'POST':
+            await self.run(self.app.usbs.plug, usb_hid, self.get_json(request))
+        else:  # Delete
+            await self.run(self.app.usbs.unplug, usb_hid)
+        return Response(status=204, content_type=None)
+
+    async def config(self, request: Request):
+        """See :meth:`workbench_server.views.config.Config.view`."""
+        if request.method == 'GET':
+            configuration = self.app.configuration
+            etag = configuration.etag()
+            headers = {'ETag': '"{}"'.format(etag)}
+            if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+                return Response(status=304, content_type=None, headers=headers)
+            return Response(self.app.codec.dumps(configuration.get()), headers=headers)
+        else:  # POST
+            await self.run(self.app.configuration.set, self.get_json(request))
+            return Response(status=204, content_type=None)
+
+    async def events(self, request: Request):
+        """See :meth:`workbench_server.views.events.Events.view_events`."""
+        events = self.app.events
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        if last_id is None:
+            last_id = request.args.get('last-event-id', type=int)
+        keep_alive = self.app.config['EVENTS_KEEP_ALIVE']
+        if 'poll' in request.args:
+            new, reset = await events.wait_async(last_id, keep_alive)
+            return self.json(events.poll(last_id, new, reset))
+
+        headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+        headers += [(k.lower().encode(), v.encode()) for k, v in events.HEADERS.items()]
+        if 'Origin' in request.headers:
+            headers += [(k.lower().encode(), v.encode()) for k, v in self.CORS.items()]
+        await request.send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        disconnected = asyncio.ensure_future(_disconnect(request.receive))
+        try:
+            last_id, message = events.first_message(last_id)
+            while True:
+                await request.send({'type': 'http.response.body', 'body': message.encode(),
+                                    'more_body': True})
+                waiting = asyncio.ensure_future(events.wait_async(last_id, keep_alive))
+                await asyncio.wait((waiting, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    return None
+                last_id, message = events.message(last_id, *waiting.result())
+        finally:
+            disconnected.cancel()
+
+    def wsgi(self, request: Request) -> Response:
+        """Serves the request with the Flask app."""
+        scope = request.scope
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': request.path,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in request.headers.items():
+            if name.lower() == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name.lower() != 'content-length':
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        status_headers = []
+
+        def start_response(status: str, headers: List[tuple], exc_info=None):
+            status_headers[:] = int(status.split(' ', 1)[0]), headers
+
+        body = self.app.wsgi_app(environ, start_response)
+        try:
+            data = b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        status, headers = status_headers
+        headers = {k: v for k, v in headers if k.lower() != 'content-length'}
+        return Response(data, status, content_type=None, headers=headers)
+
+
+async def _disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def mimetype_of(request: Request) -> str:
+    """The Content-Type of the request without its parameters."""
+    return parse_options_header(request.headers.get('Content-Type', ''))[0]
+
+
+def create_app(**kwargs) -> AsyncWorkbenchServer:
+    """Creates the ASGI application, passing ``kwargs`` to WorkbenchServer."""
+    return AsyncWorkbenchServer(**kwargs)
+
+
+def main(args=None):
+    import argparse
+    import uvicorn
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--folder', type=Path, default=Path.home().joinpath('workbench'),
+                        help='The main folder of WorkbenchServer.')
+    args = parser.parse_args(args)
+    uvicorn.run(create_app(folder=args.folder), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import List, Set
+
+
+class Sequence:
+    """
+    A thread-safe, monotonically increasing counter shared by all
+    the collections of WorkbenchServer.
+
+    Every time something changes the counter is increased, so
+    its value works as a version of the whole state of the server.
+
+    The counter starts at the current time in milliseconds so
+    values from before a restart of the server are always lower
+    than the new ones and clients get everything again.
+
+    When we run many processes (see
+    :class:`workbench_server.replica.SharedReplica`) each one
+    counts in steps of ``step`` from a different ``offset``, so a
+    process knows which values it did not give and clients that
+    hop from one process to another get everything again.
+    """
+
+    def __init__(self, step: int = 1, offset: int = 0) -> None:
+        self.step = step
+        self.offset = offset
+        self.value = self.start = int(time() * 1000) * step + offset
+        self._lock = Lock()
+
+    def next(self) -> int:
+        with self._lock:
+            self.value += self.step
+            return self.value
+
+    def issued(self, value: int) -> bool:
+        """Can this sequence have given ``value``?"""
+        return value % self.step == self.offset
+
+
+class Changes:
+    """
+    Registers in which sequence number each item of a collection
+    was last modified or removed, so clients can ask only for the
+    items that changed since a sequence number they already know.
+    """
+    MAX_TOMBSTONES = 10000
+    """
+    Removed items we remember. Clients asking for changes
+    older than the oldest forgotten tombstone need to get
+    everything again.
+    """
+
+    def __init__(self, sequence: Sequence) -> None:
+        self.sequence = sequence
+        self.updated = {}
+        """Key of the item: sequence number when it was last updated."""
+        self.removed = OrderedDict()
+        """Key of the item: sequence number when it was removed."""
+        self.forgotten = sequence.start
+        """The sequence number of the newest forgotten tombstone."""
+        self._lock = Lock()
+
+    def update(self, key) -> int:
+        """Marks the item as modified, returning the new sequence."""
+        with self._lock:
+            seq = self.updated[key] = self.sequence.next()
+            self.removed.pop(key, None)
+            return seq
+
+    def remove(self, key) -> int:
+        """Marks the item as removed, returning the new sequence."""
+        with self._lock:
+            self.updated.pop(key, None)
+            seq = self.removed[key] = self.sequence.next()
+            self.removed.move_to_end(key)
+            while len(self.removed) > self.MAX_TOMBSTONES:
+                _, self.forgotten = self.removed.popitem(last=False)
+            return seq
+
+    def knows(self, since: int) -> bool:
+        """Can we compute the changes since ``since``?"""
+        return self.sequence.issued(since) and self.forgotten <= since <= self.sequence.value
+
+    def updated_since(self, since: int) -> Set:
+        with self._lock:
+            return {key for key, seq in self.updated.items() if seq > since}
+
+    def removed_since(self, since: int) -> List:
+        with self._lock:
+            return [key for key, seq in self.removed.items() if seq > since]
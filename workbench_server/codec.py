@@ -0,0 +1,122 @@
+import json
+from typing import Any, Union
+
+from ereuse_utils import DeviceHubJSONEncoder
+
+
+class JSONCodec:
+    """
+    Encodes and decodes JSON, like the ``json`` module, handling
+    the types :class:`ereuse_utils.DeviceHubJSONEncoder` handles
+    (datetimes, UUIDs...) the same way.
+
+    Use :func:`.get_codec` to get one.
+    """
+    name = None  # type: str
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        """
+        Encodes ``obj`` in UTF-8 JSON.
+
+        :param pretty: Indent the JSON and sort the keys, for files
+        that people read.
+        """
+        raise NotImplementedError()
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """
+        Decodes JSON.
+
+        :raise ValueError: The data is not valid JSON.
+        """
+        raise NotImplementedError()
+
+
+class StdlibCodec(JSONCodec):
+    """The ``json`` module of the standard library."""
+    name = 'stdlib'
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        if pretty:
+            data = json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False,
+                              cls=DeviceHubJSONEncoder)
+        else:
+            data = json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                              cls=DeviceHubJSONEncoder)
+        return data.encode()
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        if isinstance(data, bytes):
+            data = data.decode()
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    `orjson <https://github.com/ijl/orjson>`_, the fastest one.
+
+    orjson encodes datetimes in ISO 8601 by itself; we pass them to
+    :class:`ereuse_utils.DeviceHubJSONEncoder` instead so DeviceHub
+    gets the format it expects.
+    """
+    name = 'orjson'
+
+    def __init__(self) -> None:
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        options = self.options
+        if pretty:
+            options |= self.orjson.OPT_INDENT_2 | self.orjson.OPT_SORT_KEYS
+        return self.orjson.dumps(obj, default=_default, option=options)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return self.orjson.loads(data)  # orjson.JSONDecodeError is a ValueError
+
+
+class UjsonCodec(JSONCodec):
+    """`ujson <https://github.com/ultrajson/ultrajson>`_, 5.2 or newer."""
+    name = 'ujson'
+
+    def __init__(self) -> None:
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        data = self.ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False,
+                                default=_default, indent=2 if pretty else 0, sort_keys=pretty)
+        return data.encode()
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return self.ujson.loads(data)
+
+
+CODECS = OrjsonCodec, UjsonCodec, StdlibCodec
+"""The codecs, the fastest first."""
+
+
+def get_codec(name: str = 'auto') -> JSONCodec:
+    """
+    Gets a codec by its name.
+
+    :param name: The name of the codec, or ``auto`` to get the
+    fastest one that is installed.
+    """
+    for codec in CODECS:
+        if name in (codec.name, 'auto'):
+            try:
+                return codec()
+            except ImportError:
+                if name != 'auto':
+                    raise
+    raise ValueError('Unknown JSON codec {}'.format(name))
+
+
+def _default(obj):
+    return _encoder.default(obj)
+
+
+_encoder = DeviceHubJSONEncoder()
+stdlib = StdlibCodec()
@@ -0,0 +1,37 @@
+import gzip
+import zlib
+from typing import Dict, Tuple
+
+from werkzeug.datastructures import Accept
+
+
+def gunzip(data: bytes, max_size: int) -> bytes:
+    """
+    Decompresses a gzipped request body.
+
+    :raise ValueError: The body is not gzip or it expands to
+    more than ``max_size`` bytes, which could be a zip bomb.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # Only gzip
+    try:
+        data = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError('The body is not gzip: {}'.format(e)) from e
+    if decompressor.unconsumed_tail:
+        raise ValueError('The body expands to more than {} bytes.'.format(max_size))
+    return data
+
+
+def compress(data: bytes, accept_encodings: Accept, min_size: int) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Gzips the body of a response if the client accepts it and it is
+    at least ``min_size`` bytes, as smaller ones barely shrink.
+
+    :return: The body and the headers to add to the response.
+    """
+    headers = {'Vary': 'Accept-Encoding'}
+    if len(data) >= min_size and accept_encodings['gzip']:
+        # Level 6 is what most servers use: near the best size, much faster than 9
+        data = gzip.compress(data, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    return data, headers
@@ -0,0 +1,119 @@
+import gzip
+import os
+from collections import OrderedDict
+from pathlib import Path
+from sys import stderr
+from tempfile import mkstemp
+from threading import Condition, Thread
+
+from ereuse_utils.naming import Naming
+
+from workbench_server.codec import JSONCodec, stdlib
+
+
+class SnapshotWriter:
+    """
+    Writes snapshots to JSON files in a background thread, so
+    requests do not wait for the disk.
+
+    Snapshots wait in a queue of at most ``maxsize`` snapshots;
+    writing a snapshot that is already waiting to be written to
+    the same folder replaces it, so only the last one is written.
+    When the queue is full, :meth:`.write` waits.
+    """
+
+    def __init__(self, codec: JSONCodec = stdlib, maxsize: int = 1000,
+                 compress: bool = False) -> None:
+        """
+        :param compress: Write gzipped files (``.json.gz``).
+        """
+        self.codec = codec
+        self.maxsize = maxsize
+        self.compress = compress
+        self.pending = OrderedDict()
+        """``(folder, uuid)``: the snapshot to write, oldest first."""
+        self.writing = False
+        self.condition = Condition()
+        Thread(target=self._write_forever, daemon=True).start()
+
+    def write(self, snapshot: dict, folder: Path):
+        """Writes the snapshot in the folder later."""
+        key = folder, str(snapshot['_uuid'])
+        with self.condition:
+            while key not in self.pending and len(self.pending) >= self.maxsize:
+                self.condition.wait()
+            self.pending[key] = snapshot
+            self.condition.notify_all()
+
+    def flush(self):
+        """Waits until all the snapshots are written."""
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+
+    def _write_forever(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                (folder, _uuid), snapshot = self.pending.popitem(last=False)
+                self.writing = True
+                self.condition.notify_all()
+            try:
+                to_json_file(snapshot, folder, self.codec, self.compress)
+            except Exception as e:  # Ex. a snapshot without device; keep writing the rest
+                print('Could not write the file of Snapshot {}: {!r}'.format(_uuid, e),
+                      file=stderr)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+
+def to_json_file(snapshot: dict, folder: Path, codec: JSONCodec = stdlib,
+                 compress: bool = False) -> Path:
+    """
+    Writes the snapshot in a pretty JSON file named after the
+    device and the uuid of the snapshot.
+
+    The file is written in a temporary file first and then
+    renamed, so there are never half-written snapshot files.
+    """
+    device = snapshot['device']
+    un = 'Unknown'
+    name = Naming.hid(device['manufacturer'] or un, device['serialNumber'] or un,
+                      device['model'] or un)
+    name = '{} {}.json'.format(name, snapshot['_uuid'])
+    data = codec.dumps(snapshot, pretty=True)
+    if compress:
+        name += '.gz'
+        data = gzip.compress(data)
+    path = folder.joinpath(name)
+    write_atomically(path, data)
+    return path
+
+
+def write_atomically(path: Path, data: bytes, mode: int = 0o644):
+    """
+    Writes the file in a temporary file of the same folder first
+    and then renames it, so there is never a half-written file.
+    """
+    fd, tmp = mkstemp(suffix='.tmp', dir=str(path.parent))
+    try:
+        with open(fd, 'wb') as f:
+            os.chmod(tmp, mode)  # mkstemp makes it private
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, str(path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_json_file(path: Path, codec: JSONCodec = stdlib) -> dict:
+    """Reads a file written by :func:`.to_json_file`."""
+    data = path.read_bytes()
+    if path.suffix == '.gz':
+        data = gzip.decompress(data)
+    return codec.loads(data)
@@ -1,19 +1,52 @@
 from pathlib import Path
-from typing import Type
+from time import perf_counter
+from typing import Any, Type
 
 import flask_cors
 from ereuse_utils import DeviceHubJSONEncoder, ensure_utf8
 from ereuse_utils.test import Client
-from flask import Flask
+from flask import Flask, Request, Response, current_app, g, request
 from pymongo import MongoClient
 from pymongo.database import Database
+from werkzeug.datastructures import ImmutableDict
 
+from workbench_server.changes import Sequence
+from workbench_server.codec import JSONCodec, get_codec
+from workbench_server.compression import gunzip
+from workbench_server.metrics import Metrics, TimedCodec
+from workbench_server.profiling import Profiler
+from workbench_server.replica import Replica, SharedReplica
+from workbench_server.shared import MongoState
 from workbench_server.views.config import Config
+from workbench_server.views.events import Events
 from workbench_server.views.info import Info
 from workbench_server.views.snapshots import Snapshots
 from workbench_server.views.usbs import USBs
 
 
+class JSONRequest(Request):
+    """
+    A request that decodes JSON with the codec of the app, and that
+    can be gzipped (``Content-Encoding: gzip``).
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if cache and hasattr(self, '_codec_json'):
+            return self._codec_json
+        if not (force or self.is_json):
+            return None
+        try:
+            data = self.get_data(cache=cache)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                data = gunzip(data, current_app.config['GZIP_MAX_SIZE'])
+            rv = current_app.codec.loads(data)
+        except ValueError as e:
+            rv = None if silent else self.on_json_loading_failed(e)
+        if cache:
+            self._codec_json = rv
+        return rv
+
+
 class WorkbenchServer(Flask):
     """
     Server for Workbench. WorkbenchServer exposes a REST API where
@@ -34,13 +67,60 @@ class WorkbenchServer(Flask):
     snapshots to DeviceHub.
     """
     test_client_class = Client
+    request_class = JSONRequest
+    default_config = ImmutableDict(
+        Flask.default_config,
+        MONGO_DB='workbench_server',  # The name of the Mongo database
+        JSON_CODEC='auto',  # orjson, ujson, stdlib, or auto for the fastest installed
+        SNAPSHOTS_FLUSH_INTERVAL=1,  # Seconds between saving the changed snapshots to Mongo
+        SNAPSHOTS_LOCK_STRIPES=64,  # Locks shared by the snapshots being modified
+        SNAPSHOTS_RETENTION_TTL=24 * 60 * 60,  # Seconds finished snapshots stay in memory...
+        SNAPSHOTS_RETENTION_MAX=500,  # ...and how many of them at most
+        SNAPSHOTS_FILE_QUEUE=1000,  # Snapshots waiting to be written to files, at most
+        SNAPSHOTS_FILE_COMPRESS=False,  # Gzip the snapshot files (.json.gz)
+        EVENTS_BACKLOG=1000,  # Events kept for subscribers that fall behind
+        EVENTS_KEEP_ALIVE=15,  # Seconds between keep-alive messages in /events
+        SUBMITTER_WORKERS=4,  # Snapshots uploaded to DeviceHub at the same time
+        SUBMITTER_HOST_CONCURRENCY=4,  # Same as above but for each DeviceHub host
+        SUBMITTER_MAX_ATTEMPTS=None,  # Connection errors before giving up. None is never
+        SUBMITTER_RETRY_BASE=2,  # Seconds before the first retry, doubling every retry...
+        SUBMITTER_RETRY_CAP=300,  # ...until this
+        SUBMITTER_BREAKER_THRESHOLD=5,  # Connection errors in a row to stop trying a DeviceHub
+        SUBMITTER_BREAKER_COOLDOWN=30,  # Seconds we stop trying
+        REUPLOAD_CONCURRENCY=16,  # Failed snapshots uploading again at the same time
+        ASGI_THREADS=32,  # Threads of workbench_server.asgi for what blocks, like Mongo
+        METRICS=False,  # Measure WorkbenchServer and expose it in /metrics for Prometheus
+        # Sample the stacks of this fraction of the requests and of all the requests
+        # to the PROFILE_ROUTE rule (ex. '/info'), every PROFILE_INTERVAL seconds,
+        # exposing them in /profile as collapsed stacks for flame graphs
+        PROFILE_RATE=0,
+        PROFILE_ROUTE=None,
+        PROFILE_INTERVAL=0.005,
+        GZIP_MIN_SIZE=1024,  # Bytes from which we gzip snapshots to clients that accept it
+        GZIP_MAX_SIZE=64 * 1024 * 1024,  # Bytes a gzipped request can expand to, at most
+        # Where we get the pen-drives plugged in this machine: 'pyusb', which watches
+        # udev hotplug events when pyudev is installed, or a host_usbs.USBSource
+        HOST_USBS_SOURCE='pyusb',
+        CONFIG_RELOAD_INTERVAL=1,  # Seconds between checking if someone changed config.json
+        LOCAL_IP_INTERVAL=60,  # Seconds between getting the local IP, besides on network changes
+        USBS_PLUGGED_TTL=5,  # Seconds a pen-drive stays plugged in a client without reporting it
+        HOST_USBS_POLL=2,  # Seconds between enumerating the pen-drives without hotplug events
+        # Run many processes (see SharedReplica), sharing the state in 'mongo'
+        # or in a workbench_server.shared.SharedState. None is only one process
+        SHARED_STATE=None,
+        SHARED_STATE_POLL=0.05,  # Seconds between getting the changes of other processes
+        SHARED_STATE_LEASE=10,  # Seconds before another process replaces a stuck leader
+        SHARED_STATE_KEEP=600,  # Seconds we keep the changes in the shared state
+        SHARED_STATE_SLOTS=64  # Processes with their own sequence numbers, at most
+    )
 
     def __init__(self, import_name=__name__, static_path=None, static_url_path=None,
                  static_folder='static', template_folder='templates', instance_path=None,
                  instance_relative_config=False, root_path=None,
                  folder=Path.home().joinpath('workbench'), info: Type[Info] = Info,
                  config: Type[Config] = Config, usbs: Type[USBs] = USBs,
-                 snapshots: Type[Snapshots] = Snapshots):
+                 snapshots: Type[Snapshots] = Snapshots, events: Type[Events] = Events,
+                 settings: dict = None):
         """
         Instantiates a WorkbenchServer.
 
@@ -52,15 +132,42 @@ class WorkbenchServer(Flask):
         :param config: Config class. Replace this to extend func.
         :param usbs: USB class. Replace this to extend functionality.
         :param snapshots: Snapshots class. Replace this to extend func.
+        :param events: Events class. Replace this to extend func.
+        :param settings: Values overriding the ones in
+        :attr:`.default_config`.
         """
         ensure_utf8(self.__class__.__name__)
         super().__init__(import_name, static_path, static_url_path, static_folder, template_folder,
                          instance_path, instance_relative_config, root_path)
+        self.config.update(settings or {})
         self.json_encoder = DeviceHubJSONEncoder
+        self.metrics = Metrics(self.config['METRICS'])
+        self.request_time = self.metrics.histogram('request_duration_seconds',
+                                                   'Time to respond to requests.',
+                                                   ('method', 'route', 'status'))
+        self.mongo_time = self.metrics.histogram('mongo_duration_seconds',
+                                                 'Time of the calls to Mongo in requests.',
+                                                 ('collection', 'operation'))
+        self.codec = get_codec(self.config['JSON_CODEC'])  # type: JSONCodec
+        """Encodes and decodes the JSON of requests, responses and files."""
+        if self.metrics.enabled:
+            self.codec = TimedCodec(self.codec, self.metrics.histogram('json_encode_seconds',
+                                                                       'Time to encode JSON.'))
+            self.before_request(self._start_request)
+            self.after_request(self._end_request)
+            self.add_url_rule('/metrics', view_func=self.view_metrics, methods={'GET'})
+        self.profiler = None  # type: Profiler
+        if self.config['PROFILE_RATE'] or self.config['PROFILE_ROUTE']:
+            self.profiler = Profiler(self.config['PROFILE_RATE'], self.config['PROFILE_ROUTE'],
+                                     self.config['PROFILE_INTERVAL'])
+            self.before_request(self._start_profiling)
+            self.teardown_request(self._stop_profiling)
+            self.add_url_rule('/profile', view_func=self.view_profile, methods={'GET', 'DELETE'})
         flask_cors.CORS(self,
                         origins='*',
-                        allow_headers=['Content-Type', 'Authorization', 'Origin'],
-                        expose_headers=['Authorization'],
+                        allow_headers=['Content-Type', 'Content-Encoding', 'Authorization',
+                                       'Origin', 'If-None-Match', 'If-Match', 'Last-Event-ID'],
+                        expose_headers=['Authorization', 'ETag'],
                         max_age=21600)
         self.folder = folder
         settings_folder = folder.joinpath('.settings')
@@ -70,8 +177,64 @@ class WorkbenchServer(Flask):
 
         self.auth = self.device_hub = self.db = None
         self.mongo_client = MongoClient()
-        self.mongo_db = self.mongo_client.workbench_server  # type: Database
+        self.mongo_db = self.mongo_client[self.config['MONGO_DB']]  # type: Database
+        # self.sequence is the version of the state of WorkbenchServer,
+        # increased every time a snapshot or an USB changes, and
+        # self.replica applies the changes to the state in every process
+        state = self.config['SHARED_STATE']
+        if state is None:
+            self.sequence = Sequence()
+            self.replica = Replica(self)
+        else:
+            if state == 'mongo':
+                state = MongoState(self.mongo_db)
+            slots = self.config['SHARED_STATE_SLOTS']
+            self.sequence = Sequence(slots, state.next('replicas') % slots)
+            self.replica = SharedReplica(self, state, self.config['SHARED_STATE_POLL'],
+                                         self.config['SHARED_STATE_LEASE'],
+                                         self.config['SHARED_STATE_KEEP'])
+        self.events = events(self)
         self.configuration = config(self, settings_folder, images_folder)
         self.info = info(self)
         self.snapshots = snapshots(self, folder)
         self.usbs = usbs(self)
+        self.replica.start()
+
+    def view_metrics(self):
+        """Gets the :attr:`.metrics` for Prometheus."""
+        return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def view_profile(self):
+        """
+        GET gets the samples of the :attr:`.profiler` as collapsed
+        stacks, for tools like ``flamegraph.pl``, and DELETE
+        removes them.
+        """
+        if request.method == 'GET':
+            return Response(self.profiler.collapsed(), mimetype='text/plain',
+                            headers={'X-Profiled-Requests': self.profiler.requests})
+        else:  # DELETE
+            self.profiler.reset()
+            return Response(status=204)
+
+    def _start_profiling(self):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if self.profiler.wants(route):
+            self.profiler.start('{} {}'.format(request.method, route))
+
+    def _stop_profiling(self, exception=None):
+        self.profiler.stop()
+
+    def _start_request(self):
+        g.started = perf_counter()
+
+    def _end_request(self, response: Response) -> Response:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.request_time.observe(perf_counter() - g.started, request.method, route,
+                                  str(response.status_code))
+        return response
+
+    def json_response(self, obj: Any, status: int = 200) -> Response:
+        """Like :func:`flask.jsonify` but encoding with :attr:`.codec`."""
+        return self.response_class(self.codec.dumps(obj), status=status,
+                                   mimetype='application/json')
@@ -0,0 +1,121 @@
+from math import ceil
+from threading import Lock
+from time import monotonic
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Set, Tuple
+
+
+class Heartbeats:
+    """
+    A thread-safe dict whose items vanish ``ttl`` seconds after
+    they were last put, for things that clients keep reporting
+    while they last, like the pen-drives plugged in clients.
+
+    Expiry is a timing wheel: items are in the bucket of the tick
+    of ``resolution`` seconds when they expire, so putting an item
+    again only moves it to another bucket, and expiring only pops
+    the buckets of the ticks that passed. Both are O(1) per item no
+    matter how many there are. Items expire between ``ttl`` and
+    ``ttl + resolution`` seconds after their last heartbeat.
+
+    Readers get a :meth:`.snapshot`, which is consistent and does
+    not change when the items do. We only copy the items for a new
+    snapshot after they changed, so heartbeats that put the same
+    value again don't cost readers anything.
+    """
+
+    def __init__(self, ttl: float, resolution: float = 1,
+                 on_expire: Callable[[Hashable, Any], None] = None,
+                 clock: Callable[[], float] = monotonic) -> None:
+        """
+        :param on_expire: Called with the key and value of every
+        item that expires, outside our lock.
+        :param clock: Gets the current time in seconds.
+        """
+        self.ttl = ttl
+        self.resolution = resolution
+        self.on_expire = on_expire
+        self.clock = clock
+        self.values = {}  # type: Dict[Hashable, Any]
+        self.ticks = {}  # type: Dict[Hashable, int]
+        """The tick when every item expires."""
+        self.buckets = {}  # type: Dict[int, Set[Hashable]]
+        """The items that expire in every tick."""
+        self._snapshot = MappingProxyType({})
+        self._changed = False
+        self._lock = Lock()
+
+    def put(self, key: Hashable, value: Any) -> bool:
+        """
+        Sets the item, or refreshes it, for another ``ttl`` seconds.
+
+        :return: Whether the item is new or its value changed.
+        """
+        tick = ceil((self.clock() + self.ttl) / self.resolution)
+        with self._lock:
+            previous = self.ticks.get(key)
+            if previous != tick:
+                if previous is not None:
+                    self._discard(key, previous)
+                self.ticks[key] = tick
+                self.buckets.setdefault(tick, set()).add(key)
+            changed = previous is None or self.values[key] != value
+            if changed:
+                self.values[key] = value
+                self._changed = True
+        return changed
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            tick = self.ticks.pop(key, None)
+            if tick is None:
+                return default
+            self._discard(key, tick)
+            self._changed = True
+            return self.values.pop(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self.values.get(key, default)
+
+    def expire(self) -> List[Tuple[Hashable, Any]]:
+        """
+        Removes the items that were not put for ``ttl`` seconds,
+        telling ``on_expire``.
+
+        :return: The keys and values of the removed items.
+        """
+        now = int(self.clock() / self.resolution)
+        expired = []
+        with self._lock:
+            # There are at most ttl / resolution + 1 buckets
+            for tick in [tick for tick in self.buckets if tick <= now]:
+                for key in self.buckets.pop(tick):
+                    del self.ticks[key]
+                    expired.append((key, self.values.pop(key)))
+            if expired:
+                self._changed = True
+        if self.on_expire:
+            for key, value in expired:
+                self.on_expire(key, value)
+        return expired
+
+    def snapshot(self) -> Mapping[Hashable, Any]:
+        """Gets a read-only copy of the items."""
+        if self._changed:
+            with self._lock:
+                if self._changed:
+                    self._snapshot = MappingProxyType(dict(self.values))
+                    self._changed = False
+        return self._snapshot
+
+    def _discard(self, key: Hashable, tick: int):
+        bucket = self.buckets[tick]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[tick]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.values
@@ -0,0 +1,197 @@
+from contextlib import suppress
+from sys import stderr
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+from typing import Callable, Dict, Iterable, Tuple
+
+from workbench_server.metrics import NULL, Histogram
+
+
+class USBSource:
+    """Where :class:`.HostUSBs` gets the pen-drives plugged in this machine from."""
+
+    def enumerate(self) -> Iterable[dict]:
+        """Gets the plugged-in pen-drives, as :func:`ereuse_utils.usb_flash_drive.plugged_usbs`."""
+        raise NotImplementedError()
+
+    def watch(self, changed: Callable[[], None]):
+        """
+        Calls ``changed`` every time an USB device is plugged or
+        unplugged, forever.
+
+        Raise or return when you can't watch, and we will scan the
+        bus periodically instead.
+        """
+        raise NotImplementedError()
+
+
+class PyUSBSource(USBSource):
+    """
+    Enumerates the pen-drives with pyusb and watches the hotplug
+    events of udev through netlink, when pyudev is installed.
+    """
+
+    def enumerate(self) -> Iterable[dict]:
+        from ereuse_utils.usb_flash_drive import plugged_usbs
+        return plugged_usbs()
+
+    def watch(self, changed: Callable[[], None]):
+        import pyudev
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('usb', 'usb_device')
+        monitor.start()
+        for device in iter(monitor.poll, None):
+            if device.action in {'add', 'remove', 'change'}:
+                changed()
+
+
+class FakeUSBSource(USBSource):
+    """A source of pen-drives that you plug and unplug, for testing."""
+
+    def __init__(self, *usbs: dict) -> None:
+        self.usbs = {usb['_id']: usb for usb in usbs}  # type: Dict[str, dict]
+        self.enumerations = 0
+        self.changed = None  # type: Callable[[], None]
+        self._watching = Event()
+
+    def enumerate(self) -> Iterable[dict]:
+        self.enumerations += 1
+        return tuple(self.usbs.values())
+
+    def watch(self, changed: Callable[[], None]):
+        self.changed = changed
+        self._watching.set()
+        Event().wait()
+
+    def plug(self, usb: dict):
+        self.usbs[usb['_id']] = usb
+        self._hotplug()
+
+    def unplug(self, _id: str):
+        del self.usbs[_id]
+        self._hotplug()
+
+    def _hotplug(self):
+        self._watching.wait()
+        self.changed()
+
+
+class HostUSBs:
+    """
+    The pen-drives plugged in the machine executing WorkbenchServer.
+
+    Enumerating them walks the whole USB bus and reads the
+    descriptors of the devices, which is slow and contends with the
+    hardware, so we do it in a thread only when a device is plugged
+    or unplugged —or every ``poll`` seconds when we can't know— and
+    serve the last enumeration from memory in :meth:`.get`.
+
+    We start enumerating the first time someone asks for them, and
+    after an enumeration fails we wait longer every time, up to
+    ``MAX_BACKOFF`` seconds, as pyusb looks for libusb in every
+    attempt by executing ``ldconfig`` and ``gcc``.
+    """
+
+    DEBOUNCE = 0.2
+    """
+    Seconds we wait after a hotplug event before enumerating, as
+    plugging one device sends many events, and its descriptors
+    are not readable straight away.
+    """
+
+    MAX_BACKOFF = 60
+    """Seconds we wait at most before enumerating again after failing."""
+
+    def __init__(self, source: USBSource, poll: float = 2,
+                 enumeration_time: Histogram = NULL) -> None:
+        self.source = source
+        self.poll = poll
+        self.enumeration_time = enumeration_time
+        self.usbs = ()  # type: Tuple[dict, ...]
+        """The last enumeration. Replaced, never modified."""
+        self.duration = None  # type: float
+        """Seconds the last enumeration took."""
+        self.enumerations = 0
+        self.error = None  # type: Exception
+        """Why the last enumeration failed, if it did."""
+        self.failures = 0
+        """Enumerations in a row that failed."""
+        self.watching = False
+        """Whether we get hotplug events, so we don't have to poll."""
+        self.enumerated = Event()
+        """Set once we tried to enumerate for the first time."""
+        self._changed = Event()
+        self._started = False
+        self._lock = Lock()
+
+    def get(self, timeout: float = 5) -> Tuple[dict, ...]:
+        """
+        Gets the plugged-in pen-drives, waiting up to ``timeout``
+        seconds for the first enumeration.
+        """
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    Thread(target=self._watch, daemon=True).start()
+                    Thread(target=self._enumerate_on_change, daemon=True).start()
+                    self._started = True
+        self.enumerated.wait(timeout)
+        return self.usbs
+
+    def enumerate(self) -> Tuple[dict, ...]:
+        """Enumerates the pen-drives now, updating :attr:`.usbs`."""
+        with self._lock:  # Don't walk the bus twice at the same time
+            start = perf_counter()
+            try:
+                usbs = tuple(self.source.enumerate())
+            except Exception as e:
+                if repr(e) != repr(self.error):  # Don't repeat it every poll
+                    print('Could not enumerate the USBs: {!r}'.format(e), file=stderr)
+                self.error = e
+                self.failures += 1
+                raise
+            finally:
+                self.duration = perf_counter() - start
+                self.enumeration_time.observe(self.duration)
+                self.enumerations += 1
+                self.enumerated.set()
+            self.usbs = usbs
+            self.error = None
+            self.failures = 0
+        return usbs
+
+    def changed(self):
+        """Tells that a device was plugged or unplugged."""
+        self._changed.set()
+
+    def stats(self) -> dict:
+        return {
+            'plugged': len(self.usbs),
+            'enumerations': self.enumerations,
+            'enumerationSeconds': self.duration,
+            'watching': self.watching,
+            'error': repr(self.error) if self.error else None
+        }
+
+    def _watch(self):
+        try:
+            self.watching = True
+            self.source.watch(self.changed)
+        except Exception:  # Ex. no pyudev or no netlink, so we poll
+            pass
+        finally:
+            self.watching = False
+            self.changed()
+
+    def _enumerate_on_change(self):
+        while True:
+            with suppress(Exception):
+                self.enumerate()
+            if self.failures:
+                # Hotplug events don't tell us when a failed enumeration will work
+                timeout = min(self.poll * 2 ** (self.failures - 1), self.MAX_BACKOFF)
+            else:
+                timeout = None if self.watching else self.poll
+            self._changed.wait(timeout)
+            sleep(self.DEBOUNCE)
+            self._changed.clear()
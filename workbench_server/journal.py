@@ -0,0 +1,151 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Condition, Thread
+from typing import List
+
+from workbench_server.codec import JSONCodec, stdlib
+
+
+class Journal:
+    """
+    An append-only file with the snapshots waiting to be uploaded,
+    so they are not lost if WorkbenchServer stops before uploading
+    them.
+
+    Every line is a JSON record, either ``{"put": uuid, "snapshot":
+    {...}}`` when a snapshot is queued or ``{"ack": uuid}`` when it
+    has been uploaded (or failed for good). On start, :meth:`.replay`
+    returns the snapshots that were put and not acknowledged.
+
+    A background thread writes and *fsyncs* together all the records
+    that arrived while the previous fsync happened, so writing many
+    records costs about as much as writing one. When many records
+    have been acknowledged the file is compacted.
+    """
+
+    def __init__(self, path: Path, compact_after: int = 1000, codec: JSONCodec = stdlib) -> None:
+        """
+        :param compact_after: Rewrite the file after this number of
+        acknowledgements.
+        """
+        self.path = path
+        self.codec = codec
+        self.compact_after = compact_after
+        self.pending = OrderedDict()
+        """The records of the snapshots waiting to be uploaded."""
+        self.buffer = []
+        self.appended = self.synced = self.acks = 0
+        self.condition = Condition()
+        self.file = None
+        self.closed = False
+        self._thread = None
+
+    def replay(self) -> List[dict]:
+        """
+        Reads the journal, returning the snapshots that were not
+        acknowledged, and starts writing to it.
+
+        Call it once, before putting anything.
+        """
+        if self.path.exists():
+            with self.path.open(encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = self.codec.loads(line)
+                    except ValueError:
+                        # The last line of a journal from a crash
+                        continue
+                    if 'put' in record:
+                        self.pending[record['put']] = line if line.endswith('\n') else line + '\n'
+                    else:
+                        self.pending.pop(record['ack'], None)
+        self._compact()
+        self._thread = Thread(target=self._flush, daemon=True)
+        self._thread.start()
+        return [self.codec.loads(line)['snapshot'] for line in self.pending.values()]
+
+    def put(self, _uuid: str, snapshot: dict, wait: bool = True) -> int:
+        """
+        Records that we have to upload ``snapshot``.
+
+        :param wait: Wait until the record is safe in disk. If not,
+        pass the returned ticket to :meth:`.wait`.
+        """
+        line = self.codec.dumps({'put': _uuid, 'snapshot': snapshot}).decode()
+        return self._append(line + '\n', wait, put=_uuid)
+
+    def wait(self, ticket: int):
+        """Waits until the record of ``ticket`` is safe in disk."""
+        with self.condition:
+            while self.synced < ticket:
+                self.condition.wait()
+
+    def ack(self, _uuid: str):
+        """
+        Records that we do not need to upload the snapshot anymore.
+        Acknowledging an unknown snapshot does nothing.
+        """
+        with self.condition:
+            if _uuid not in self.pending:
+                return
+        self._append(self.codec.dumps({'ack': _uuid}).decode() + '\n', wait=False, ack=_uuid)
+
+    def close(self):
+        """Writes the pending records and stops writing."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self._thread.join()
+        self.file.close()
+
+    def _append(self, line: str, wait: bool, put: str = None, ack: str = None) -> int:
+        with self.condition:
+            if put:
+                self.pending[put] = line
+                self.pending.move_to_end(put)
+            else:
+                self.pending.pop(ack, None)
+                self.acks += 1
+            self.buffer.append(line)
+            self.appended += 1
+            ticket = self.appended
+            self.condition.notify_all()
+            while wait and self.synced < ticket:
+                self.condition.wait()
+            return ticket
+
+    def _flush(self):
+        while True:
+            with self.condition:
+                while not self.buffer:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                lines, self.buffer = self.buffer, []
+                compact = self.acks >= self.compact_after
+            self.file.write(''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if compact:
+                with self.condition:
+                    self.acks = 0
+                    self._compact()
+            with self.condition:
+                self.synced += len(lines)
+                self.condition.notify_all()
+
+    def _compact(self):
+        """
+        Atomically replaces the journal with one that has only the
+        pending records.
+        """
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            f.write(''.join(self.pending.values()))
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file:
+            self.file.close()
+        os.replace(str(tmp), str(self.path))
+        self.file = self.path.open('a', encoding='utf-8')
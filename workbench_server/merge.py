@@ -0,0 +1,103 @@
+from typing import Any, Dict, List
+
+_MISSING = object()
+
+
+def merge(snapshot: dict, patch: dict) -> dict:
+    """
+    Merges ``patch`` into ``snapshot`` like :func:`pydash.merge`, but
+    for snapshots:
+
+    - Instead of modifying ``snapshot`` it returns a new one that
+      shares with ``snapshot`` the values that did not change, so
+      we copy only the dicts and lists on the way to a change.
+      Neither of them must be modified afterwards.
+    - Components are merged with the component of the same
+      ``@type`` and ``serialNumber`` —or the same ``@type`` and
+      position, for components without ``serialNumber``—
+      instead of with the one in the same position of the list,
+      so the order in which Workbench sends them doesn't matter.
+
+    The other lists are merged position by position, and values
+    that are not dicts nor lists are replaced, like pydash does.
+
+    :return: The new snapshot, which is ``snapshot`` if nothing
+    changed.
+    """
+    return _merge(snapshot, patch)
+
+
+def _merge(base: Any, patch: Any, name: Any = None) -> Any:
+    """:param name: The key or index of ``base`` in its parent."""
+    if isinstance(base, dict) and isinstance(patch, dict):
+        result = None
+        for key, value in patch.items():
+            old = base.get(key, _MISSING)
+            new = value if old is _MISSING else _merge(old, value, key)
+            if new is not old:
+                if result is None:
+                    result = dict(base)
+                result[key] = new
+        return base if result is None else result
+    if isinstance(base, list) and isinstance(patch, list):
+        if name == 'components':
+            return _merge_components(base, patch)
+        result = None
+        for i, value in enumerate(patch):
+            if i < len(base):
+                new = _merge(base[i], value, i)
+                if new is base[i]:
+                    continue
+            else:
+                new = value
+            if result is None:
+                result = list(base)
+            if i < len(result):
+                result[i] = new
+            else:
+                result.append(new)
+        return base if result is None else result
+    if type(base) is type(patch) and base == patch:
+        return base
+    return patch
+
+
+def _merge_components(base: list, patch: list) -> list:
+    positions = {key: i for i, key in enumerate(_keys(base))}  # type: Dict[tuple, int]
+    result = None
+    for key, component in zip(_keys(patch), patch):
+        i = positions.get(key)
+        if i is None:  # A new component
+            if result is None:
+                result = list(base)
+            positions[key] = len(result)
+            result.append(component)
+            continue
+        current = base[i] if result is None else result[i]
+        new = _merge(current, component, i)
+        if new is not current:
+            if result is None:
+                result = list(base)
+            result[i] = new
+    return base if result is None else result
+
+
+def _keys(components: list) -> List[tuple]:
+    """
+    Identifies the components by ``@type`` and ``serialNumber`` or,
+    for the ones without serial number, by ``@type`` and how many
+    of them came before.
+    """
+    keys = []
+    without_serial = {}
+    for component in components:
+        if not isinstance(component, dict):
+            keys.append((None, len(keys)))
+            continue
+        _type, serial_number = component.get('@type'), component.get('serialNumber')
+        if serial_number:
+            keys.append((_type, serial_number))
+        else:
+            n = without_serial[_type] = without_serial.get(_type, -1) + 1
+            keys.append((_type, None, n))
+    return keys
@@ -0,0 +1,240 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from math import inf
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+from workbench_server.codec import JSONCodec
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+"""The default upper bounds of the buckets of histograms, in seconds."""
+
+Sample = Tuple[str, Dict[str, str], float]
+"""The suffix of the name of the metric, the labels and the value."""
+
+
+class Metrics:
+    """
+    Measures WorkbenchServer, exposing the measurements in the text
+    format of `Prometheus <https://prometheus.io/docs/instrumenting/
+    exposition_formats/>`_ through ``/metrics``.
+
+    Create metrics with :meth:`.counter` and :meth:`.histogram`, and
+    expose values that already exist somewhere else, like the
+    length of a queue, with :meth:`.callback`.
+
+    Disabled metrics are :data:`.NULL`, which does nothing, so the
+    hot paths we measure do not get slower.
+
+    When we run many processes every process has its own metrics.
+    """
+
+    def __init__(self, enabled: bool = True, prefix: str = 'workbench_') -> None:
+        self.enabled = enabled
+        self.prefix = prefix
+        self.metrics = OrderedDict()  # type: Dict[str, Metric]
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> 'Counter':
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = BUCKETS) -> 'Histogram':
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def callback(self, name: str, help: str, type: str,
+                 function: Callable[[], Union[float, Iterable[Sample]]]):
+        """
+        Exposes the value that ``function`` returns, or its samples,
+        every time we :meth:`.render`.
+
+        :param type: ``gauge``, ``counter`` or ``histogram``.
+        """
+        self._add(Callback(self.prefix + name, help, type, function))
+
+    def _add(self, metric: 'Metric'):
+        if not self.enabled:
+            return NULL
+        assert metric.name not in self.metrics, 'Metric {} already exists'.format(metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in tuple(self.metrics.values()):
+            try:
+                samples = list(metric.samples())
+            except Exception as e:  # A broken callback should not hide the rest
+                lines.append('# {} failed: {!r}'.format(metric.name, e))
+                continue
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(metric.name, suffix, _labels(labels),
+                                                _value(value)))
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class Metric:
+    type = None  # type: str
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values = {}  # type: Dict[tuple, float]
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = tuple(self.values.items())
+        for label_values, value in values:
+            yield '_total', dict(zip(self.labels, label_values)), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # type: Dict[tuple, List[float]]
+        """Per labels, the count of every bucket, then the sum."""
+
+    def observe(self, seconds: float, *label_values: str):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self.values.get(label_values)
+            if values is None:
+                values = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            values[i] += 1
+            values[-1] += seconds
+
+    def time(self, *label_values: str) -> '_Timer':
+        """Observes the time the ``with`` block takes."""
+        return _Timer(self, label_values)
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = tuple((k, list(v)) for k, v in self.values.items())
+        for label_values, counts in values:
+            labels = dict(zip(self.labels, label_values))
+            yield from histogram_samples(self.buckets, counts[:-1], counts[-1], labels)
+
+
+class Callback(Metric):
+    def __init__(self, name: str, help: str, type: str,
+                 function: Callable[[], Union[float, Iterable[Sample]]]) -> None:
+        super().__init__(name, help)
+        self.type = type
+        self.function = function
+
+    def samples(self) -> Iterable[Sample]:
+        value = self.function()
+        if isinstance(value, (int, float)):
+            return [('_total' if self.type == 'counter' else '', {}, value)]
+        return value
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: tuple) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.start, *self.label_values)
+
+
+class _Null:
+    """A disabled metric, which does nothing."""
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args):
+        pass
+
+    def time(self, *args):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL = _Null()
+
+
+class TimedCodec(JSONCodec):
+    """A codec that measures the time it takes to encode JSON."""
+
+    def __init__(self, codec: JSONCodec, histogram: Histogram) -> None:
+        self.codec = codec
+        self.name = codec.name
+        self.histogram = histogram
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        start = perf_counter()
+        data = self.codec.dumps(obj, pretty)
+        self.histogram.observe(perf_counter() - start)
+        return data
+
+    def loads(self, data):
+        return self.codec.loads(data)
+
+
+def histogram_samples(buckets: Sequence[float], counts: Sequence[float], total: float,
+                      labels: Dict[str, str] = None) -> Iterable[Sample]:
+    """
+    The samples of a histogram.
+
+    :param counts: The observations that fell in every bucket,
+    not cumulative, plus the ones greater than the last bucket.
+    :param total: The sum of the observations.
+    """
+    labels = labels or {}
+    cumulative = 0
+    for bound, count in zip(tuple(buckets) + (inf,), counts):
+        cumulative += count
+        yield '_bucket', dict(labels, le='+Inf' if bound == inf else repr(bound)), cumulative
+    yield '_sum', labels, total
+    yield '_count', labels, cumulative
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                .replace('\n', '\\n'))
+               for k, v in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def _value(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if value in (inf, -inf):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
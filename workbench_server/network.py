@@ -0,0 +1,79 @@
+import socket
+from contextlib import suppress
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Optional
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+
+class LocalAddress:
+    """
+    Caches the local IP of this machine, so requests don't open
+    sockets to find it out.
+
+    We get it the first time someone asks, and then again in a
+    thread every time the kernel tells us through netlink that
+    the links, addresses or routes changed, and every
+    ``interval`` seconds in case we can't listen to netlink.
+    """
+
+    DEBOUNCE = 0.5
+    """Seconds we wait for the burst of netlink messages of a change to end."""
+
+    def __init__(self, get: Callable[[], str], interval: float = 60) -> None:
+        """
+        :param get: Gets the IP, raising :class:`OSError` if
+        there is no network.
+        """
+        self.get_ip = get
+        self.interval = interval
+        self.ip = None  # type: Optional[str]
+        self._started = False
+        self._lock = Lock()
+
+    def get(self) -> Optional[str]:
+        """Gets the IP, or ``None`` if there is no network."""
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    self.refresh()
+                    Thread(target=self._refresh_on_change, daemon=True).start()
+                    self._started = True
+        return self.ip
+
+    def refresh(self):
+        ip = None
+        with suppress(OSError):
+            ip = self.get_ip()
+        self.ip = ip
+
+    def _refresh_on_change(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+                       | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+        except (AttributeError, OSError):  # Not Linux
+            sock = None
+        while True:
+            if sock is None:
+                sleep(self.interval)
+            else:
+                sock.settimeout(self.interval)
+                with suppress(OSError):  # A timeout, or we missed messages
+                    sock.recv(65536)
+                    sleep(self.DEBOUNCE)
+                    _drain(sock)
+            self.refresh()
+
+
+def _drain(sock: socket.socket):
+    sock.settimeout(0)
+    with suppress(OSError):
+        while sock.recv(65536):
+            pass
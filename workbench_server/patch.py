@@ -0,0 +1,169 @@
+"""
+The patch formats of ``PATCH /snapshots/<uuid>`` besides our own
+merge (see :func:`workbench_server.merge.merge`), so clients like
+Workbench can send only what changed, and remove values:
+
+- `JSON Merge Patch <https://tools.ietf.org/html/rfc7396>`_
+  (``application/merge-patch+json``), with :func:`.merge_patch`.
+- `JSON Patch <https://tools.ietf.org/html/rfc6902>`_
+  (``application/json-patch+json``), with :func:`.json_patch`.
+
+Like :func:`workbench_server.merge.merge`, they don't modify the
+document but return a new one that shares what did not change.
+"""
+from typing import Any, Callable, List
+
+OPERATIONS = {'add', 'remove', 'replace', 'move', 'copy', 'test'}
+
+_MISSING = object()
+
+
+class PatchError(ValueError):
+    """The patch is malformed."""
+
+
+class PatchConflict(Exception):
+    """The patch is well formed but cannot be applied to the document."""
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """Applies a JSON Merge Patch, where ``null`` removes the value."""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    result = None
+    for key, value in patch.items():
+        if value is None:
+            if key in target:
+                if result is None:
+                    result = dict(target)
+                del result[key]
+            continue
+        old = target.get(key, _MISSING)
+        new = merge_patch({} if old is _MISSING else old, value)
+        if new is not old:
+            if result is None:
+                result = dict(target)
+            result[key] = new
+    return target if result is None else result
+
+
+def validate(operations: Any):
+    """Raises :class:`.PatchError` if the operations of a JSON Patch are malformed."""
+    if not isinstance(operations, list):
+        raise PatchError('A JSON Patch is a list of operations.')
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise PatchError('Operation {!r} is not one of {}.'.format(operation,
+                                                                       sorted(OPERATIONS)))
+        pointer(operation.get('path'))
+        if operation['op'] in {'add', 'replace', 'test'} and 'value' not in operation:
+            raise PatchError('Operation {!r} needs a value.'.format(operation))
+        if operation['op'] in {'move', 'copy'}:
+            pointer(operation.get('from'))
+
+
+def json_patch(document: Any, operations: List[dict]) -> Any:
+    """
+    Applies the operations of a JSON Patch, all or none.
+
+    :raise PatchError: The operations are malformed.
+    :raise PatchConflict: An operation cannot be applied, like
+    removing a value that does not exist or a failed ``test``.
+    """
+    validate(operations)
+    for operation in operations:
+        op, path = operation['op'], pointer(operation['path'])
+        if op == 'add':
+            document = _add(document, path, operation['value'])
+        elif op == 'remove':
+            document = _remove(document, path)
+        elif op == 'replace':
+            if path:
+                document = _add(_remove(document, path), path, operation['value'])
+            else:  # The whole document
+                document = operation['value']
+        elif op == 'test':
+            if _get(document, path) != operation['value']:
+                raise PatchConflict('Test of {} failed.'.format(operation['path']))
+        else:  # move or copy
+            source = pointer(operation['from'])
+            value = _get(document, source)
+            if op == 'move':
+                if path[:len(source)] == source and len(path) > len(source):
+                    raise PatchConflict('Cannot move {} into itself.'.format(operation['from']))
+                document = _remove(document, source)
+            document = _add(document, path, value)
+    return document
+
+
+def pointer(path: Any) -> List[str]:
+    """Parses a `JSON Pointer <https://tools.ietf.org/html/rfc6901>`_."""
+    if not isinstance(path, str) or path and not path.startswith('/'):
+        raise PatchError('{!r} is not a JSON Pointer.'.format(path))
+    return [token.replace('~1', '/').replace('~0', '~') for token in path.split('/')[1:]]
+
+
+def _get(document: Any, path: List[str]) -> Any:
+    for token in path:
+        if isinstance(document, dict) and token in document:
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[_index(token, len(document) - 1)]
+        else:
+            raise PatchConflict('There is no {}.'.format(_path(path)))
+    return document
+
+
+def _add(document: Any, path: List[str], value: Any) -> Any:
+    if not path:
+        return value
+
+    def add(parent):
+        if isinstance(parent, dict):
+            return dict(parent, **{path[-1]: value})
+        if isinstance(parent, list):
+            i = len(parent) if path[-1] == '-' else _index(path[-1], len(parent))
+            return parent[:i] + [value] + parent[i:]
+        raise PatchConflict('Cannot add {}.'.format(_path(path)))
+
+    return _update(document, path[:-1], add)
+
+
+def _remove(document: Any, path: List[str]) -> Any:
+    if not path:
+        raise PatchConflict('Cannot remove the whole document.')
+
+    def remove(parent):
+        if isinstance(parent, dict) and path[-1] in parent:
+            return {k: v for k, v in parent.items() if k != path[-1]}
+        if isinstance(parent, list):
+            i = _index(path[-1], len(parent) - 1)
+            return parent[:i] + parent[i + 1:]
+        raise PatchConflict('There is no {}.'.format(_path(path)))
+
+    return _update(document, path[:-1], remove)
+
+
+def _update(document: Any, path: List[str], function: Callable[[Any], Any]) -> Any:
+    """Copies the containers from ``document`` to ``path``, replacing the last one."""
+    if not path:
+        return function(document)
+    token = path[0]
+    if isinstance(document, dict) and token in document:
+        return dict(document, **{token: _update(document[token], path[1:], function)})
+    if isinstance(document, list):
+        i = _index(token, len(document) - 1)
+        return document[:i] + [_update(document[i], path[1:], function)] + document[i + 1:]
+    raise PatchConflict('There is no {}.'.format(_path(path)))
+
+
+def _index(token: str, maximum: int) -> int:
+    if not token.isdigit() or token != '0' and token.startswith('0') or int(token) > maximum:
+        raise PatchConflict('{!r} is not an index of the list.'.format(token))
+    return int(token)
+
+
+def _path(path: List[str]) -> str:
+    return '/' + '/'.join(token.replace('~', '~0').replace('/', '~1') for token in path)
@@ -0,0 +1,83 @@
+from sys import stderr
+from threading import Lock, Thread
+from time import sleep
+
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+
+class WriteBehind:
+    """
+    Saves documents to a Mongo collection in the background.
+
+    Documents are marked as changed with :meth:`.mark` and written
+    every ``interval`` seconds in a single ``bulk_write``, so many
+    changes of the same document between writes cost one write,
+    and requests do not wait for Mongo.
+
+    Documents can be saved with the number of the last change of
+    :class:`workbench_server.replica.SharedReplica` they have, in
+    their ``_applied`` field.
+    """
+
+    def __init__(self, collection: Collection, interval: float = 1) -> None:
+        self.collection = collection
+        self.interval = interval
+        self.dirty = {}
+        """The id, and the document and ``_applied`` of the changed documents."""
+        self._lock = Lock()
+        Thread(target=self._flush_periodically, daemon=True).start()
+
+    def load(self, query: dict = None, projection: dict = None) -> dict:
+        """Gets the documents that match the query, by id."""
+        documents = {}
+        for document in self.collection.find(query, projection):
+            documents[document.pop('_id')] = document
+        return documents
+
+    def find_one(self, _id):
+        """Gets a document, including the ones not written yet."""
+        with self._lock:
+            if _id in self.dirty:
+                return self.dirty[_id][0]
+        document = self.collection.find_one({'_id': _id})
+        if document:
+            document.pop('_id')
+        return document
+
+    def mark(self, _id, document: dict, applied: int = None):
+        """
+        Marks the document as changed, to be written later.
+
+        The document must not be modified after, as we keep
+        a reference to it until we write it.
+        """
+        with self._lock:
+            self.dirty[_id] = document, applied
+
+    def flush(self):
+        """Writes the changed documents now."""
+        with self._lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        requests = []
+        for _id, (document, applied) in dirty.items():
+            document = dict(document, _id=_id)
+            if applied is not None:
+                document['_applied'] = applied
+            requests.append(ReplaceOne({'_id': _id}, document, upsert=True))
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            print('Could not save to Mongo, trying later: {!r}'.format(e), file=stderr)
+            with self._lock:
+                # Keep newer changes that happened meanwhile
+                dirty.update(self.dirty)
+                self.dirty = dirty
+
+    def _flush_periodically(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
@@ -0,0 +1,122 @@
+import sys
+from collections import Counter
+from os.path import basename
+from random import random
+from threading import Event, Lock, Thread, get_ident
+from time import sleep
+from types import FrameType
+from typing import Set
+
+
+class Profiler:
+    """
+    Finds where requests spend their time by sampling the stacks of
+    the threads serving them every ``interval`` seconds.
+
+    We profile a fraction ``rate`` of the requests, and every request
+    to ``route``. Samples are aggregated as collapsed stacks, the
+    input of flame graph tools like `FlameGraph <https://github.com/
+    brendangregg/FlameGraph>`_ or `speedscope <https://speedscope.app>`_::
+
+        GET /info;view_info (info.py:17);info (info.py:44) 12
+
+    The sampling thread only wakes up while there are requests to
+    profile, so requests we do not profile do not get slower.
+    """
+
+    MAX_DEPTH = 100
+    """
+    Frames of a stack we keep, from the request to the top; deeper
+    frames are counted together in a ``(deeper)`` frame.
+    """
+
+    def __init__(self, rate: float = 0, route: str = None, interval: float = 0.005,
+                 max_stacks: int = 10000) -> None:
+        """
+        :param max_stacks: Different stacks we keep at most; the
+        samples of newer ones are counted as ``(other)``.
+        """
+        self.rate = rate
+        self.route = route
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.requests = 0
+        """The requests we profiled."""
+        self.profiling = {}
+        """The threads we profile and the name of their request."""
+        self._lock = Lock()
+        self._wake = Event()
+        Thread(target=self._sample_periodically, daemon=True).start()
+
+    def wants(self, route: str) -> bool:
+        """Whether to profile a request to ``route``."""
+        return route == self.route or bool(self.rate and random() < self.rate)
+
+    def start(self, name: str):
+        """Profiles the current thread, which serves the request ``name``."""
+        # The frames below the request, which we leave out of the stacks
+        below = set()
+        frame = sys._getframe(1)
+        while frame is not None:
+            below.add(frame)
+            frame = frame.f_back
+        with self._lock:
+            self.profiling[get_ident()] = name, below
+            self.requests += 1
+        self._wake.set()
+
+    def stop(self):
+        with self._lock:
+            self.profiling.pop(get_ident(), None)
+
+    def collapsed(self) -> str:
+        """Gets the samples as collapsed stacks."""
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks)
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.requests = 0
+
+    def sample(self):
+        """Samples the stacks of the threads we profile."""
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, (name, below) in self.profiling.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = ';'.join([name] + _stack(frame, below, self.MAX_DEPTH))
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = name + ';(other)'
+                self.stacks[stack] += 1
+
+    def _sample_periodically(self):
+        while True:
+            self._wake.wait()
+            sleep(self.interval)
+            self.sample()
+            with self._lock:
+                if not self.profiling:
+                    self._wake.clear()
+
+
+def _stack(frame: FrameType, below: Set[FrameType], depth: int) -> list:
+    """
+    The first ``depth`` frames from the first one that is not
+    ``below`` to ``frame``, as ``function (file:line)``.
+    """
+    frames = []
+    while frame is not None and frame not in below:
+        frames.append(frame.f_code)
+        frame = frame.f_back
+    frames.reverse()
+    stack = ['{} ({}:{})'.format(code.co_name, basename(code.co_filename),
+                                 code.co_firstlineno).replace(';', ',')
+             for code in frames[:depth]]
+    if len(frames) > depth:
+        stack.append('(deeper)')
+    return stack
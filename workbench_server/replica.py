@@ -0,0 +1,156 @@
+import os
+from socket import gethostname
+from sys import stderr
+from threading import RLock, Thread
+from time import sleep, time
+from typing import Callable, Dict
+from uuid import uuid4
+
+from workbench_server import flaskapp
+from workbench_server.shared import SharedState
+
+
+class Replica:
+    """
+    Applies the changes to the state of WorkbenchServer.
+
+    Views do not change their state directly; they :meth:`.publish`
+    the change and apply it in the function they registered with
+    :meth:`.on`. This replica, for when we run one process,
+    applies the changes straight away; :class:`.SharedReplica`
+    applies them in every process.
+
+    Things that only one process has to do, like uploading
+    snapshots, are done by the *leader*, which calls the functions
+    registered with :meth:`.on_lead`.
+    """
+
+    def __init__(self, app: 'flaskapp.WorkbenchServer') -> None:
+        self.app = app
+        self.appliers = {}  # type: Dict[str, Callable[[dict], None]]
+        self.leading = []
+        self.leader = False
+        self.applied = None  # type: int
+        """
+        The number of the change we apply, or applied last, in the
+        log of :class:`.SharedReplica`; ``None`` when there is no log.
+        """
+
+    def on(self, kind: str, apply: Callable[[dict], None]):
+        """Applies the changes of ``kind`` with ``apply``."""
+        self.appliers[kind] = apply
+
+    def on_lead(self, start: Callable[[], None], stop: Callable[[], None]):
+        """
+        Calls ``start`` when this process becomes the leader and
+        ``stop`` if it stops being it.
+        """
+        self.leading.append((start, stop))
+
+    def publish(self, kind: str, data: dict):
+        """Changes the state, returning once the change is applied here."""
+        self.appliers[kind](data)
+
+    def start(self):
+        """Starts applying changes, once all views registered."""
+        self._lead(True)
+
+    def _lead(self, leader: bool):
+        self.leader = leader
+        for start, stop in self.leading:
+            if leader:
+                start()
+            else:
+                stop()
+
+
+class SharedReplica(Replica):
+    """
+    Runs WorkbenchServer in many processes, for example as
+    gunicorn workers, sharing the state through a
+    :class:`workbench_server.shared.SharedState`.
+
+    Changes are appended to the log of the shared state, and every
+    process applies the log in order, so they all get the same
+    state. A process returns from :meth:`.publish` once it applied
+    the change, so clients read their own writes in the process
+    that got them; other processes get them some milliseconds
+    later, every ``poll`` seconds.
+
+    The leader is the process holding the lease ``leader``, which
+    it renews every third of ``lease`` seconds, and which other
+    processes take if the leader stops renewing it. The leader
+    removes the entries of the log older than ``keep`` seconds;
+    the other state is in Mongo (see
+    :class:`workbench_server.persistence.WriteBehind`), which only
+    the leader writes, way more often. It saves the snapshots with
+    the number of the last change they have, so a process that
+    starts loads them and applies only the changes of the log that
+    came after.
+    """
+
+    def __init__(self, app: 'flaskapp.WorkbenchServer', state: SharedState, poll: float = 0.05,
+                 lease: float = 10, keep: float = 600) -> None:
+        super().__init__(app)
+        self.state = state
+        self.poll = poll
+        self.lease = lease
+        self.keep = keep
+        self.id = '{}-{}-{}'.format(gethostname(), os.getpid(), uuid4().hex[:8])
+        self.applied = 0
+        self._lock = RLock()
+
+    def publish(self, kind: str, data: dict):
+        number = self.state.append({'kind': kind, 'data': data})
+        while not self.catch_up(number):
+            sleep(self.poll / 10)  # Entries before ours are on their way
+
+    def catch_up(self, until: int = None) -> bool:
+        """
+        Applies the entries of the log we did not apply yet.
+
+        :return: Whether we applied up to ``until``.
+        """
+        with self._lock:
+            for number, entry in self.state.read(self.applied):
+                self.applied = number  # Appliers save it with what they change
+                try:
+                    self.appliers[entry['kind']](entry['data'])
+                except Exception as e:
+                    # Applying the rest keeps us as close to others as we can
+                    print('Could not apply {} {}: {!r}'.format(entry['kind'], number, e),
+                          file=stderr)
+            return until is None or self.applied >= until
+
+    def start(self):
+        # Become leader after catching up so the leader knows everything
+        self.catch_up()
+        Thread(target=self._tail, daemon=True).start()
+        Thread(target=self._elect, daemon=True).start()
+
+    def _tail(self):
+        while True:
+            sleep(self.poll)
+            try:
+                self.catch_up()
+            except Exception as e:
+                print('Could not read the shared state: {!r}'.format(e), file=stderr)
+
+    def _elect(self):
+        while True:
+            try:
+                leader = self.state.lease('leader', self.id, self.lease)
+            except Exception as e:
+                print('Could not get the lease: {!r}'.format(e), file=stderr)
+                leader = False
+            if leader != self.leader:
+                with self._lock:  # The leader starts from what it applied
+                    if leader:
+                        self.catch_up()
+                    self._lead(leader)
+            if leader:
+                try:
+                    self.state.trim(time() - self.keep)
+                except Exception as e:
+                    print('Could not trim the shared state: {!r}'.format(e), file=stderr)
+            sleep(self.lease / 3)
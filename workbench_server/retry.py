@@ -0,0 +1,104 @@
+import heapq
+from itertools import count
+from random import uniform
+from threading import Condition, Lock
+from time import monotonic
+from typing import Callable
+
+
+class RetryScheduler:
+    """
+    Runs jobs when they are due, keeping the pending ones in
+    a heap ordered by time, so waiting to retry a job does not
+    block the others.
+
+    Call :meth:`.run` in a thread of its own.
+    """
+
+    def __init__(self, execute: Callable, base: float = 2, cap: float = 300) -> None:
+        """
+        :param execute: A function that receives a due job and runs
+        it, like :meth:`concurrent.futures.Executor.submit`.
+        :param base: Seconds to wait before the first retry.
+        :param cap: Maximum seconds to wait before a retry.
+        """
+        self.execute = execute
+        self.base = base
+        self.cap = cap
+        self.heap = []
+        self._order = count()  # Keeps FIFO for jobs due at the same time
+        self.condition = Condition()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, job, delay: float = 0):
+        """Runs ``job`` in ``delay`` seconds."""
+        with self.condition:
+            heapq.heappush(self.heap, (monotonic() + delay, next(self._order), job))
+            self.condition.notify()
+
+    def backoff(self, attempts: int) -> float:
+        """
+        Seconds to wait before retrying a job that failed
+        ``attempts`` times: an exponential backoff with jitter,
+        so jobs failing at the same time do not retry at the same
+        time.
+        """
+        delay = min(self.cap, self.base * 2 ** (attempts - 1))
+        return uniform(delay / 2, delay)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > monotonic():
+                    self.condition.wait(self.heap[0][0] - monotonic() if self.heap else None)
+                _, _, job = heapq.heappop(self.heap)
+            self.execute(job)
+
+
+class CircuitBreaker:
+    """
+    Stops trying to connect to a host that keeps failing.
+
+    After ``threshold`` consecutive failures the circuit *opens*
+    and :meth:`.allow` returns False for ``cooldown`` seconds. Then
+    one try is allowed; if it succeeds the circuit *closes* again,
+    otherwise it opens for another ``cooldown``.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0
+        self._lock = Lock()
+
+    @property
+    def open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def allow(self) -> bool:
+        """Can we try to connect?"""
+        with self._lock:
+            if not self.open:
+                return True
+            if monotonic() >= self.opened_until:
+                # Half-open: let this one try and wait for the others
+                self.opened_until = monotonic() + self.cooldown
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        """Seconds until the circuit lets us try again."""
+        return max(0, self.opened_until - monotonic())
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures == self.threshold:
+                self.opened_until = monotonic() + self.cooldown
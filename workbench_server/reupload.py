@@ -0,0 +1,156 @@
+"""
+Uploads again to DeviceHub the snapshots in ``Failed Snapshots``,
+for example after fixing what made DeviceHub reject them.
+
+Execute ``workbench-server-reupload --help`` to do it from the
+command line; WorkbenchServer must have the credentials of DeviceHub,
+which DeviceHubClient gives when it connects.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep, time
+from typing import Callable, Iterator
+
+import requests
+
+from workbench_server.codec import JSONCodec, stdlib
+from workbench_server.files import read_json_file
+
+
+class Reupload:
+    """
+    Submits the snapshots of a folder of failed snapshots, reading
+    them one by one as they are submitted, with at most
+    ``concurrency`` of them waiting for their outcome.
+
+    Tell the outcome of the uploads with :meth:`.outcome`. Uploaded
+    snapshots are removed from the folder, as the submitter saves
+    them in the folder of uploaded snapshots; failed ones stay.
+    """
+
+    def __init__(self, folder: Path, submit: Callable[[dict], None], concurrency: int = 16,
+                 codec: JSONCodec = stdlib) -> None:
+        """
+        :param submit: A function that uploads the snapshot.
+        """
+        self.folder = folder
+        self.submit = submit
+        self.codec = codec
+        self.slots = BoundedSemaphore(concurrency)
+        self.paths = {}
+        """The uuid and path of the snapshots waiting for their outcome."""
+        self.seen = set()
+        """
+        The uuids we submitted. Failing again re-writes the file,
+        which we could find again while reading the folder.
+        """
+        self.counts = dict.fromkeys(('submitted', 'uploaded', 'failed', 'unreadable'), 0)
+        self.started = time()
+        self.listed = False
+        """Whether we have read all the files of the folder."""
+        self.finished = None
+        self._lock = Lock()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self.finished is None
+
+    def outcome(self, _uuid: str, changes: dict) -> bool:
+        """
+        Tells the changes the submitter made to a snapshot.
+
+        :return: Whether the snapshot is one of ours.
+        """
+        with self._lock:
+            if _uuid not in self.paths:
+                return False
+            if not changes.get('_saved'):  # A connection error; the submitter retries
+                return True
+            path = self.paths.pop(_uuid)
+            self.counts['uploaded' if '_uploaded' in changes else 'failed'] += 1
+            self._finish_if_done()
+        if '_uploaded' in changes:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        self.slots.release()
+        return True
+
+    def progress(self) -> dict:
+        with self._lock:
+            progress = dict(self.counts, running=self.running, pending=len(self.paths))
+        elapsed = (self.finished or time()) - self.started
+        done = progress['uploaded'] + progress['failed']
+        progress['seconds'] = elapsed
+        progress['per_second'] = done / elapsed if elapsed else 0
+        return progress
+
+    def _run(self):
+        for path in failed_files(self.folder):
+            self.slots.acquire()
+            try:
+                snapshot = read_json_file(path, self.codec)
+                _uuid = str(snapshot['_uuid'])
+            except (OSError, ValueError, KeyError) as e:
+                print('Could not read failed snapshot {}: {!r}'.format(path, e), file=sys.stderr)
+                with self._lock:
+                    self.counts['unreadable'] += 1
+                self.slots.release()
+                continue
+            if _uuid in self.seen:
+                self.slots.release()
+                continue
+            self.seen.add(_uuid)
+            with self._lock:
+                self.paths[_uuid] = path
+                self.counts['submitted'] += 1
+            self.submit(snapshot)
+        with self._lock:
+            self.listed = True
+            self._finish_if_done()
+
+    def _finish_if_done(self):
+        if self.listed and not self.paths and self.finished is None:
+            self.finished = time()
+
+
+def failed_files(folder: Path) -> Iterator[Path]:
+    """Lazily gets the snapshot files of the folder."""
+    for entry in os.scandir(str(folder)):
+        if entry.is_file() and entry.name.endswith(('.json', '.json.gz')):
+            yield Path(entry.path)
+
+
+def main(args=None):
+    """Starts uploading again the failed snapshots and shows the progress."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', default='https://localhost:8091',
+                        help='The URL of WorkbenchServer.')
+    parser.add_argument('--insecure', action='store_true',
+                        help='Do not verify the certificate of WorkbenchServer.')
+    args = parser.parse_args(args)
+    url = '{}/snapshots/failed'.format(args.server.rstrip('/'))
+    session = requests.Session()
+    session.verify = not args.insecure
+    r = session.post(url)
+    if r.status_code != 202:
+        print('Could not start: {}'.format(r.text), file=sys.stderr)
+        return 1
+    while True:
+        progress = session.get(url).json()
+        print('\r{submitted} submitted, {uploaded} uploaded, {failed} failed, {pending} pending '
+              '({per_second:.1f}/s)'.format(**progress), end='', flush=True)
+        if not progress['running']:
+            print()
+            return 0
+        sleep(1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
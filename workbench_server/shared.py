@@ -0,0 +1,164 @@
+from contextlib import suppress
+from itertools import count
+from threading import Lock
+from time import time
+from typing import List, Tuple
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+
+class SharedState:
+    """
+    State shared by the processes of WorkbenchServer when we run
+    many of them (see :class:`workbench_server.replica.Replica`).
+
+    It is an ordered log of changes, which every process applies
+    in the same order to get the same state, plus leases to elect
+    the process that does something only one of them has to do,
+    and counters.
+    """
+
+    def append(self, entry: dict) -> int:
+        """Adds an entry at the end of the log, returning its number."""
+        raise NotImplementedError()
+
+    def read(self, after: int) -> List[Tuple[int, dict]]:
+        """Gets the number and the entries after the ``after`` one."""
+        raise NotImplementedError()
+
+    def trim(self, older_than: float):
+        """Removes the entries appended before the timestamp."""
+        raise NotImplementedError()
+
+    def lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        Gets or renews the lease ``name`` for ``ttl`` seconds,
+        returning whether ``owner`` has it.
+        """
+        raise NotImplementedError()
+
+    def next(self, counter: str) -> int:
+        """Increases the counter, returning the new value."""
+        raise NotImplementedError()
+
+
+class MemoryState(SharedState):
+    """
+    Shared state for the instances of WorkbenchServer in one
+    process, for testing.
+    """
+
+    def __init__(self) -> None:
+        self.log = []
+        """The number, the entry and when it was appended."""
+        self.leases = {}
+        self.counters = {}
+        self._numbers = count(1)
+        self._lock = Lock()
+
+    def append(self, entry: dict) -> int:
+        with self._lock:
+            number = next(self._numbers)
+            self.log.append((number, entry, time()))
+        return number
+
+    def read(self, after: int) -> List[Tuple[int, dict]]:
+        with self._lock:
+            return [(number, entry) for number, entry, _ in self.log if number > after]
+
+    def trim(self, older_than: float):
+        with self._lock:
+            self.log = [e for e in self.log if e[2] >= older_than]
+
+    def lease(self, name: str, owner: str, ttl: float) -> bool:
+        with self._lock:
+            holder, expires = self.leases.get(name, (None, 0))
+            if holder in (None, owner) or expires < time():
+                self.leases[name] = owner, time() + ttl
+                return True
+            return False
+
+    def next(self, counter: str) -> int:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+            return self.counters[counter]
+
+
+class MongoState(SharedState):
+    """
+    Shared state in the ``state_*`` collections of Mongo.
+
+    Entries get their number from a counter in ``state_counters``;
+    as two processes can get their numbers in one order and insert
+    the entries in the other, :meth:`.read` only returns entries
+    without gaps, waiting a bit for the missing ones.
+
+    If a missing entry does not come —the process that took its
+    number died before inserting it— we fill its number with an
+    empty entry, which every process skips. The insert of the one
+    that got the number, if it is only slow, fails then, and
+    :meth:`.append` tries again with another number, so no
+    process skips an entry that others applied.
+    """
+
+    GAP_TIMEOUT = 1
+    """Seconds we wait for a missing entry before filling it."""
+
+    def __init__(self, db: Database) -> None:
+        self.log = db.state_log
+        self.leases = db.state_leases
+        self.counters = db.state_counters
+        self.log.create_index([('at', ASCENDING)])
+        self._gap = None
+        """The number of the missing entry we wait for, and since when."""
+
+    def append(self, entry: dict) -> int:
+        while True:
+            number = self.next('log')
+            try:
+                self.log.insert_one({'_id': number, 'entry': entry, 'at': time()})
+            except DuplicateKeyError:  # Somebody filled our number; see read()
+                continue
+            return number
+
+    def read(self, after: int) -> List[Tuple[int, dict]]:
+        entries = []
+        expected = after + 1
+        for doc in self.log.find({'_id': {'$gt': after}}).sort('_id', ASCENDING):
+            if doc['_id'] != expected and (entries or after):
+                gap = self._gap
+                if gap is None or gap[0] != expected:
+                    self._gap = expected, time()
+                elif time() - gap[1] >= self.GAP_TIMEOUT:
+                    with suppress(DuplicateKeyError):  # Unless it just came
+                        self.log.insert_one({'_id': expected, 'at': time()})
+                break  # We read it next time, whoever inserted it
+            self._gap = None
+            if 'entry' in doc:  # Not a number we filled
+                entries.append((doc['_id'], doc['entry']))
+            expected = doc['_id'] + 1
+        return entries
+
+    def trim(self, older_than: float):
+        self.log.delete_many({'at': {'$lt': older_than}})
+
+    def lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time()
+        query = {'_id': name, '$or': [{'owner': owner}, {'expires': {'$lt': now}}]}
+        try:
+            lease = self.leases.find_one_and_update(query,
+                                                    {'$set': {'owner': owner,
+                                                              'expires': now + ttl}},
+                                                    upsert=True,
+                                                    return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:  # Somebody else has it
+            return False
+        return lease['owner'] == owner
+
+    def next(self, counter: str) -> int:
+        doc = self.counters.find_one_and_update({'_id': counter}, {'$inc': {'value': 1}},
+                                                upsert=True,
+                                                return_document=ReturnDocument.AFTER)
+        return doc['value']
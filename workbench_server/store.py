@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from itertools import count
+from sys import getsizeof
+from threading import Lock
+from time import monotonic
+from typing import Callable, Iterator, List, Set, Tuple
+
+
+class SnapshotStore:
+    """
+    Keeps the snapshots in memory, safe for many threads.
+
+    Snapshots are never modified in place: :meth:`.transform` builds
+    a new snapshot and then replaces the old one (copy-on-write), so
+    readers always get whole snapshots without locking, and must not
+    modify them. Writers of the same snapshot go one after the other
+    by holding one of ``stripes`` locks, chosen by hashing the uuid,
+    so writers of different snapshots rarely wait for each other.
+
+    Listing the snapshots returns a tuple that is cached until the
+    next write, so consecutive listings cost nothing.
+
+    The store also caches the JSON of every snapshot (see
+    :meth:`.encoded`). As snapshots are never modified, the cache is
+    valid while the snapshot is the same object.
+    """
+
+    def __init__(self, stripes: int = 64, encode: Callable[[dict, bool], bytes] = None) -> None:
+        """
+        :param encode: A function that gets a snapshot and whether
+        the JSON is for the public (like in :func:`workbench_server.
+        views.snapshots.remove_auxiliary_properties`) and returns it
+        encoded in JSON.
+        """
+        self._snapshots = {}
+        self._encode = encode
+        self._encoded = {}
+        """``(uuid, public)``: the snapshot and its JSON."""
+        self._locks = tuple(Lock() for _ in range(stripes))
+        self._versions = count(1)  # next() is atomic, unlike += 1
+        self._version = 0
+        self._listing = -1, ()
+
+    def lock(self, _uuid: str) -> Lock:
+        """The lock that writers of the snapshot hold."""
+        return self._locks[hash(_uuid) % len(self._locks)]
+
+    def __contains__(self, _uuid: str) -> bool:
+        return _uuid in self._snapshots
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(tuple(self._snapshots))
+
+    def __getitem__(self, _uuid: str) -> dict:
+        return self._snapshots[_uuid]
+
+    def get(self, _uuid: str, default=None) -> dict:
+        return self._snapshots.get(_uuid, default)
+
+    def values(self) -> Tuple[dict]:
+        """A consistent listing of the snapshots, in insertion order."""
+        version, listing = self._listing
+        if version != self._version:
+            # Get the version before so a write happening
+            # while we copy invalidates our listing
+            version = self._version
+            listing = tuple(self._snapshots.values())
+            self._listing = version, listing
+        return listing
+
+    def items(self) -> Tuple[Tuple[str, dict]]:
+        return tuple(self._snapshots.items())
+
+    def transform(self, _uuid: str, function: Callable[[dict], dict]) -> dict:
+        """
+        Changes a snapshot, creating it if it does not exist.
+
+        :param function: A function that gets the snapshot, or an
+        empty dict, and returns the new one without modifying it,
+        sharing the parts that did not change (like
+        :func:`workbench_server.merge.merge`). It is executed while
+        holding the lock of the snapshot.
+        :return: The new snapshot.
+        """
+        with self.lock(_uuid):
+            snapshot = function(self._snapshots.get(_uuid, {}))
+            self._set(_uuid, snapshot)
+        return snapshot
+
+    def set(self, _uuid: str, snapshot: dict):
+        """Replaces a snapshot, creating it if it does not exist."""
+        with self.lock(_uuid):
+            self._set(_uuid, snapshot)
+
+    def remove(self, _uuid: str) -> dict:
+        with self.lock(_uuid):
+            snapshot = self._snapshots.pop(_uuid, None)
+            self._version = next(self._versions)
+            self._encoded.pop((_uuid, False), None)
+            self._encoded.pop((_uuid, True), None)
+        return snapshot
+
+    def encoded(self, _uuid: str, snapshot: dict = None, public: bool = False) -> bytes:
+        """
+        Gets the snapshot encoded in JSON, encoding
+        it only if it changed since last time.
+
+        :param snapshot: The snapshot of ``_uuid``, if you have it.
+        """
+        if snapshot is None:
+            snapshot = self._snapshots[_uuid]
+        key = _uuid, public
+        cached = self._encoded.get(key)
+        if cached is None or cached[0] is not snapshot:
+            cached = snapshot, self._encode(snapshot, public)
+            if self._snapshots.get(_uuid) is snapshot:  # Don't cache removed ones
+                self._encoded[key] = cached
+        return cached[1]
+
+    def encoded_values(self, uuids: Set[str] = None) -> List[bytes]:
+        """
+        Like :meth:`.values` but encoded in JSON.
+
+        :param uuids: Only get the snapshots with these uuids.
+        """
+        return [self.encoded(_uuid, snapshot) for _uuid, snapshot in self.items()
+                if uuids is None or _uuid in uuids]
+
+    def memory_size(self) -> int:
+        """
+        Approximate bytes the snapshots take in memory. This is
+        slow; don't use it in hot paths.
+        """
+        seen = set()
+
+        def size(obj) -> int:
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            total = getsizeof(obj)
+            if isinstance(obj, dict):
+                total += sum(size(k) + size(v) for k, v in obj.items())
+            elif isinstance(obj, (list, tuple)):
+                total += sum(size(v) for v in obj)
+            return total
+
+        encoded = sum(getsizeof(json) for _, json in tuple(self._encoded.values()))
+        return sum(size(snapshot) for snapshot in self.values()) + encoded
+
+    def _set(self, _uuid: str, snapshot: dict):
+        self._snapshots[_uuid] = snapshot
+        self._version = next(self._versions)
+
+
+class Retention:
+    """
+    Decides when to remove finished snapshots (uploaded or saved
+    as failed) from memory: after ``ttl`` seconds since they
+    finished or, if there are more than ``maximum`` of them, the
+    least recently used ones.
+    """
+
+    def __init__(self, ttl: float, maximum: int) -> None:
+        self.ttl = ttl
+        self.maximum = maximum
+        self.finished = OrderedDict()
+        """The finished snapshots and when they finished, oldest used first."""
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.finished)
+
+    def finish(self, _uuid: str):
+        with self._lock:
+            self.finished[_uuid] = monotonic()
+            self.finished.move_to_end(_uuid)
+
+    def touch(self, _uuid: str):
+        """Marks the snapshot as recently used."""
+        with self._lock:
+            if _uuid in self.finished:
+                self.finished.move_to_end(_uuid)
+
+    def forget(self, _uuid: str):
+        """The snapshot is not finished anymore."""
+        with self._lock:
+            self.finished.pop(_uuid, None)
+
+    def expired(self) -> List[str]:
+        """Gets and forgets the snapshots to remove from memory."""
+        expired = []
+        with self._lock:
+            while len(self.finished) > self.maximum:
+                expired.append(self.finished.popitem(last=False)[0])
+            limit = monotonic() - self.ttl
+            expired.extend(_uuid for _uuid, at in self.finished.items() if at < limit)
+            for _uuid in expired:
+                self.finished.pop(_uuid, None)
+        return expired
@@ -0,0 +1,43 @@
+"""
+Compares the JSON codecs (see :mod:`workbench_server.codec`)
+that are installed, encoding, pretty-encoding (as for files) and
+decoding the ``phases.json`` fixture.
+
+Execute it with ``python -m workbench_server.tests.bench_codec``.
+"""
+from timeit import timeit
+
+from pydash import merge
+
+from workbench_server.codec import CODECS, get_codec
+from workbench_server.tests.conftest import jsonf
+
+
+def bench(name: str, number: int = 2000):
+    """
+    :return: Microseconds to encode, pretty-encode and decode
+    the phases and the resulting snapshot.
+    """
+    codec = get_codec(name)
+    phases = jsonf('phases')
+    snapshot = {}
+    for phase in phases:
+        merge(snapshot, phase)
+    objs = phases + [snapshot]
+    encoded = [codec.dumps(obj) for obj in objs]
+    return tuple(timeit(f, number=number) / number * 10 ** 6 for f in (
+        lambda: [codec.dumps(obj) for obj in objs],
+        lambda: [codec.dumps(obj, pretty=True) for obj in objs],
+        lambda: [codec.loads(data) for data in encoded]
+    ))
+
+
+if __name__ == '__main__':
+    print('{:<8} {:>10} {:>10} {:>10}'.format('codec', 'dumps µs', 'pretty µs', 'loads µs'))
+    for codec in CODECS:
+        try:
+            times = bench(codec.name)
+        except ImportError:
+            print('{:<8} not installed'.format(codec.name))
+        else:
+            print('{:<8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(codec.name, *times))
@@ -0,0 +1,87 @@
+"""
+Measures the registry of the pen-drives plugged in clients with 5000
+clients that heartbeat every second while readers poll ``/info``,
+:class:`workbench_server.heartbeats.Heartbeats` versus the
+``cachetools.TTLCache`` we used before, behind a lock.
+
+Execute it with ``python -m workbench_server.tests.bench_heartbeats``.
+"""
+from threading import Lock
+from timeit import timeit
+
+from workbench_server.heartbeats import Heartbeats
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def bench(clients: int = 5000, seconds: int = 20, readers: int = 20, ttl: float = 5):
+    """
+    Simulates ``seconds`` seconds, in which every client heartbeats
+    once, 1% of them stop and as many new ones start, readers read
+    all the pen-drives, and we expire once.
+
+    :return: Microseconds per heartbeat, per expiry and per read.
+    """
+    clock = Clock()
+    heartbeats = Heartbeats(ttl, clock=clock)
+    usbs = [{'hid': str(i), 'serialNumber': str(i)} for i in range(clients * 2)]
+    times = [0, 0, 0]
+
+    for second in range(seconds):
+        clock.now = second
+        start = second * clients // 100  # The ones that stopped
+        alive = usbs[start:start + clients]
+        times[0] += timeit(lambda: [heartbeats.put(usb['hid'], usb) for usb in alive], number=1)
+        times[1] += timeit(heartbeats.expire, number=1)
+        times[2] += timeit(lambda: list(heartbeats.snapshot().values()), number=readers)
+    assert len(heartbeats) >= clients
+    return (times[0] / (seconds * clients) * 1e6, times[1] / seconds * 1e6,
+            times[2] / (seconds * readers) * 1e6)
+
+
+def bench_ttl_cache(clients: int = 5000, seconds: int = 20, readers: int = 20, ttl: float = 5):
+    """Like :func:`.bench` but with a big enough ``TTLCache``."""
+    from cachetools import TTLCache
+
+    clock = Clock()
+    cache = TTLCache(maxsize=clients * 2, ttl=ttl, timer=clock)
+    lock = Lock()
+    usbs = [{'hid': str(i), 'serialNumber': str(i)} for i in range(clients * 2)]
+    times = [0, 0, 0]
+
+    def put(usb):
+        with lock:
+            cache[usb['hid']] = usb
+
+    def expire():
+        with lock:
+            cache.expire()
+
+    def read():
+        with lock:
+            return list(cache.values())
+
+    for second in range(seconds):
+        clock.now = second
+        start = second * clients // 100
+        alive = usbs[start:start + clients]
+        times[0] += timeit(lambda: [put(usb) for usb in alive], number=1)
+        times[1] += timeit(expire, number=1)
+        times[2] += timeit(read, number=readers)
+    return (times[0] / (seconds * clients) * 1e6, times[1] / seconds * 1e6,
+            times[2] / (seconds * readers) * 1e6)
+
+
+if __name__ == '__main__':
+    template = '{}: {:.2f} µs per heartbeat, {:.0f} µs per expiry, {:.0f} µs per read'
+    print(template.format('Heartbeats', *bench()))
+    try:
+        print(template.format('TTLCache', *bench_ttl_cache()))
+    except ImportError:
+        print('Install cachetools to compare with TTLCache.')
@@ -0,0 +1,54 @@
+"""
+Measures the cost of encoding the snapshots of ``/info`` with 500
+live snapshots, encoding all of them every time versus joining the
+JSON cached by :class:`workbench_server.store.SnapshotStore`.
+
+Execute it with ``python -m workbench_server.tests.bench_info``.
+"""
+import json
+from timeit import timeit
+from uuid import uuid4
+
+from ereuse_utils import DeviceHubJSONEncoder
+from pydash import merge
+
+from workbench_server.store import SnapshotStore
+from workbench_server.tests.conftest import jsonf
+from workbench_server.views.snapshots import encode
+
+
+def bench(snapshots: int = 500, changed: int = 25, number: int = 50):
+    """
+    :param changed: Snapshots that change between /info requests.
+    :return: Milliseconds per /info encoding everything, with
+    the cache and nothing changed, and with the cache and
+    ``changed`` snapshots changed.
+    """
+    snapshot = {}
+    for phase in jsonf('phases'):
+        merge(snapshot, phase)
+    store = SnapshotStore(encode=encode)
+    uuids = [str(uuid4()) for _ in range(snapshots)]
+    for _uuid in uuids:
+        store.set(_uuid, dict(snapshot, _uuid=_uuid))
+
+    def full():
+        json.dumps(list(store.values()), cls=DeviceHubJSONEncoder).encode()
+
+    def cached():
+        b'[' + b','.join(store.encoded_values()) + b']'
+
+    def cached_with_changes():
+        for _uuid in uuids[:changed]:
+            store.transform(_uuid, lambda s: dict(s, _phases=s['_phases']))
+        cached()
+
+    cached()  # Fill the cache
+    return tuple(timeit(f, number=number) / number * 1000
+                 for f in (full, cached, cached_with_changes))
+
+
+if __name__ == '__main__':
+    print('Encoding everything: {:.2f} ms\n'
+          'Cached, no changes: {:.2f} ms\n'
+          'Cached, 25 changes: {:.2f} ms'.format(*bench()))
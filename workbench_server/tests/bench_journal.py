@@ -0,0 +1,41 @@
+"""
+Measures how many snapshots per second we can durably enqueue
+in the upload :class:`workbench_server.journal.Journal`.
+
+Execute it with ``python -m workbench_server.tests.bench_journal``.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time
+from uuid import uuid4
+
+from workbench_server.journal import Journal
+from workbench_server.tests.conftest import jsonf
+
+
+def bench(snapshots: int = 2000, threads: int = 16) -> float:
+    """
+    Enqueues and acknowledges ``snapshots`` from ``threads`` request
+    threads, returning the enqueues per second.
+    """
+    snapshot = jsonf('phases')[-1]
+    with TemporaryDirectory() as tmp:
+        journal = Journal(Path(tmp).joinpath('journal.jsonl'))
+        journal.replay()
+
+        def enqueue(_):
+            _uuid = str(uuid4())
+            journal.put(_uuid, dict(snapshot, _uuid=_uuid))
+            journal.ack(_uuid)
+
+        start = time()
+        with ThreadPoolExecutor(threads) as executor:
+            tuple(executor.map(enqueue, range(snapshots)))
+        journal.close()
+        return snapshots / (time() - start)
+
+
+if __name__ == '__main__':
+    for threads in 1, 4, 16, 64:
+        print('{:>3} threads: {:>7.0f} enqueues/s'.format(threads, bench(threads=threads)))
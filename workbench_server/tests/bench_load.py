@@ -0,0 +1,361 @@
+"""
+Load test of WorkbenchServer, like the scenario of
+``_test_concurrency``: Workbench clients go through the phases of
+their snapshots, reporting their pen-drives, while dashboards like
+DeviceHubClient poll ``/info``, against a local WorkbenchServer that
+uploads the snapshots to a stub of DeviceHub.
+
+It records the latency percentiles and the requests per second of
+every endpoint and writes them as JSON, so we can compare the
+results of a release with the ones of the previous one::
+
+    python -m workbench_server.tests.bench_load --output old.json
+    # ...change things...
+    python -m workbench_server.tests.bench_load --output new.json --compare old.json
+
+Which exits with 1 if an endpoint got slower. Runs with the same
+``--seed`` send the same requests. Execute it with ``--help`` to
+see the number of clients and the other options; it needs MongoDB.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from math import ceil
+from multiprocessing import Pool, Process
+from pathlib import Path
+from random import Random
+from socketserver import ThreadingMixIn
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import perf_counter, sleep, strftime, time
+from typing import Dict, List, Tuple
+from uuid import UUID, uuid4
+
+import requests
+
+from workbench_server.tests.conftest import jsonf
+
+DB = 'workbench_server_bench'
+
+
+class DeviceHubStub(ThreadingMixIn, HTTPServer):
+    """A DeviceHub that accepts every snapshot, counting them."""
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), _DeviceHubHandler)
+        self.uploads = 0
+        self.lock = Lock()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class _DeviceHubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'_id': str(uuid4())}).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.uploads += 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Recorder:
+    """The latencies of the requests of the clients, by endpoint."""
+
+    def __init__(self) -> None:
+        self.latencies = defaultdict(list)  # type: Dict[str, List[float]]
+        self.errors = Counter()
+        self.lock = Lock()
+
+    def request(self, session: requests.Session, endpoint: str, method: str, url: str,
+                expected=(200,), **kwargs) -> requests.Response:
+        """
+        Performs the request, recording it under ``endpoint``.
+
+        :return: The response, or ``None`` if its status was not
+        ``expected``.
+        """
+        start = perf_counter()
+        try:
+            r = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            r = None
+        latency = perf_counter() - start
+        with self.lock:
+            if r is not None and r.status_code in expected:
+                self.latencies[endpoint].append(latency)
+                return r
+            self.errors[endpoint] += 1
+
+
+def workbench(url: str, deadline: float, rng: Random, recorder: Recorder, think: float):
+    """
+    A Workbench client: snapshots computers one after the other,
+    PATCHing every phase and reporting the pen-drive it uses.
+    """
+    session = requests.Session()
+    phases, usb = jsonf('phases'), jsonf('usb')
+    while time() < deadline:
+        _uuid = str(UUID(int=rng.getrandbits(128), version=4))
+        usb_hid = '{}-{}'.format(usb['hid'], _uuid[:8])
+        usb_url = '{}/usbs/plugged/{}'.format(url, usb_hid)
+        snapshot_url = '{}/snapshots/{}'.format(url, _uuid)
+        for phase in phases:
+            recorder.request(session, 'PATCH /snapshots/<uuid>', 'PATCH', snapshot_url, (204,),
+                             json=dict(phase, _uuid=_uuid))
+            sleep(think * rng.random())
+            recorder.request(session, 'POST /usbs/plugged/<hid>', 'POST', usb_url, (204,),
+                             json=dict(usb, _uuid=_uuid, hid=usb_hid))
+            sleep(think * rng.random())
+            if time() >= deadline:
+                return
+        # The user links the computer in DeviceHubClient
+        recorder.request(session, 'PATCH /snapshots/<uuid>', 'PATCH', snapshot_url, (204,),
+                         json={'device': {'_id': _uuid}, '_linked': True})
+        recorder.request(session, 'DELETE /usbs/plugged/<hid>', 'DELETE', usb_url, (204,))
+
+
+def dashboard(url: str, deadline: float, rng: Random, recorder: Recorder, poll: float,
+              device_hub: str):
+    """
+    A DeviceHubClient: polls ``/info`` for what changed, after
+    passing the credentials of DeviceHub.
+    """
+    session = requests.Session()
+    r = recorder.request(session, 'GET /info', 'GET', url + '/info',
+                         params={'device-hub': device_hub, 'db': 'db'},
+                         headers={'Authorization': 'Basic Zm9vOg=='})
+    seq, etag = (r.json()['seq'], r.headers['ETag']) if r is not None else (None, None)
+    while time() < deadline:
+        sleep(poll * rng.random() * 2)
+        r = recorder.request(session, 'GET /info', 'GET', url + '/info', (200, 304),
+                             params={'since': seq} if seq is not None else None,
+                             headers={'If-None-Match': etag} if etag else None)
+        if r is not None and r.status_code == 200:
+            seq, etag = r.json()['seq'], r.headers['ETag']
+
+
+def clients(url: str, kinds: List[Tuple[str, int]], deadline: float, seed: int, think: float,
+            poll: float, device_hub: str) -> Tuple[dict, dict]:
+    """
+    Runs the clients, each one in a thread.
+
+    :param kinds: The kind of every client, ``workbench`` or
+    ``dashboard``, and its number, which seeds its random.
+    :return: The latencies and errors by endpoint.
+    """
+    recorder = Recorder()
+    threads = []
+    for kind, i in kinds:
+        rng = Random(seed * 1000003 + i)
+        if kind == 'workbench':
+            args = url, deadline, rng, recorder, think
+        else:
+            args = url, deadline, rng, recorder, poll, device_hub
+        threads.append(Thread(target=workbench if kind == 'workbench' else dashboard,
+                              args=args, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict(recorder.latencies), dict(recorder.errors)
+
+
+def serve(port: int, folder: str, server: str):
+    """Runs WorkbenchServer, with the ``flask`` or ``asgi`` server."""
+    from workbench_server.flaskapp import WorkbenchServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = WorkbenchServer(folder=Path(folder), settings={'MONGO_DB': DB})
+    app.info.local_ip = lambda: '127.0.0.1'
+    if server == 'asgi':
+        import uvicorn
+        from workbench_server.asgi import AsyncWorkbenchServer
+        uvicorn.run(AsyncWorkbenchServer(app), host='127.0.0.1', port=port, log_level='warning')
+    else:
+        app.run('127.0.0.1', port, threaded=True, use_reloader=False)
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(url: str = None, workbenches: int = 120, dashboards: int = 20, seconds: float = 30,
+        think: float = 1, poll: float = 1, processes: int = 4, seed: int = 0,
+        server: str = 'flask') -> dict:
+    """
+    Runs the load test.
+
+    :param url: The URL of a running WorkbenchServer, or ``None``
+    to start one with ``server``, in a new database.
+    :param think: Seconds Workbench waits between requests, at most.
+    :param poll: Seconds dashboards wait between requests, on average.
+    :param processes: Processes running the clients, so they are
+    not limited by the GIL.
+    :return: The results, see :func:`.summarize`.
+    """
+    config = dict(workbenches=workbenches, dashboards=dashboards, seconds=seconds, think=think,
+                  poll=poll, processes=processes, seed=seed, server=server if not url else url)
+    stub = DeviceHubStub()
+    Thread(target=stub.serve_forever, daemon=True).start()
+    with TemporaryDirectory() as folder:
+        process = None
+        if url is None:
+            port = free_port()
+            url = 'http://127.0.0.1:{}'.format(port)
+            # Not a daemon, as WorkbenchServer starts the process of the submitter
+            process = Process(target=serve, args=(port, folder, server))
+            process.start()
+            wait_for(url, process)
+        try:
+            kinds = [('workbench', i) for i in range(workbenches)] + \
+                    [('dashboard', workbenches + i) for i in range(dashboards)]
+            processes = max(1, min(processes, len(kinds)))
+            deadline = time() + seconds
+            args = [(url, kinds[i::processes], deadline, seed, think, poll, stub.url)
+                    for i in range(processes)]
+            start = time()
+            if processes == 1:
+                outcomes = [clients(*args[0])]
+            else:
+                with Pool(processes) as pool:
+                    outcomes = pool.starmap(clients, args)
+            elapsed = time() - start
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+                from pymongo import MongoClient
+                MongoClient().drop_database(DB)
+    stub.shutdown()
+    latencies, errors = defaultdict(list), Counter()
+    for outcome_latencies, outcome_errors in outcomes:
+        for endpoint, values in outcome_latencies.items():
+            latencies[endpoint].extend(values)
+        errors.update(outcome_errors)
+    results = summarize(latencies, errors, elapsed)
+    results.update(config=config, uploads=stub.uploads, date=strftime('%Y-%m-%dT%H:%M:%S'),
+                   python=platform.python_version())
+    return results
+
+
+def wait_for(url: str, process: Process, timeout: float = 30):
+    deadline = time() + timeout
+    while True:
+        try:
+            requests.get(url + '/info/stats').raise_for_status()
+            return
+        except requests.RequestException:
+            if not process.is_alive() or time() > deadline:
+                raise
+            sleep(0.2)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The nearest-rank percentile of the sorted ``values``."""
+    return values[max(0, ceil(p / 100 * len(values)) - 1)] if values else 0
+
+
+def summarize(latencies: Dict[str, List[float]], errors: Dict[str, int],
+              seconds: float) -> dict:
+    """
+    :return: For every endpoint, the ``requests`` that succeeded,
+    the ``errors``, the ``per_second`` requests and the ``p50``,
+    ``p95``, ``p99`` and ``max`` latencies in milliseconds.
+    """
+    endpoints = {}
+    for endpoint in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(endpoint, ()))
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'errors': errors.get(endpoint, 0),
+            'per_second': round(len(values) / seconds, 2),
+            'p50': round(percentile(values, 50) * 1000, 3),
+            'p95': round(percentile(values, 95) * 1000, 3),
+            'p99': round(percentile(values, 99) * 1000, 3),
+            'max': round((values[-1] if values else 0) * 1000, 3)
+        }
+    return {'seconds': round(seconds, 3), 'endpoints': endpoints}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Compares the results with the ones of a previous run.
+
+    :param tolerance: How much worse, as a fraction, an endpoint
+    can get before considering it a regression.
+    :return: The regressions.
+    """
+    regressions = []
+    for endpoint, new in results['endpoints'].items():
+        old = baseline['endpoints'].get(endpoint)
+        if old is None:
+            continue
+        for field in 'p50', 'p95', 'p99':
+            if new[field] > old[field] * (1 + tolerance):
+                regressions.append('{} {} went from {}ms to {}ms'
+                                   .format(endpoint, field, old[field], new[field]))
+        if new['per_second'] < old['per_second'] * (1 - tolerance):
+            regressions.append('{} went from {} to {} requests/s'
+                               .format(endpoint, old['per_second'], new['per_second']))
+        if new['errors'] > old['errors']:
+            regressions.append('{} went from {} to {} errors'
+                               .format(endpoint, old['errors'], new['errors']))
+    return regressions
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', help='A running WorkbenchServer instead of starting one.')
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--workbenches', type=int, default=120)
+    parser.add_argument('--dashboards', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--think', type=float, default=1,
+                        help='Seconds Workbench waits between requests, at most.')
+    parser.add_argument('--poll', type=float, default=1,
+                        help='Seconds dashboards wait between requests, on average.')
+    parser.add_argument('--processes', type=int, default=4, help='Processes of the clients.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='Write the results in this JSON file.')
+    parser.add_argument('--compare', type=Path, help='The JSON results of a previous run.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much worse an endpoint can get, as a fraction.')
+    args = parser.parse_args(args)
+    results = run(args.url, args.workbenches, args.dashboards, args.seconds, args.think,
+                  args.poll, args.processes, args.seed, args.server)
+    print('{:<28} {:>8} {:>6} {:>8} {:>9} {:>9} {:>9}'
+          .format('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, r in results['endpoints'].items():
+        print('{:<28} {requests:>8} {errors:>6} {per_second:>8.1f} {p50:>9.2f} {p95:>9.2f} '
+              '{p99:>9.2f}'.format(endpoint, **r))
+    print('{} snapshots uploaded to DeviceHub'.format(results['uploads']))
+    if args.output:
+        with args.output.open('w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with args.compare.open() as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
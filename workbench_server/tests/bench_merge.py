@@ -0,0 +1,52 @@
+"""
+Measures merging the phases of Workbench into a snapshot, as
+PATCH /snapshots/<uuid> does, with :func:`workbench_server.merge.merge`
+versus ``pydash.merge`` on a copy of the snapshot, which is what we
+did before.
+
+Execute it with ``python -m workbench_server.tests.bench_merge``.
+"""
+from copy import deepcopy
+from timeit import timeit
+
+from pydash import merge as pydash_merge
+
+from workbench_server.merge import merge
+from workbench_server.tests.conftest import jsonf
+
+
+def bench(number: int = 2000):
+    """
+    :return: Microseconds to merge every phase into the
+    snapshot of the previous ones, and to merge the last
+    phase again (a PATCH that does not change anything),
+    with pydash and with ours.
+    """
+    phases = jsonf('phases')
+    last = {}
+    for phase in phases:
+        last = pydash_merge(last, deepcopy(phase))
+
+    def with_pydash():
+        snapshot = {}
+        for phase in phases:
+            snapshot = pydash_merge(deepcopy(snapshot), phase)
+
+    def with_ours():
+        snapshot = {}
+        for phase in phases:
+            snapshot = merge(snapshot, phase)
+
+    def again_with_pydash():
+        pydash_merge(deepcopy(last), phases[-1])
+
+    def again_with_ours():
+        merge(last, phases[-1])
+
+    return tuple(timeit(f, number=number) / number * 1e6
+                 for f in (with_pydash, with_ours, again_with_pydash, again_with_ours))
+
+
+if __name__ == '__main__':
+    print('All the phases: pydash {:.0f} µs, ours {:.0f} µs\n'
+          'The last phase again: pydash {:.0f} µs, ours {:.0f} µs'.format(*bench()))
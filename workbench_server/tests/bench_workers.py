@@ -0,0 +1,78 @@
+"""
+Measures how the requests per second that WorkbenchServer serves
+grow with the number of processes sharing the state in Mongo (see
+:class:`workbench_server.replica.SharedReplica`).
+
+Clients PATCH snapshots and GET ``/info``, spreading the requests
+over the processes like a load balancer.
+
+Execute it with ``python -m workbench_server.tests.bench_workers``;
+it needs MongoDB.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from multiprocessing import Process
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from uuid import uuid4
+
+import requests
+from pymongo import MongoClient
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.tests.conftest import jsonf
+
+DB = 'workbench_server_bench'
+PORT = 8191
+
+
+def serve(folder: str, port: int):
+    app = WorkbenchServer(folder=Path(folder), settings={'MONGO_DB': DB,
+                                                         'SHARED_STATE': 'mongo'})
+    app.info.local_ip = lambda: 'X.X.X.X'
+    app.run('127.0.0.1', port, threaded=True, use_reloader=False)
+
+
+def bench(processes: int, clients: int = 32, seconds: float = 10) -> float:
+    """:return: Requests per second."""
+    MongoClient().drop_database(DB)
+    phase = jsonf('phases')[0]
+    with TemporaryDirectory() as tmp:
+        servers = [Process(target=serve, args=(tmp, PORT + i), daemon=True)
+                   for i in range(processes)]
+        for server in servers:
+            server.start()
+        sleep(3)  # Let them start
+        requests_done = count()
+        deadline = time() + seconds
+
+        def client(i: int):
+            session = requests.Session()
+            _uuid = str(uuid4())
+            n = 0
+            while time() < deadline:
+                url = 'http://127.0.0.1:{}'.format(PORT + (i + n) % processes)
+                if n % 2:
+                    session.get(url + '/info').raise_for_status()
+                else:
+                    data = dict(phase, _uuid=_uuid)
+                    session.patch('{}/snapshots/{}'.format(url, _uuid), json=data) \
+                        .raise_for_status()
+                next(requests_done)
+                n += 1
+
+        with ThreadPoolExecutor(clients) as executor:
+            tuple(executor.map(client, range(clients)))
+        total = next(requests_done)
+        for server in servers:
+            server.terminate()
+    return total / seconds
+
+
+if __name__ == '__main__':
+    base = None
+    for processes in 1, 2, 4, 8:
+        rate = bench(processes)
+        base = base or rate
+        print('{} processes: {:>7.0f} requests/s ({:.1f}x)'.format(processes, rate, rate / base))
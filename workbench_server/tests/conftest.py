@@ -12,9 +12,11 @@ from workbench_server.flaskapp import WorkbenchServer
 
 @pytest.fixture
 def app(tmpdir) -> WorkbenchServer:
-    app = WorkbenchServer(folder=Path(tmpdir.strpath))
+    app = WorkbenchServer(folder=Path(tmpdir.strpath),
+                          settings={'MONGO_DB': 'workbench_server_test'})
     app.testing = True
-    return app
+    yield app
+    app.mongo_client.drop_database('workbench_server_test')
 
 
 @pytest.fixture
@@ -0,0 +1,154 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from workbench_server.asgi import AsyncWorkbenchServer
+from workbench_server.flaskapp import WorkbenchServer
+
+
+def call(asgi: AsyncWorkbenchServer, method: str, path: str, data=None, query: str = '',
+         headers: dict = None) -> (int, dict, bytes):
+    """Performs a request to the ASGI app, returning the response."""
+    headers = dict(headers or {})
+    body = b''
+    if data is not None:
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        headers.setdefault('Content-Type', 'application/json')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.get_event_loop().run_until_complete(asgi(scope, receive, send))
+    start = sent[0]
+    response_headers = {k.decode(): v.decode() for k, v in start['headers']}
+    return start['status'], response_headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+
+@pytest.fixture
+def asgi(app: WorkbenchServer) -> AsyncWorkbenchServer:
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    yield AsyncWorkbenchServer(app)
+    asyncio.get_event_loop().close()
+
+
+@pytest.mark.usefixtures('mock_ip')
+def test_asgi(asgi: AsyncWorkbenchServer, fphases: (list, str), fusb: (dict, str)):
+    """Tests the routes served from the event loop and the Flask app."""
+    phases, uri = fphases
+    usb, usb_uri = fusb
+
+    status, headers, body = call(asgi, 'GET', '/info', headers={'Origin': 'https://foo.com'})
+    assert status == 200 and json.loads(body.decode())['snapshots'] == []
+    assert headers['access-control-allow-origin'] == '*'
+    etag = headers['etag']
+    assert call(asgi, 'GET', '/info', headers={'If-None-Match': etag})[0] == 304
+
+    assert call(asgi, 'PATCH', uri, phases[0])[0] == 204
+    assert call(asgi, 'POST', usb_uri, usb)[0] == 204
+    status, _, body = call(asgi, 'GET', '/info', headers={'If-None-Match': etag})
+    info = json.loads(body.decode())
+    assert len(info['snapshots']) == 1 and len(info['usbs']) == 1
+    # ASGI servers give the path already decoded
+    assert call(asgi, 'POST', '/usbs/plugged/50%25', usb)[0] == 204
+    assert '50%25' in asgi.app.usbs.client_plugged.snapshot()
+    status, _, body = call(asgi, 'GET', uri)
+    assert status == 200
+    assert json.loads(body.decode())['_uuid'] == uri.split('/')[-1]
+    assert call(asgi, 'GET', '/snapshots/6e1ad6c4-1fcb-4a4e-8c0b-32fd7e0b1a1a')[0] == 404
+    status, _, body = call(asgi, 'GET', '/info/stats')
+    assert status == 200 and json.loads(body.decode())['snapshots']['in_memory'] == 1
+
+    # Bad requests are errors like in Flask
+    status, _, _ = call(asgi, 'PATCH', '/snapshots/batch', ['not', 'an', 'object'])
+    assert status == 400
+    status, _, body = call(asgi, 'PATCH', '/snapshots/batch',
+                           {'usbs': [{'hid': 'foo', 'usb': None}]})
+    assert json.loads(body.decode())['usbs'] == [{'hid': 'foo', 'status': 204}]
+
+    assert call(asgi, 'POST', '/config', {'link': False})[0] == 204
+    status, headers, body = call(asgi, 'GET', '/config')
+    assert json.loads(body.decode()) == {'link': False}
+    assert call(asgi, 'GET', '/config', headers={'If-None-Match': headers['etag']})[0] == 304
+    assert not asgi.app.configuration.link
+
+    # Routes we do not serve go to Flask
+    status, _, body = call(asgi, 'GET', '/snapshots/archive')
+    assert status == 200 and '_items' in json.loads(body.decode())
+    status, headers, _ = call(asgi, 'OPTIONS', '/info',
+                              headers={'Origin': 'https://foo.com',
+                                       'Access-Control-Request-Method': 'GET'})
+    assert 'access-control-allow-origin' in headers
+
+
+def test_asgi_events(asgi: AsyncWorkbenchServer):
+    """Tests waiting for events in the event loop."""
+    loop = asyncio.get_event_loop()
+    events = asgi.app.events
+    events.publish('foo', {})
+    last_id = events.ids.value
+
+    async def publish_later():
+        await asyncio.sleep(0.1)
+        await loop.run_in_executor(None, events.publish, 'bar', {'a': 1})
+
+    # Long-polling waits without a thread
+    waiting = asyncio.ensure_future(events.wait_async(last_id, 5))
+    loop.run_until_complete(publish_later())
+    new, reset = loop.run_until_complete(waiting)
+    assert [e[1] for e in new] == ['bar'] and not reset
+    assert not events.waiters
+    # And times out
+    assert loop.run_until_complete(events.wait_async(events.ids.value, 0.05)) == ([], False)
+    assert not events.waiters
+
+    # The stream stops when the client disconnects
+    sent = []
+    disconnect = asyncio.Event()
+
+    async def receive():
+        if not sent:
+            return {'type': 'http.request', 'body': b''}
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        if b'event: bar' in message.get('body', b''):
+            disconnect.set()
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/events', 'query_string': b'',
+             'headers': [(b'last-event-id', str(events.ids.value).encode())]}
+    loop.run_until_complete(asyncio.wait_for(asyncio.gather(asgi(scope, receive, send),
+                                                            publish_later()), 5))
+    assert sent[0]['status'] == 200
+    assert b'event: bar' in b''.join(m.get('body', b'') for m in sent[1:])
+
+
+def test_asgi_patch_formats(asgi: AsyncWorkbenchServer, fphases: (list, str)):
+    """Tests PATCHing a snapshot with JSON Patch, If-Match and gzip."""
+    phases, uri = fphases
+    status, headers, _ = call(asgi, 'PATCH', uri, gzip.compress(json.dumps(phases[0]).encode()),
+                              headers={'Content-Encoding': 'gzip'})
+    assert status == 204 and headers['etag'] == '"1"'
+    operations = [{'op': 'replace', 'path': '/_phases', 'value': 2}]
+    json_patch = {'Content-Type': 'application/json-patch+json', 'If-Match': '"1"'}
+    status, headers, _ = call(asgi, 'PATCH', uri, operations, headers=json_patch)
+    assert status == 204 and headers['etag'] == '"2"'
+    assert call(asgi, 'PATCH', uri, operations, headers=json_patch)[0] == 409
+    status, headers, body = call(asgi, 'GET', uri, headers={'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers['etag'] == '"2"'
+    assert headers['content-encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(body).decode())['_uuid'] == uri.split('/')[-1]
@@ -0,0 +1,31 @@
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from workbench_server.codec import CODECS, get_codec, stdlib
+from workbench_server.tests.conftest import jsonf
+
+
+@pytest.mark.parametrize('name', [codec.name for codec in CODECS])
+def test_codec(name: str):
+    """Tests that codecs encode the same as the stdlib one."""
+    if name != 'stdlib':
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    _uuid = uuid4()
+    obj = {'_uuid': _uuid, 'date': datetime(2018, 1, 2, 3, 4, 5, 6), 'name': 'ñ/ü', 1: None}
+    expected = stdlib.loads(stdlib.dumps(obj))
+    assert codec.loads(codec.dumps(obj)) == expected
+    assert expected['_uuid'] == str(_uuid)
+    phases = jsonf('phases')
+    assert codec.dumps(phases, pretty=True) == stdlib.dumps(phases, pretty=True)
+    with pytest.raises(ValueError):
+        codec.loads(b'{"a": ')
+
+
+def test_get_codec():
+    assert get_codec('stdlib').name == 'stdlib'
+    assert get_codec().name in {codec.name for codec in CODECS}
+    with pytest.raises(ValueError):
+        get_codec('foo')
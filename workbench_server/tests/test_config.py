@@ -1,19 +1,61 @@
+import json
+import os
+from pathlib import Path
+from time import sleep, time
+
 from ereuse_utils.test import Client
 
+from workbench_server.flaskapp import WorkbenchServer
 from workbench_server.tests.conftest import jsonf
 
 
 def test_config(client: Client):
     """Tests getting and modifying the config."""
     # Let's get it without any change
-    config, _ = client.get('/config')
+    config, response = client.get('/config')
     assert config == {}
+    etag = response.headers['ETag']
+    client.get('/config', headers={'If-None-Match': etag}, status=304)
 
     # We upload new config with those values changed
     config_fixture = jsonf('config')
     client.post('/config', data=config_fixture, status=204)
 
     # We get the new config with the values changed
-    config, _ = client.get('/config')
+    config, response = client.get('/config', headers={'If-None-Match': etag})
     assert config == config_fixture
+    assert response.headers['ETag'] != etag
+
 
+def test_config_persists(tmpdir):
+    """
+    Tests that we load the config when starting, and
+    the changes that someone else does to the file.
+    """
+    folder = Path(tmpdir.strpath)
+    settings = {'MONGO_DB': 'workbench_server_test', 'CONFIG_RELOAD_INTERVAL': 0.01}
+    app = WorkbenchServer(folder=folder, settings=settings)
+    try:
+        app.configuration.set({'link': False})
+        assert app.configuration.version == 1
+        app.configuration.reload()
+        assert app.configuration.version == 1, 'We do not reload our own write'
+        app = WorkbenchServer(folder=folder, settings=settings)
+        assert app.configuration.get() == {'link': False}
+        assert not app.configuration.link
+        # Someone edits the file
+        file = folder.joinpath('.settings', 'config.json')
+        file.write_text(json.dumps({'link': True, 'smart': 'long'}))
+        os.utime(str(file), ns=(0, 0))  # Filesystems with coarse mtimes
+        deadline = time() + 5
+        while app.configuration.version < 2:
+            assert time() < deadline
+            sleep(0.01)
+        assert app.configuration.get() == {'link': True, 'smart': 'long'}
+        assert app.configuration.link
+        # A broken file does not break the config
+        file.write_text('{"link": ')
+        app.configuration.reload()
+        assert app.configuration.get() == {'link': True, 'smart': 'long'}
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+from workbench_server.files import SnapshotWriter, read_json_file
+
+
+def snapshot(_uuid: str, phase: int) -> dict:
+    device = {'manufacturer': 'foo', 'serialNumber': 'bar', 'model': 'baz'}
+    return {'_uuid': _uuid, '_phase': phase, 'device': device}
+
+
+def test_writer(tmpdir):
+    """Tests that the last of many writes of a snapshot is written."""
+    folder = Path(tmpdir.strpath)
+    writer = SnapshotWriter(maxsize=2)
+    for phase in range(10):
+        writer.write(snapshot('a', phase), folder)
+        writer.write(snapshot('b', phase), folder)
+    writer.flush()
+    files = sorted(folder.iterdir())
+    assert [f.name[-6:] for f in files] == ['a.json', 'b.json'], 'No temporary files left'
+    assert read_json_file(files[0])['_phase'] == 9
+
+
+def test_writer_compress(tmpdir):
+    folder = Path(tmpdir.strpath)
+    writer = SnapshotWriter(compress=True)
+    writer.write(snapshot('a', 1), folder)
+    writer.flush()
+    path, = folder.glob('* a.json*')
+    assert path.suffix == '.gz'
+    assert read_json_file(path) == snapshot('a', 1)
+
+
+def test_writer_bad_snapshot(tmpdir):
+    """Tests that a snapshot we cannot write does not stop the writer."""
+    folder = Path(tmpdir.strpath)
+    writer = SnapshotWriter(maxsize=1)
+    writer.write({'_uuid': 'bad'}, folder)  # No device to name the file after
+    writer.write(snapshot('a', 1), folder)
+    writer.flush()
+    path, = folder.iterdir()
+    assert read_json_file(path) == snapshot('a', 1)
@@ -1,9 +1,11 @@
 import json
 from time import sleep
+from unittest.mock import patch
 
 import pytest
 from ereuse_utils.test import Client
 from requests_mock import Mocker
+from werkzeug.exceptions import BadRequest, Conflict
 
 from workbench_server.flaskapp import WorkbenchServer
 
@@ -23,6 +25,7 @@ def test_full(client: Client, fphases: (list, str), fusb: (dict, str),
 
     # Emptiness, before performing anything
     response, _ = client.get('/info')
+    assert isinstance(response.pop('seq'), int)
     assert response == {
         "attempts": 0,
         "ip": "X.X.X.X",
@@ -106,3 +109,70 @@ def test_full_no_link(client: Client, fphases: (list, str),
         snapshot_file = json.load(f)
     assert '_id' not in snapshot_file['device'], 'There is no _id because we didn\'t link it'
     assert snapshot_file['device']['serialNumber'] == phases[0]['device']['serialNumber']
+
+
+def test_archive(client: Client, fphases: (list, str), app: WorkbenchServer):
+    """Tests searching the archive of finished snapshots."""
+    phases, uri = fphases
+    client.post('/config', data={'link': False}, status=204)
+    for phase in phases:
+        client.patch(uri, data=phase, status=204)
+    app.snapshots.archive.flush()
+    serial = phases[0]['device']['serialNumber']
+    result, _ = client.get('/snapshots/archive', query={'serial': serial, 'from': '2018-01'})
+    assert result['_meta'] == {'page': 1, 'max_results': 25, 'total': 1}
+    item = result['_items'][0]
+    assert item['_uuid'] == phases[0]['_uuid']
+    assert item['status'] == 'pending', 'We have no DeviceHub credentials to upload it'
+    assert 'segment' not in item
+    result, _ = client.get('/snapshots/archive', query={'to': '2017'})
+    assert result['_items'] == []
+    app.snapshots.archive.set_status('not-archived', 'uploaded', uploaded='id')
+    app.snapshots.archive.flush()
+    assert app.mongo_db.archive.find_one({'_id': 'not-archived'}) is None
+    # We can get it after it is removed from memory
+    app.snapshots.snapshots.remove(phases[0]['_uuid'])
+    app.snapshots.persistence.flush()
+    app.mongo_db.snapshots.delete_one({'_id': phases[0]['_uuid']})
+    snapshot, _ = client.get(uri)
+    assert snapshot['device']['serialNumber'] == serial
+
+
+@pytest.mark.usefixtures('mock_ip')
+def test_batch(client: Client, fphases: (list, str), fusb: (dict, str), app: WorkbenchServer):
+    """Tests updating snapshots and plugging USBs in one request."""
+    phases, _ = fphases
+    usb, _ = fusb
+    other_uuid = '0a2b8a9e-5fd8-4c8b-9c6b-6c6e4f4a8a35'
+    batch = {
+        'snapshots': [
+            {'_uuid': phases[0]['_uuid'], 'patch': phases[0]},
+            {'_uuid': phases[0]['_uuid'], 'patch': phases[1]},
+            {'_uuid': other_uuid, 'patch': {'_uuid': other_uuid, '_phases': 1}},
+            {'_uuid': 'not-an-uuid', 'patch': {}},
+            {'_uuid': 5, 'patch': {}},
+        ],
+        'usbs': [{'hid': usb['_id'], 'usb': usb}]
+    }
+    result, _ = client.patch('/snapshots/batch', data=batch)
+    assert [r['status'] for r in result['snapshots']] == [204, 204, 204, 400, 400]
+    assert result['usbs'] == [{'hid': usb['_id'], 'status': 204}]
+
+    info, _ = client.get('/info')
+    snapshots = {s['_uuid']: s for s in info['snapshots']}
+    assert snapshots[phases[0]['_uuid']]['_phases'] == 2
+    assert len(snapshots) == 2
+    assert info['usbs'][0]['_id'] == usb['_id']
+
+    # Unplug the USB
+    client.patch('/snapshots/batch', data={'usbs': [{'hid': usb['_id'], 'usb': None}]})
+    info, _ = client.get('/info')
+    assert info['usbs'] == []
+
+    # An item that fails like a single PATCH gets its status
+    with patch.object(app.snapshots, 'patch', side_effect=Conflict()):
+        result, _ = client.patch('/snapshots/batch',
+                                 data={'snapshots': [{'_uuid': other_uuid, 'patch': {}}]})
+    assert result['snapshots'] == [{'_uuid': other_uuid, 'status': 409}]
+    with pytest.raises(BadRequest):
+        app.snapshots.batch({'snapshots': {}})
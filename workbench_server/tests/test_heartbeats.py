@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from workbench_server.heartbeats import Heartbeats
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_heartbeats_expire():
+    """Tests that items expire ttl seconds after their last heartbeat."""
+    clock = Clock()
+    expired = []
+    heartbeats = Heartbeats(5, on_expire=lambda k, v: expired.append(k), clock=clock)
+    assert heartbeats.put('a', 1)
+    assert heartbeats.put('b', 1)
+    clock.now += 3
+    assert not heartbeats.put('a', 1), 'A heartbeat is not a change'
+    assert heartbeats.put('a', 2)
+    clock.now += 2
+    assert heartbeats.expire() == [('b', 1)]
+    assert expired == ['b']
+    assert 'b' not in heartbeats
+    clock.now += 2.9
+    assert heartbeats.expire() == []
+    clock.now += 0.1
+    assert heartbeats.expire() == [('a', 2)]
+    assert len(heartbeats) == 0 and heartbeats.buckets == {} and heartbeats.ticks == {}
+    # Popped items don't expire
+    heartbeats.put('c', 1)
+    assert heartbeats.pop('c') == 1
+    assert heartbeats.pop('c') is None
+    clock.now += 10
+    assert heartbeats.expire() == []
+    assert expired == ['b', 'a']
+
+
+def test_heartbeats_snapshot():
+    """Tests that readers get a consistent copy that only changes with the items."""
+    clock = Clock()
+    heartbeats = Heartbeats(5, clock=clock)
+    heartbeats.put('a', 1)
+    snapshot = heartbeats.snapshot()
+    assert dict(snapshot) == {'a': 1}
+    clock.now += 1
+    heartbeats.put('a', 1)
+    assert heartbeats.snapshot() is snapshot
+    heartbeats.put('b', 2)
+    assert dict(snapshot) == {'a': 1}
+    assert dict(heartbeats.snapshot()) == {'a': 1, 'b': 2}
+
+
+def test_heartbeats_concurrent():
+    """Tests many clients heartbeating while others read, beyond 100 items."""
+    heartbeats = Heartbeats(60)
+
+    def heartbeat(i):
+        heartbeats.put(i % 5000, {'hid': i % 5000})
+        if i % 100 == 0:
+            assert len(heartbeats.snapshot()) <= 5000
+            heartbeats.expire()
+
+    with ThreadPoolExecutor(16) as executor:
+        tuple(executor.map(heartbeat, range(20000)))
+    assert len(heartbeats.snapshot()) == 5000
+    assert sum(len(b) for b in heartbeats.buckets.values()) == 5000
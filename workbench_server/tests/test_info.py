@@ -0,0 +1,91 @@
+import pytest
+from ereuse_utils.test import Client
+
+from workbench_server.network import LocalAddress
+
+
+@pytest.mark.usefixtures('mock_ip')
+def test_info_etag_and_since(client: Client, fphases: (list, str), fusb: (dict, str)):
+    """
+    Tests getting only what changed from /info, through ETags and
+    the ``since`` sequence number.
+    """
+    phases, uri = fphases
+    usb, usb_uri = fusb
+
+    info, response = client.get('/info')
+    etag = response.headers['ETag']
+    # Nothing changed
+    client.get('/info', headers={'If-None-Match': etag}, status=304)
+    client.patch(uri, data=phases[0], status=204)
+    info2, response = client.get('/info', headers={'If-None-Match': etag})
+    assert response.headers['ETag'] != etag
+    assert len(info2['snapshots']) == 1
+
+    # Only the USB changed
+    client.post(usb_uri, data=usb, status=204)
+    delta, _ = client.get('/info', query={'since': info2['seq']})
+    assert delta['since'] == info2['seq']
+    assert delta['seq'] > info2['seq']
+    assert delta['snapshots'] == []
+    assert [u['_id'] for u in delta['usbs']] == [usb['_id']]
+    # Re-plugging the same USB is not a change
+    client.post(usb_uri, data=usb, status=204)
+    same, _ = client.get('/info', query={'since': delta['seq']})
+    assert same['seq'] == delta['seq']
+    assert same['usbs'] == []
+
+    # Unplugging leaves a tombstone
+    client.delete(usb_uri, data=usb, status=204)
+    delta2, _ = client.get('/info', query={'since': delta['seq']})
+    assert delta2['usbs'] == []
+    assert delta2['removed']['usbs'] == [usb['_id']]
+
+    # A sequence from an unknown time gets everything
+    full, _ = client.get('/info', query={'since': 0})
+    assert 'since' not in full
+    assert len(full['snapshots']) == 1
+
+
+def test_events_poll(client: Client, fphases: (list, str), fusb: (dict, str)):
+    """Tests getting the changes through long-polling /events."""
+    phases, uri = fphases
+    usb, usb_uri = fusb
+
+    events, _ = client.get('/events', query={'poll': ''})
+    assert events['events'] == []
+    assert not events['reset']
+    last_id = events['lastEventId']
+
+    client.patch(uri, data=phases[0], status=204)
+    client.post(usb_uri, data=usb, status=204)
+    client.post(usb_uri, data=usb, status=204)  # Still plugged, no event
+    events, _ = client.get('/events', query={'poll': '', 'last-event-id': last_id})
+    snapshot, plugged = events['events']
+    assert snapshot['event'] == 'snapshot'
+    assert snapshot['data']['_uuid'] == phases[0]['_uuid']
+    assert snapshot['data']['patch']['_phases'] == 1
+    assert plugged['event'] == 'usb-plugged'
+    assert plugged['data']['hid'] == usb['_id']
+    assert events['lastEventId'] == plugged['id']
+
+    # A subscriber with an id from before a restart needs to reset
+    events, _ = client.get('/events', query={'poll': '', 'last-event-id': 1})
+    assert events['reset']
+
+
+def test_local_address():
+    """Tests that we get the local IP once and then only when refreshing it."""
+    ips = iter(['1.1.1.1', '2.2.2.2'])
+    address = LocalAddress(lambda: next(ips), interval=60)
+    assert address.get() == '1.1.1.1'
+    assert address.get() == '1.1.1.1'
+    address.refresh()
+    assert address.get() == '2.2.2.2'
+
+    def no_network():
+        raise OSError()
+
+    address.get_ip = no_network
+    address.refresh()
+    assert address.get() is None
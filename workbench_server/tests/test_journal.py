@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from workbench_server.journal import Journal
+
+
+def test_journal_replay(tmpdir):
+    """Tests that only not acknowledged snapshots are replayed."""
+    path = Path(tmpdir.strpath).joinpath('journal.jsonl')
+    journal = Journal(path, compact_after=2)
+    assert journal.replay() == []
+    journal.put('a', {'_uuid': 'a'})
+    journal.put('b', {'_uuid': 'b'})
+    journal.put('a', {'_uuid': 'a', '_phases': 2})
+    journal.ack('b')
+    journal.ack('b')  # Acknowledging is idempotent
+    ticket = journal.put('c', {'_uuid': 'c'}, wait=False)
+    journal.wait(ticket)
+    assert journal.synced >= ticket
+    journal.close()
+
+    # Like if WorkbenchServer restarted
+    assert Journal(path).replay() == [{'_uuid': 'a', '_phases': 2}, {'_uuid': 'c'}]
+
+
+def test_journal_torn_write(tmpdir):
+    """Tests that a record half-written in a crash is ignored."""
+    path = Path(tmpdir.strpath).joinpath('journal.jsonl')
+    journal = Journal(path)
+    journal.replay()
+    journal.put('a', {'_uuid': 'a'})
+    journal.close()
+    with path.open('a') as f:
+        f.write('{"put": "b", "snaps')
+    assert Journal(path).replay() == [{'_uuid': 'a'}]
@@ -0,0 +1,34 @@
+from threading import Thread
+
+import pytest
+from werkzeug.serving import make_server
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.tests import bench_load
+
+
+@pytest.mark.usefixtures('mock_ip')
+def test_load(app: WorkbenchServer):
+    """Tests a short load test and comparing its results."""
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    try:
+        results = bench_load.run(url, workbenches=2, dashboards=2, seconds=1, think=0,
+                                 poll=0.05, processes=1)
+    finally:
+        server.shutdown()
+    endpoints = results['endpoints']
+    assert set(endpoints) == {'PATCH /snapshots/<uuid>', 'POST /usbs/plugged/<hid>',
+                              'DELETE /usbs/plugged/<hid>', 'GET /info'}
+    for endpoint in endpoints.values():
+        assert endpoint['errors'] == 0
+        assert endpoint['requests'] > 0
+        assert 0 < endpoint['p50'] <= endpoint['p95'] <= endpoint['p99'] <= endpoint['max']
+    assert bench_load.compare(results, results) == []
+
+    slower = {'endpoints': {e: dict(r, p95=r['p95'] * 2, per_second=r['per_second'] / 2)
+                            for e, r in endpoints.items()}}
+    regressions = bench_load.compare(slower, results)
+    assert len(regressions) == 2 * len(endpoints)
+    assert bench_load.compare(results, slower) == []
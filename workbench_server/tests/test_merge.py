@@ -0,0 +1,60 @@
+from copy import deepcopy
+
+from pydash import merge as pydash_merge
+
+from workbench_server.merge import merge
+from workbench_server.tests.conftest import jsonf
+
+
+def test_merge_like_pydash():
+    """Tests that merging the phases gets what pydash gets."""
+    phases = jsonf('phases')
+    snapshot = expected = {}
+    for phase in phases:
+        before = deepcopy(snapshot)
+        snapshot = merge(snapshot, phase)
+        expected = pydash_merge(expected, deepcopy(phase))
+        assert snapshot == expected
+        assert before == deepcopy(before), 'We did not modify the previous snapshot'
+    # Merging the same again changes nothing
+    assert merge(snapshot, deepcopy(phases[-1])) is snapshot
+
+
+def test_merge_shares():
+    """Tests sharing what did not change."""
+    snapshot = {
+        'device': {'serialNumber': 'foo'},
+        'components': [{'@type': 'HardDrive', 'serialNumber': 'a', 'size': 1},
+                       {'@type': 'RamModule', 'serialNumber': 'b'}],
+        'tests': [{'@type': 'StressTest'}]
+    }
+    new = merge(snapshot, {'components': [{'@type': 'RamModule', 'serialNumber': 'b'},
+                                          {'@type': 'HardDrive', 'serialNumber': 'a', 'size': 2}],
+                           '_phases': 1})
+    assert new['components'][0]['size'] == 2
+    assert snapshot['components'][0]['size'] == 1
+    assert new['device'] is snapshot['device']
+    assert new['tests'] is snapshot['tests']
+    assert new['components'][1] is snapshot['components'][1]
+
+
+def test_merge_components():
+    """Tests merging components by @type and serialNumber, or @type and position."""
+    snapshot = {'components': [{'@type': 'SoundCard', 'model': 'x'},
+                               {'@type': 'GraphicCard', 'model': 'y'},
+                               {'@type': 'SoundCard', 'model': 'z'}]}
+    new = merge(snapshot, {'components': [
+        {'@type': 'GraphicCard', 'memory': 256},
+        {'@type': 'SoundCard', 'vendor': 'v'},
+        {'@type': 'SoundCard', 'vendor': 'w'},
+        {'@type': 'NetworkAdapter', 'serialNumber': 'mac'}
+    ]})
+    assert new['components'] == [
+        {'@type': 'SoundCard', 'model': 'x', 'vendor': 'v'},
+        {'@type': 'GraphicCard', 'model': 'y', 'memory': 256},
+        {'@type': 'SoundCard', 'model': 'z', 'vendor': 'w'},
+        {'@type': 'NetworkAdapter', 'serialNumber': 'mac'}
+    ]
+    # Values of other types replace the previous ones, like in pydash
+    new = merge({'a': {'b': 1}, 'c': 1, 'd': [1, 2]}, {'a': 5, 'c': True, 'd': [3]})
+    assert new == {'a': 5, 'c': True, 'd': [3, 2]}
@@ -0,0 +1,74 @@
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from werkzeug.test import Client
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.metrics import NULL, Metrics
+
+
+def test_metrics_render():
+    """Tests the text format of Prometheus."""
+    metrics = Metrics()
+    counter = metrics.counter('things', 'Things.', ('kind',))
+    counter.inc('a "quoted" one')
+    counter.inc('a "quoted" one', amount=2)
+    histogram = metrics.histogram('time_seconds', 'Time.', buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    metrics.callback('answer', 'The answer.', 'gauge', lambda: 42)
+    assert metrics.render().decode().splitlines() == [
+        '# HELP workbench_things Things.',
+        '# TYPE workbench_things counter',
+        'workbench_things_total{kind="a \\"quoted\\" one"} 3',
+        '# HELP workbench_time_seconds Time.',
+        '# TYPE workbench_time_seconds histogram',
+        'workbench_time_seconds_bucket{le="0.1"} 1',
+        'workbench_time_seconds_bucket{le="1"} 2',
+        'workbench_time_seconds_bucket{le="+Inf"} 3',
+        'workbench_time_seconds_sum 5.55',
+        'workbench_time_seconds_count 3',
+        '# HELP workbench_answer The answer.',
+        '# TYPE workbench_answer gauge',
+        'workbench_answer 42'
+    ]
+    # Disabled metrics do nothing
+    disabled = Metrics(enabled=False)
+    assert disabled.histogram('time_seconds', 'Time.') is NULL
+    with disabled.histogram('time_seconds', 'Time.').time():
+        pass
+    assert disabled.render() == b'\n'
+
+
+def test_metrics(tmpdir, fphases: (list, str)):
+    """Tests measuring the requests and the state of WorkbenchServer."""
+    phases, uri = fphases
+    app = WorkbenchServer(folder=Path(tmpdir.strpath),
+                          settings={'MONGO_DB': 'workbench_server_test', 'METRICS': True})
+    try:
+        app.testing = True
+        app.info.local_ip = MagicMock(return_value='X.X.X.X')
+        client = app.test_client()
+        client.patch(uri, data=phases[0], status=204)
+        client.get('/info')
+        client.get('/info')
+        r = Client(app, app.response_class).get('/metrics')
+        assert r.status_code == 200
+        assert r.mimetype == 'text/plain'
+        metrics = dict(line.rsplit(' ', 1) for line in r.get_data(as_text=True).splitlines()
+                       if not line.startswith('#'))
+        # Labels come in any order
+        requests = {k: v for k, v in metrics.items()
+                    if k.startswith('workbench_request_duration_seconds_count')}
+        assert [v for k, v in requests.items()
+                if 'route="/info"' in k and 'status="200"' in k] == ['2']
+        assert any('route="/snapshots/<uuid:_uuid>"' in k for k in requests)
+        assert metrics['workbench_snapshots'] == '1'
+        assert int(metrics['workbench_snapshots_memory_bytes']) > 0
+        assert int(metrics['workbench_json_encode_seconds_count']) >= 2
+        assert 'workbench_submitter_queue{queue="sender"}' in metrics
+        assert metrics['workbench_uploads_total{outcome="uploaded"}'] == '0'
+        assert metrics['workbench_upload_duration_seconds_count'] == '0'
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
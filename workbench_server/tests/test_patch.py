@@ -0,0 +1,103 @@
+import gzip
+import json
+
+import pytest
+from werkzeug.test import Client
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.patch import PatchConflict, PatchError, json_patch, merge_patch
+
+
+def test_merge_patch():
+    """Tests the examples of RFC 7396 and sharing what did not change."""
+    document = {'a': 'b', 'c': {'d': 'e', 'f': 'g'}, 'h': {'i': 'j'}}
+    patched = merge_patch(document, {'a': 'z', 'c': {'f': None}})
+    assert patched == {'a': 'z', 'c': {'d': 'e'}, 'h': {'i': 'j'}}
+    assert document['c'] == {'d': 'e', 'f': 'g'}
+    assert patched['h'] is document['h']
+    assert merge_patch({'a': ['b']}, {'a': 'c'}) == {'a': 'c'}
+    assert merge_patch({'a': [{'b': 'c'}]}, {'a': [1]}) == {'a': [1]}
+    assert merge_patch({'e': None}, {'a': 1}) == {'e': None, 'a': 1}
+    assert merge_patch({}, {'a': {'bb': {'ccc': None}}}) == {'a': {'bb': {}}}
+    assert merge_patch(document, {}) is document
+
+
+def test_json_patch():
+    """Tests the operations of JSON Patch (RFC 6902)."""
+    document = {'foo': ['bar', 'baz'], 'qux': {'a/b': 1}, 'other': {'x': 1}}
+    patched = json_patch(document, [
+        {'op': 'add', 'path': '/foo/1', 'value': 'qux'},
+        {'op': 'add', 'path': '/foo/-', 'value': 'end'},
+        {'op': 'remove', 'path': '/qux/a~1b'},
+        {'op': 'replace', 'path': '/foo/0', 'value': 'BAR'},
+        {'op': 'copy', 'from': '/foo/0', 'path': '/copied'},
+        {'op': 'move', 'from': '/copied', 'path': '/qux/moved'},
+        {'op': 'test', 'path': '/qux/moved', 'value': 'BAR'}
+    ])
+    assert patched == {'foo': ['BAR', 'qux', 'baz', 'end'], 'qux': {'moved': 'BAR'},
+                       'other': {'x': 1}}
+    assert document == {'foo': ['bar', 'baz'], 'qux': {'a/b': 1}, 'other': {'x': 1}}
+    assert patched['other'] is document['other']
+    assert json_patch(document, [{'op': 'replace', 'path': '', 'value': {'a': 1}}]) == {'a': 1}
+    for operations in ([{'op': 'test', 'path': '/foo/0', 'value': 'nope'}],
+                       [{'op': 'remove', 'path': '/nope'}],
+                       [{'op': 'add', 'path': '/foo/5', 'value': 1}],
+                       [{'op': 'replace', 'path': '/foo/01', 'value': 1}],
+                       [{'op': 'move', 'from': '/qux', 'path': '/qux/a'}],
+                       [{'op': 'remove', 'path': ''}]):
+        with pytest.raises(PatchConflict):
+            json_patch(document, operations)
+    for operations in ({'op': 'add'}, [{'op': 'nope', 'path': '/a'}],
+                       [{'op': 'add', 'path': 'a', 'value': 1}], [{'op': 'add', 'path': '/a'}]):
+        with pytest.raises(PatchError):
+            json_patch(document, operations)
+
+
+def test_patch_snapshot(app: WorkbenchServer, fphases: (list, str)):
+    """Tests PATCHing a snapshot with the formats, versions and gzip."""
+    phases, uri = fphases
+    app.info.local_ip = lambda: 'X.X.X.X'
+    client = Client(app, app.response_class)
+
+    def patch(body, content_type='application/json', **headers):
+        data = json.dumps(body).encode()
+        if headers.pop('gzip', False):
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        return client.patch(uri, data=data, content_type=content_type, headers=headers)
+
+    r = patch(phases[0], gzip=True)
+    assert r.status_code == 204 and r.headers['ETag'] == '"1"'
+    # Workbench sends only what the phase produced
+    r = patch({'_phases': 2, 'tests': [{'@type': 'StressTest'}]},
+              'application/merge-patch+json', **{'If-Match': '"1"'})
+    assert r.status_code == 204 and r.headers['ETag'] == '"2"'
+    r = patch({'_phases': 3}, 'application/merge-patch+json', **{'If-Match': '"1"'})
+    assert r.status_code == 409
+    operations = [{'op': 'remove', 'path': '/tests'},
+                  {'op': 'replace', 'path': '/_phases', 'value': 3}]
+    r = patch(operations, 'application/json-patch+json', **{'If-Match': '"2"'})
+    assert r.status_code == 204 and r.headers['ETag'] == '"3"'
+    r = patch([{'op': 'remove', 'path': '/tests'}], 'application/json-patch+json')
+    assert r.status_code == 409, 'There are no tests to remove'
+    assert patch([{'op': 'remove'}], 'application/json-patch+json').status_code == 400
+    r = patch([{'op': 'replace', 'path': '', 'value': [1]}], 'application/json-patch+json')
+    assert r.status_code == 409, 'Snapshots are objects'
+    assert patch({}, 'text/plain').status_code == 415
+    assert client.patch(uri, data=b'not gzip', content_type='application/json',
+                        headers={'Content-Encoding': 'gzip'}).status_code == 400
+
+    snapshot = app.snapshots.snapshots[uri.split('/')[-1]]
+    assert snapshot['_phases'] == 3 and 'tests' not in snapshot
+    assert snapshot['_version'] == 3
+    r = client.get(uri, headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['ETag'] == '"3"' and r.headers['Content-Encoding'] == 'gzip'
+    public = json.loads(gzip.decompress(r.get_data()).decode())
+    assert '_version' not in public and '_phases' not in public
+    r = client.get(uri)
+    assert 'Content-Encoding' not in r.headers
+    assert json.loads(r.get_data(as_text=True)) == public
+    r = patch([{'op': 'replace', 'path': '', 'value': dict(public, _phases=1)}],
+              'application/json-patch+json')
+    assert r.status_code == 204 and r.headers['ETag'] == '"4"'
+    assert app.snapshots.snapshots[uri.split('/')[-1]]['_phases'] == 1
@@ -0,0 +1,77 @@
+from pathlib import Path
+from time import sleep, time
+
+from werkzeug.test import Client
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.profiling import Profiler
+
+
+def busy(seconds: float):
+    deadline = time() + seconds
+    while time() < deadline:
+        pass
+
+
+def test_profiler():
+    """Tests sampling the stacks of the current thread."""
+    profiler = Profiler(interval=0.001)
+    assert not profiler.wants('/info')
+    profiler.start('GET /foo')
+    busy(0.1)
+    profiler.stop()
+    busy(0.05)  # Not profiled
+    stacks = profiler.collapsed().splitlines()
+    assert stacks
+    for line in stacks:
+        stack, count = line.rsplit(' ', 1)
+        frames = stack.split(';')
+        assert frames[0] == 'GET /foo'
+        assert frames[1].startswith('busy (test_profiling.py:')
+        assert int(count) > 0
+    assert profiler.requests == 1
+    profiler.reset()
+    assert profiler.collapsed() == ''
+
+
+def test_profiler_max_depth():
+    """Tests that we keep the frames near the request of deep stacks."""
+    profiler = Profiler(interval=0.001)
+    profiler.MAX_DEPTH = 3
+
+    def recurse(n: int):
+        return busy(0.1) if n == 0 else recurse(n - 1)
+
+    profiler.start('GET /foo')
+    recurse(5)
+    profiler.stop()
+    stacks = profiler.collapsed().splitlines()
+    assert stacks
+    for line in stacks:
+        frames = line.rsplit(' ', 1)[0].split(';')
+        assert len(frames) == 5
+        assert all(frame.startswith('recurse (test_profiling.py:') for frame in frames[1:4])
+        assert frames[4] == '(deeper)', 'Not busy, which is the deepest'
+
+
+def test_profile_route(tmpdir):
+    """Tests profiling the requests to a route."""
+    app = WorkbenchServer(folder=Path(tmpdir.strpath),
+                          settings={'MONGO_DB': 'workbench_server_test',
+                                    'PROFILE_ROUTE': '/info', 'PROFILE_INTERVAL': 0.001})
+    try:
+        app.info.local_ip = lambda: sleep(0.05) or 'X.X.X.X'
+        client = Client(app, app.response_class)
+        client.get('/info')
+        client.get('/config')
+        r = client.get('/profile')
+        assert r.headers['X-Profiled-Requests'] == '1'
+        stacks = r.get_data(as_text=True)
+        assert stacks
+        assert all(line.startswith('GET /info;') for line in stacks.splitlines())
+        assert 'view_info (info.py:' in stacks
+        assert '<lambda> (test_profiling.py:' in stacks
+        assert client.delete('/profile').status_code == 204
+        assert client.get('/profile').get_data() == b''
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
@@ -0,0 +1,31 @@
+from pathlib import Path
+from time import sleep
+
+from workbench_server.files import to_json_file
+from workbench_server.reupload import Reupload
+
+
+def test_reupload(tmpdir):
+    """Tests uploading again failed snapshots, one failing again."""
+    folder = Path(tmpdir.strpath)
+    device = {'manufacturer': 'foo', 'serialNumber': 'bar', 'model': 'baz'}
+    for _uuid in 'a', 'b', 'c':
+        to_json_file({'_uuid': _uuid, 'device': device}, folder)
+    reupload = None
+
+    def submit(snapshot: dict):
+        if snapshot['_uuid'] == 'b':
+            to_json_file(snapshot, folder)  # As the submitter does
+            reupload.outcome('b', {'_attempts': 0, '_error': 'Bad', '_saved': True})
+        else:
+            reupload.outcome(snapshot['_uuid'], {'_attempts': 1})  # Connection error
+            reupload.outcome(snapshot['_uuid'], {'_uploaded': 'id', '_saved': True})
+
+    reupload = Reupload(folder, submit, concurrency=1)
+    sleep(0.5)
+    progress = reupload.progress()
+    assert not progress['running']
+    assert progress['submitted'] == 3
+    assert progress['uploaded'] == 2 and progress['failed'] == 1
+    assert [f.name[-6:] for f in folder.iterdir()] == ['b.json']
+    assert not reupload.outcome('d', {'_saved': True}), 'Not one of ours'
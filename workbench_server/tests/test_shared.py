@@ -0,0 +1,121 @@
+from pathlib import Path
+from time import sleep
+from unittest.mock import MagicMock
+
+from pymongo import MongoClient
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.shared import MemoryState, MongoState
+
+
+def test_shared_state(tmpdir, fphases: (list, str), fusb: (dict, str)):
+    """Tests two processes of WorkbenchServer sharing the state."""
+    phases, uri = fphases
+    usb, usb_uri = fusb
+    state = MemoryState()
+    settings = {'MONGO_DB': 'workbench_server_test', 'SHARED_STATE': state,
+                'SHARED_STATE_POLL': 0.01}
+    apps = [WorkbenchServer(folder=Path(tmpdir.strpath), settings=settings) for _ in range(2)]
+    try:
+        for app in apps:
+            app.testing = True
+            app.info.local_ip = MagicMock(return_value='X.X.X.X')
+        client1, client2 = (app.test_client() for app in apps)
+        sleep(0.2)
+        assert [app.replica.leader for app in apps].count(True) == 1, 'One uploads snapshots'
+        assert [app.snapshots.submitter is not None for app in apps].count(True) == 1
+
+        client1.patch(uri, data=phases[0], status=204)
+        client2.post(usb_uri, data=usb, status=204)
+        # Each process applied its own change and...
+        assert len(client1.get('/info')[0]['snapshots']) == 1
+        assert len(client2.get('/info')[0]['usbs']) == 1
+        # ...the changes of the other one
+        for app in apps:
+            app.replica.catch_up()
+        info1, _ = client1.get('/info')
+        info2, _ = client2.get('/info')
+        assert info1['snapshots'] == info2['snapshots']
+        assert info1['usbs'] == info2['usbs'] and len(info2['usbs']) == 1
+        # Sequence numbers of one process mean nothing to the other
+        assert info1['seq'] != info2['seq']
+        other, _ = client2.get('/info', query={'since': info1['seq']})
+        assert 'since' not in other, 'We got everything again'
+        # And so do the ids of the events
+        events = apps[1].events
+        assert len(events.buffer) >= 2
+        first_id = events.buffer[0][0]
+        new, reset = events.wait(first_id, 0)
+        assert [e[0] for e in new] == [e[0] for e in list(events.buffer)[1:]] and not reset
+        assert events.wait(events.ids.value - 1, 0) == ([], True)
+
+        # Naming a pen-drive in one process names it in all of them,
+        # without Mongo change streams
+        apps[0].mongo_db.named_usbs.insert_one(dict(usb, name='foo'))
+        client1.post('/usbs/named', data={'_id': usb['_id'], 'name': 'bar'}, status=204)
+        apps[1].replica.catch_up()
+        delta, _ = client2.get('/info', query={'since': info2['seq']})
+        assert [u['name'] for u in delta['names']] == ['bar']
+        assert [u['name'] for u in delta['usbs']] == ['bar']
+    finally:
+        apps[0].mongo_client.drop_database('workbench_server_test')
+
+
+def test_shared_state_restart(tmpdir, fphases: (list, str)):
+    """
+    Tests that a process that starts does not apply again the
+    changes that the snapshots it loads from Mongo have.
+    """
+    phases, uri = fphases
+    state = MemoryState()
+    settings = {'MONGO_DB': 'workbench_server_test', 'SHARED_STATE': state,
+                'SHARED_STATE_POLL': 0.01}
+    app = WorkbenchServer(folder=Path(tmpdir.strpath), settings=settings)
+    try:
+        app.testing = True
+        sleep(0.2)
+        assert app.replica.leader
+        app.test_client().patch(uri, data=phases[0], status=204)
+        app.snapshots.persistence.flush()
+        _uuid = phases[0]['_uuid']
+        saved = app.mongo_db.snapshots.find_one({'_id': _uuid})
+        assert saved['_version'] == 1 and saved['_applied'] == 1
+
+        # Like a process that starts: it loads the snapshot from Mongo
+        # and applies the log from the beginning
+        app.snapshots.positions[_uuid] = saved['_applied']
+        app.replica.applied = 0
+        app.replica.catch_up()
+        assert app.snapshots.snapshots[_uuid]['_version'] == 1, 'We did not patch it twice'
+        app.test_client().patch(uri, data=phases[1], status=204)
+        assert app.snapshots.snapshots[_uuid]['_version'] == 2, 'We apply the new changes'
+        assert app.snapshots.positions == {}
+
+        other = WorkbenchServer(folder=Path(tmpdir.strpath), settings=settings)
+        assert not other.replica.leader
+        assert other.snapshots.persistence.dirty == {}, 'Only the leader saves the snapshots'
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
+
+
+def test_mongo_state_gap():
+    """
+    Tests that MongoState fills the numbers that processes took
+    but never inserted, instead of skipping them.
+    """
+    db = MongoClient()['workbench_server_test']
+    try:
+        state = MongoState(db)
+        assert state.append({'n': 1}) == 1
+        state.next('log')  # A process took number 2 and died
+        assert state.append({'n': 3}) == 3
+        assert state.read(1) == [], 'We wait for 2'
+        state.GAP_TIMEOUT = 0
+        assert state.read(1) == [], 'We fill 2'
+        assert state.read(1) == [(3, {'n': 3})], 'Skipping the 2 we filled'
+        # A process that gets a number we filled inserts its entry with another one
+        db.state_counters.update_one({'_id': 'log'}, {'$set': {'value': 1}})
+        assert state.append({'n': 4}) == 4
+        assert state.read(3) == [(4, {'n': 4})]
+    finally:
+        db.client.drop_database('workbench_server_test')
@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from time import sleep
+
+from workbench_server.store import Retention, SnapshotStore
+
+
+def test_store_concurrent_updates():
+    """Tests that concurrent updates of the same snapshots are not lost."""
+    store = SnapshotStore(stripes=4)
+
+    def increment(i):
+        store.transform(str(i % 10), lambda s: dict(s, n=s.get('n', 0) + 1))
+        store.values()
+
+    with ThreadPoolExecutor(16) as executor:
+        tuple(executor.map(increment, range(5000)))
+    assert sum(s['n'] for s in store.values()) == 5000
+    assert len(store) == 10
+
+
+def test_store_copy_on_write():
+    """Tests that readers keep the snapshot they got."""
+    store = SnapshotStore()
+    store.set('a', {'components': [{'@type': 'HardDrive'}]})
+    listing = store.values()
+    assert store.values() is listing, 'Listing is cached until a write'
+    before = store['a']
+    store.transform('a', lambda s: dict(s, components=s['components'] + [{'@type': 'Ram'}]))
+    assert len(before['components']) == 1
+    assert len(store['a']['components']) == 2
+    assert store.values() is not listing
+    assert store.remove('a') is not None
+    assert 'a' not in store and store.values() == ()
+
+
+def test_retention():
+    """Tests evicting finished snapshots by count (LRU) and by age."""
+    retention = Retention(ttl=0.1, maximum=2)
+    for _uuid in 'a', 'b', 'c':
+        retention.finish(_uuid)
+    retention.touch('a')
+    assert retention.expired() == ['b']
+    retention.forget('c')  # PATCHed again
+    assert retention.expired() == []
+    sleep(0.15)
+    assert retention.expired() == ['a']
+    assert len(retention) == 0
+
+
+def test_store_encoded():
+    """Tests that the JSON of a snapshot is cached until it changes."""
+    encodings = []
+
+    def encode(snapshot, public):
+        encodings.append(snapshot)
+        return repr(sorted(snapshot.items())).encode()
+
+    store = SnapshotStore(encode=encode)
+    store.set('a', {'n': 1})
+    store.set('b', {'n': 1})
+    assert store.encoded_values() == store.encoded_values()
+    assert len(encodings) == 2
+    store.transform('a', lambda s: dict(s, n=2))
+    assert store.encoded_values({'a'}) == [b"[('n', 2)]"]
+    assert len(encodings) == 3
+    store.remove('a')
+    assert len(store.encoded_values()) == 1
@@ -0,0 +1,93 @@
+from pathlib import Path
+from time import sleep, time
+
+import pytest
+from ereuse_utils.test import Client
+from werkzeug.exceptions import BadRequest
+
+from workbench_server.flaskapp import WorkbenchServer
+from workbench_server.host_usbs import FakeUSBSource
+
+
+def test_rename_usb(client: Client, fusb: (dict, str), app: WorkbenchServer):
+    """
+    Tests renaming an already named pen-drive, which shows
+    the new name in plugged-in USBs without querying Mongo.
+    """
+    usb, usb_uri = fusb
+    app.mongo_db.named_usbs.insert_one(dict(usb, name='foo'))
+    client.post(usb_uri, data=usb, status=204)
+    info, _ = client.get('/info')
+    assert info['usbs'][0]['name'] == 'foo'
+
+    client.post('/usbs/named', data={'_id': usb['_id'], 'name': 'bar'}, status=204)
+    delta, _ = client.get('/info', query={'since': info['seq']})
+    assert [u['name'] for u in delta['names']] == ['bar']
+    assert [u['name'] for u in delta['usbs']] == ['bar']
+    # Naming again with the same name is fine
+    client.post('/usbs/named', data={'_id': usb['_id'], 'name': 'bar'}, status=204)
+    assert app.mongo_db.named_usbs.count() == 1
+    # Clients keep sending the USB without the name; this is not a change
+    client.post(usb_uri, data=usb, status=204)
+    same, _ = client.get('/info', query={'since': delta['seq']})
+    assert same['usbs'] == []
+
+
+def test_host_usbs(tmpdir, fusb: (dict, str)):
+    """
+    Tests serving the pen-drives plugged in the machine from memory,
+    enumerating them again only when one is plugged or unplugged.
+    """
+    usb, _ = fusb
+    source = FakeUSBSource()
+    app = WorkbenchServer(folder=Path(tmpdir.strpath),
+                          settings={'MONGO_DB': 'workbench_server_test',
+                                    'HOST_USBS_SOURCE': source})
+    try:
+        client = app.test_client()
+        usbs, _ = client.get('/usbs')
+        assert usbs['plugged'] == []
+        assert source.enumerations == 1
+        source.plug(usb)
+        wait(lambda: app.usbs.host.usbs)
+        for _ in range(3):
+            usbs, _ = client.get('/usbs')
+            assert usbs['plugged'] == [usb]
+        assert source.enumerations == 2
+        client.post('/usbs/named', data={'_id': usb['_id'], 'name': 'foo'}, status=204)
+        assert 'name' not in app.usbs.host.usbs[0]
+        usbs, _ = client.get('/usbs')
+        assert [u['name'] for u in usbs['named']] == ['foo']
+        source.unplug(usb['_id'])
+        wait(lambda: not app.usbs.host.usbs)
+        stats = app.usbs.host.stats()
+        assert stats['watching']
+        assert stats['enumerations'] == 3
+        assert stats['enumerationSeconds'] >= 0
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
+
+
+def test_host_usbs_name_before_enumeration(tmpdir, fusb: (dict, str)):
+    """Tests naming a pen-drive plugged before we enumerate it."""
+    usb, _ = fusb
+    source = FakeUSBSource()
+    app = WorkbenchServer(folder=Path(tmpdir.strpath),
+                          settings={'MONGO_DB': 'workbench_server_test',
+                                    'HOST_USBS_SOURCE': source})
+    try:
+        app.usbs.host.get()
+        source.usbs[usb['_id']] = usb  # Plugged without a hotplug event
+        client = app.test_client()
+        client.post('/usbs/named', data={'_id': usb['_id'], 'name': 'foo'}, status=204)
+        with pytest.raises(BadRequest):
+            app.usbs.name({'_id': 'unknown', 'name': 'foo'})
+    finally:
+        app.mongo_client.drop_database('workbench_server_test')
+
+
+def wait(condition, timeout: float = 5):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline, 'Timed out'
+        sleep(0.01)
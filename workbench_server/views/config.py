@@ -1,35 +1,119 @@
 import json
+import os
 from pathlib import Path
+from sys import stderr
+from threading import Lock, Thread
+from time import sleep
 
-from flask import Response, jsonify, request
+from flask import Response, request
 
 from workbench_server import flaskapp
+from workbench_server.files import write_atomically
 
 
 class Config:
+    """
+    The configuration of Workbench that DeviceHubClient sets.
+
+    We load it from ``config.json`` when we start and keep it in
+    memory, writing the file when it changes. Changes done to the
+    file by someone else are loaded every
+    ``CONFIG_RELOAD_INTERVAL`` seconds.
+    """
+
     def __init__(self, app: 'flaskapp.WorkbenchServer', settings_path: Path,
                  images_path: Path) -> None:
+        self.app = app
         self.config = settings_path.joinpath('config.json')
+        self.values = {}
+        """The configuration. Replaced, never modified."""
+        self.version = 0
+        """Increased every time :attr:`.values` change."""
         self.link = True  # Please Keep default in sync with DeviceHubClient
         """
-        Shortcut to the link config property. 
+        Shortcut to the link config property.
         'Wait for user to link computer without uploading them to
         DeviceHub'.
         """
         self.images_path = images_path
+        self._file = None
+        """The modification time, size and inode of the file we loaded."""
+        self._lock = Lock()
+        self.reload()
+        Thread(target=self.reload_periodically, daemon=True).start()
         app.add_url_rule('/config', view_func=self.view, methods={'GET', 'POST'})
+        app.replica.on('config', self.apply_config)
 
     def view(self):
+        """
+        Gets or sets the config. GET responses carry an ETag; send it
+        back in ``If-None-Match`` to get a 304 when nothing changed.
+        """
         if request.method == 'GET':
-            try:
-                with self.config.open() as f:
-                    config = json.load(f)
-            except FileNotFoundError:
-                config = {}
-            return jsonify(config)
+            # Get the ETag before the values so a change in between is sent again
+            etag = self.etag()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = self.app.json_response(self.get())
+            response.set_etag(etag)
+            return response
         else:  # POST
-            config = request.get_json()
-            self.link = config['link']
-            with self.config.open(mode='w') as f:
-                json.dump(config, f)
+            self.set(request.get_json())
             return Response(status=204)
+
+    def get(self) -> dict:
+        return self.values
+
+    def etag(self) -> str:
+        """
+        The ETag of :attr:`.values`. Each process counts its own
+        :attr:`.version`, so we add the start of
+        :attr:`workbench_server.flaskapp.WorkbenchServer.sequence`,
+        which is different in every process and after every restart.
+        """
+        return '{}-{}'.format(self.app.sequence.start, self.version)
+
+    def set(self, config: dict):
+        with self._lock:
+            write_atomically(self.config, json.dumps(config).encode())
+            self._file = self._stat()  # Don't reload our own write
+        self.app.replica.publish('config', {'config': config})
+
+    def apply_config(self, config: dict):
+        self._apply(config['config'])
+
+    def reload(self):
+        """Loads the file if it changed since we last did."""
+        with self._lock:
+            file = self._stat()
+            if file == self._file:
+                return
+            self._file = file  # We try broken files again when they change
+            try:
+                config = json.loads(self.config.read_text()) if file else {}
+            except (OSError, ValueError) as e:  # Ex. someone is editing it
+                print('Could not load {}: {!r}'.format(self.config, e), file=stderr)
+                return
+        self._apply(config)
+
+    def reload_periodically(self):
+        while True:
+            sleep(self.app.config['CONFIG_RELOAD_INTERVAL'])
+            self.reload()
+
+    def _apply(self, config: dict):
+        with self._lock:
+            # Processes get their own changes from the file and from the replica
+            if config == self.values:
+                return
+            self.values = config
+            self.link = config.get('link', True)
+            self.version += 1
+
+    def _stat(self):
+        try:
+            stat = os.stat(str(self.config))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
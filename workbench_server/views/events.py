@@ -0,0 +1,175 @@
+import asyncio
+from collections import deque
+from contextlib import suppress
+from threading import Condition
+from typing import List, Optional, Tuple
+
+from flask import Response, request
+
+from workbench_server import flaskapp
+from workbench_server.changes import Sequence
+
+
+class Events:
+    """
+    Pushes changes of snapshots and USBs to clients like
+    DeviceHubClient, so they do not need to poll :class:`.Info`.
+
+    Events are encoded once and kept in a single, bounded buffer
+    shared by all subscribers, which only keep the id of the last
+    event they got; adding subscribers costs almost nothing.
+    A subscriber that falls further behind than the buffer gets a
+    ``reset`` event, meaning it has to get everything again
+    from ``/info``.
+
+    The events are:
+
+    - ``snapshot``: a PATCH to a snapshot, with the ``_uuid`` and
+      the ``patch`` to merge or, for JSON Patches and JSON Merge
+      Patches, which can remove values, the whole new ``snapshot``.
+    - ``snapshot-removed``: a finished snapshot has been removed from
+      memory, with its ``_uuid``.
+    - ``upload``: the outcome of uploading a snapshot to DeviceHub,
+      or a failed attempt to connect, with the ``_uuid`` and the
+      control properties that changed.
+    - ``usb-plugged`` and ``usb-unplugged``: a pen-drive has been
+      plugged-in or unplugged from a client, with its ``hid``.
+    """
+
+    def __init__(self, app: 'flaskapp.WorkbenchServer') -> None:
+        self.app = app
+        self.buffer = deque(maxlen=app.config['EVENTS_BACKLOG'])
+        """The last events as ``(id, event, encoded data)``."""
+        self.ids = Sequence(app.sequence.step, app.sequence.offset)
+        """
+        The ids of the events, in the same slot as :attr:`.app.sequence`
+        so we know the ids that other processes gave.
+        """
+        self.condition = Condition()
+        self.waiters = set()
+        """The loops and futures of the coroutines in :meth:`.wait_async`."""
+        app.add_url_rule('/events', view_func=self.view_events, methods={'GET'})
+
+    def publish(self, event: str, data: dict):
+        """Sends an event to all subscribers."""
+        data = self.app.codec.dumps(data).decode()
+        with self.condition:
+            self.buffer.append((self.ids.next(), event, data))
+            self.condition.notify_all()
+            for loop, future in self.waiters:
+                with suppress(RuntimeError):  # The loop is closed
+                    loop.call_soon_threadsafe(_wake, future)
+            self.waiters.clear()
+
+    def wait(self, last_id: int = None, timeout: float = None) -> Tuple[List[tuple], bool]:
+        """
+        Gets the events after ``last_id``, waiting up to ``timeout``
+        seconds for new ones if there are none.
+
+        :return: The events and whether the subscriber lost
+        events and needs to get everything again.
+        """
+        with self.condition:
+            result = self._after(last_id)
+            if result is None:
+                self.condition.wait(timeout)
+                result = self._after(last_id)
+            return result or ([], False)
+
+    async def wait_async(self, last_id: int = None,
+                         timeout: float = None) -> Tuple[List[tuple], bool]:
+        """Like :meth:`.wait` but without blocking the event loop."""
+        loop = asyncio.get_event_loop()
+        with self.condition:
+            result = self._after(last_id)
+            if result is not None:
+                return result
+            waiter = loop, loop.create_future()
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                self.waiters.discard(waiter)
+        with self.condition:
+            return self._after(last_id) or ([], False)
+
+    def _after(self, last_id: Optional[int]) -> Optional[Tuple[List[tuple], bool]]:
+        """
+        The result of :meth:`.wait`, or ``None`` if there are no
+        events after ``last_id`` yet. Hold :attr:`.condition`.
+        """
+        if last_id is None or last_id > self.ids.value or last_id < self.ids.start \
+                or not self.ids.issued(last_id):
+            # New subscriber, one from before a restart or one that
+            # got the id from another process
+            return [], last_id is not None
+        if last_id == self.ids.value:
+            return None
+        if not self.buffer:
+            return [], False
+        first_id, step = self.buffer[0][0], self.ids.step
+        if last_id < first_id - step:
+            return [], True
+        return list(self.buffer)[(last_id - first_id) // step + 1:], False
+
+    def view_events(self):
+        """
+        Streams the events as Server-Sent Events.
+
+        Clients that cannot use SSE can long-poll by passing
+        ``?poll``, getting a JSON list with the events after the
+        ``last-event-id`` query parameter.
+        """
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        if last_id is None:
+            last_id = request.args.get('last-event-id', type=int)
+        keep_alive = self.app.config['EVENTS_KEEP_ALIVE']
+        if 'poll' in request.args:
+            events, reset = self.wait(last_id, keep_alive)
+            return self.app.json_response(self.poll(last_id, events, reset))
+
+        def stream(last_id):
+            last_id, message = self.first_message(last_id)
+            yield message
+            while True:
+                last_id, message = self.message(last_id, *self.wait(last_id, keep_alive))
+                yield message
+
+        return Response(stream(last_id), mimetype='text/event-stream', headers=self.HEADERS)
+
+    HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    """The headers of the stream of events."""
+
+    def poll(self, last_id: Optional[int], events: List[tuple], reset: bool) -> dict:
+        """The response of :meth:`.view_events` when polling."""
+        return {
+            'lastEventId': events[-1][0] if events else max(last_id or 0, self.ids.value),
+            'reset': reset,
+            'events': [{'id': i, 'event': e, 'data': self.app.codec.loads(d)}
+                       for i, e, d in events]
+        }
+
+    def first_message(self, last_id: Optional[int]) -> Tuple[int, str]:
+        """The first message of the stream and its last id."""
+        # Let the client know from where we start
+        last_id = self.ids.value if last_id is None else last_id
+        return last_id, 'retry: 3000\nid: {}\n\n'.format(last_id)
+
+    def message(self, last_id: int, events: List[tuple], reset: bool) -> Tuple[int, str]:
+        """The message of the stream for :meth:`.wait` and the new last id."""
+        if reset:
+            last_id = self.ids.value
+            return last_id, 'id: {}\nevent: reset\ndata: {{}}\n\n'.format(last_id)
+        elif events:
+            message = ''.join('id: {}\nevent: {}\ndata: {}\n\n'.format(*e) for e in events)
+            return events[-1][0], message
+        else:
+            return last_id, ': keep-alive\n\n'
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
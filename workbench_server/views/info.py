@@ -1,32 +1,129 @@
-from contextlib import suppress
+import json
+from sys import stderr
+from typing import Optional, Tuple
 
-from flask import jsonify, request
+from flask import Response, request
+from werkzeug.datastructures import ETags
 
 from workbench_server import flaskapp
+from workbench_server.files import write_atomically
+from workbench_server.network import LocalAddress
 
 
 class Info:
     def __init__(self, app: 'flaskapp.WorkbenchServer') -> None:
         self.app = app
+        # A lambda so replacing local_ip replaces what we cache
+        self.address = LocalAddress(lambda: self.local_ip(), app.config['LOCAL_IP_INTERVAL'])
+        """The cached :meth:`.local_ip`."""
+        self.credentials = app.folder.joinpath('.settings', 'credentials.json')
+        """
+        The credentials of DeviceHub, readable only by us, which we
+        share through this file and not through the replica so
+        they don't end up in the shared state.
+        """
         app.add_url_rule('/info', view_func=self.view_info, methods=['GET'])
+        app.add_url_rule('/info/stats', view_func=self.view_stats, methods=['GET'])
+        app.replica.on('credentials', self.apply_credentials)
 
     def view_info(self):
+        """
+        Gets the snapshots, the plugged-in and named USBs and
+        the state of the connection with DeviceHub.
+
+        Pass ``?since=<seq>``, where *seq* is the ``seq`` of a
+        previous response, to only get what changed after it, plus
+        the ``removed`` ids. Responses carry an ETag; send it back in
+        ``If-None-Match`` to get a 304 when nothing changed.
+        """
         if 'device-hub' in request.args:
-            self.app.device_hub = request.args['device-hub']
-            self.app.db = request.args['db']
-            self.app.auth = request.headers['Authorization']
-
-        response = {
-            # We need to send snapshots as a list
-            # so Javascript can keep the order
-            'snapshots': self.app.snapshots.get_snapshots(),
-            'usbs': self.app.usbs.get_client_plugged_usbs(),
-            'names': self.app.usbs.get_all_named_usbs(),
-            'attempts': self.app.snapshots.attempts
+            self.set_credentials(request.args['device-hub'], request.args['db'],
+                                 request.headers['Authorization'])
+        etag, data = self.info(request.args.get('since', type=int), request.if_none_match)
+        if data is None:
+            response = Response(status=304)
+        else:
+            response = Response(data, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    def set_credentials(self, device_hub: str, db: str, auth: str):
+        """Sets the credentials of DeviceHub, if they changed."""
+        if (device_hub, db, auth) != (self.app.device_hub, self.app.db, self.app.auth):
+            credentials = {'device_hub': device_hub, 'db': db, 'auth': auth}
+            write_atomically(self.credentials, json.dumps(credentials).encode(), mode=0o600)
+            self.app.replica.publish('credentials', {})
+
+    def info(self, since: int = None, if_none_match: ETags = None) -> Tuple[str, Optional[bytes]]:
+        """
+        Gets the JSON of :meth:`.view_info` and its ETag, or ``None``
+        instead of the JSON if ``if_none_match`` has the ETag.
+        """
+        ip = self.address.get()  # None if no Internet
+        usbs = self.app.usbs
+        usbs.expire_client_plugged()
+        # Get the sequence before anything else so changes happening
+        # while we build the response are sent again next time
+        seq = self.app.sequence.value
+        etag = '{}-{}'.format(seq, ip)
+        if if_none_match is not None and if_none_match.contains(etag):
+            return etag, None
+
+        changes = self.app.snapshots.changes, usbs.plugged_changes, usbs.named_changes
+        if since is not None and all(c.knows(since) for c in changes):
+            snapshots = self.app.snapshots.get_encoded_snapshots(since)
+            response = {
+                'since': since,
+                'usbs': usbs.get_client_plugged_usbs(since),
+                'names': usbs.get_all_named_usbs(since),
+                'removed': {
+                    'snapshots': self.app.snapshots.changes.removed_since(since),
+                    'usbs': usbs.plugged_changes.removed_since(since),
+                    'names': usbs.named_changes.removed_since(since)
+                }
+            }
+        else:
+            snapshots = self.app.snapshots.get_encoded_snapshots()
+            response = {
+                'usbs': usbs.get_client_plugged_usbs(),
+                'names': usbs.get_all_named_usbs()
+            }
+        response['seq'] = seq
+        response['attempts'] = self.app.snapshots.attempts
+        if ip is not None:
+            response['ip'] = ip
+        # Snapshots are already encoded, so we just join them.
+        # We need to send snapshots as a list
+        # so Javascript can keep the order
+        data = self.app.codec.dumps(response)
+        return etag, b''.join((b'{"snapshots":[', b','.join(snapshots), b'],', data[1:]))
+
+    def apply_credentials(self, _):
+        """Sets the credentials of DeviceHub that DeviceHubClient sent."""
+        try:
+            credentials = json.loads(self.credentials.read_text())
+        except (OSError, ValueError) as e:
+            print('Could not load the credentials of DeviceHub: {!r}'.format(e), file=stderr)
+            return
+        self.app.device_hub, self.app.db, self.app.auth = \
+            credentials['device_hub'], credentials['db'], credentials['auth']
+        if self.app.replica.leader:
+            self.app.snapshots.update_credentials()
+
+    def view_stats(self):
+        """
+        Gets performance counters of WorkbenchServer, useful
+        to size it.
+        """
+        return self.app.json_response(self.stats())
+
+    def stats(self) -> dict:
+        submitter = self.app.snapshots.submitter  # Only the leader has one
+        return {
+            'submitter': submitter.stats.to_dict() if submitter else None,
+            'snapshots': self.app.snapshots.stats(),
+            'hostUsbs': self.app.usbs.host.stats()
         }
-        with suppress(OSError):  # If no Internet
-            response['ip'] = self.local_ip()
-        return jsonify(response)
 
     @staticmethod
     def local_ip():
@@ -1,22 +1,41 @@
-import json
-from collections import defaultdict, deque
-from json import JSONDecodeError
-from multiprocessing import Process, Queue
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+from multiprocessing import Array, Process, Queue, Value
 from pathlib import Path
 from sys import stderr
-from threading import Thread
-from time import sleep
-from uuid import UUID
+from threading import BoundedSemaphore, Lock, RLock, Thread
+from time import sleep, time
+from typing import List, Optional
+from urllib.parse import urlparse
+from uuid import UUID, uuid4
 
 import requests
-from ereuse_utils import DeviceHubJSONEncoder, now
-from ereuse_utils.naming import Naming
-from flask import Response, jsonify, request
-from pydash import merge
+from ereuse_utils import now
+from flask import Response, request
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
 from requests import HTTPError, Session, Timeout
-from werkzeug.exceptions import NotFound
+from requests.adapters import HTTPAdapter
+from werkzeug.exceptions import BadRequest, Conflict, HTTPException, InternalServerError, \
+    NotFound, ServiceUnavailable, UnsupportedMediaType
 
 from workbench_server import flaskapp
+from workbench_server.archive import Archive
+from workbench_server.changes import Changes
+from workbench_server.codec import JSONCodec, get_codec, stdlib
+from workbench_server.compression import compress
+from workbench_server.files import SnapshotWriter, read_json_file
+from workbench_server.journal import Journal
+from workbench_server.merge import merge
+from workbench_server.metrics import BUCKETS, Metrics, histogram_samples
+from workbench_server.patch import PatchConflict, PatchError, json_patch, merge_patch, validate
+from workbench_server.persistence import WriteBehind
+from workbench_server.retry import CircuitBreaker, RetryScheduler
+from workbench_server.reupload import Reupload
+from workbench_server.store import Retention, SnapshotStore
 
 
 class Snapshots:
@@ -26,95 +45,656 @@ class Snapshots:
     are completed (all phases done and linked).
     """
 
+    PATCH_TYPES = {
+        'application/json': 'merge',
+        'application/merge-patch+json': 'merge-patch',
+        'application/json-patch+json': 'json-patch'
+    }
+    """The formats of ``PATCH /snapshots/<uuid>`` by Content-Type."""
+    MAX_OUTCOMES = 1000
+
     def __init__(self, app: 'flaskapp.WorkbenchServer', public_folder: Path) -> None:
         self.app = app
-        self.snapshots = defaultdict(dict)
+        self.snapshots = SnapshotStore(app.config['SNAPSHOTS_LOCK_STRIPES'],
+                                       partial(encode, codec=app.codec))
+        self.changes = Changes(app.sequence)
         self.sender_queue = Queue()
         self.receiver_queue = Queue()
         self.snapshot_folder = public_folder.joinpath('Snapshots')
         self.snapshot_folder.mkdir(exist_ok=True)
-        self.submitter = DeviceHubSubmitter(public_folder, self.sender_queue, self.receiver_queue)
-        self.submitter.start()
-        Thread(target=self.update_from_submitter, args=(self.receiver_queue,), daemon=True).start()
-        self.attempts = 0
+        self.snapshot_error_folder = public_folder.joinpath('Failed Snapshots')
+        self.writer = SnapshotWriter(app.codec, app.config['SNAPSHOTS_FILE_QUEUE'],
+                                     app.config['SNAPSHOTS_FILE_COMPRESS'])
+        """Writes the snapshot files without making requests wait."""
+        self.public_folder = public_folder
+        self.submitter = None  # type: DeviceHubSubmitter
+        self.journal = None  # type: Journal
+        """The snapshots to upload, saved in case we stop before."""
+        self.journal_lock = RLock()
+        """Taken to use :attr:`.journal`, which we close when we stop being the leader."""
+        self.persistence = WriteBehind(app.mongo_db.snapshots,
+                                       app.config['SNAPSHOTS_FLUSH_INTERVAL'])
+        """Saves the snapshots to Mongo."""
+        self.archive = Archive(app.mongo_db.archive, public_folder.joinpath('Archive'),
+                               app.codec, app.config['SNAPSHOTS_FLUSH_INTERVAL'])
+        """Keeps the finished snapshots to query them later."""
+        self.retention = Retention(app.config['SNAPSHOTS_RETENTION_TTL'],
+                                   app.config['SNAPSHOTS_RETENTION_MAX'])
+        """
+        Removes finished snapshots from memory. They can still be
+        retrieved through ``GET /snapshots/<uuid>``.
         """
-        Failed attempts to connect to DeviceHub due a connection error
-        (ex. no WiFi)
+        self.positions = {}
         """
+        The last change of :class:`workbench_server.replica.SharedReplica`
+        that the snapshots we loaded from Mongo have, so we don't
+        apply them twice when we catch up with the log.
+        """
+        with suppress(PyMongoError):
+            self.persistence.collection.create_index([('_saved', ASCENDING),
+                                                      ('_applied', ASCENDING)])
+        try:
+            # We load the finished snapshots from Mongo only when asked for them
+            for _uuid, snapshot in self.persistence.load({'_saved': {'$ne': True}}).items():
+                applied = snapshot.pop('_applied', None)
+                if applied is not None:
+                    self.positions[_uuid] = applied
+                self.snapshots.set(_uuid, snapshot)
+                self.changes.update(_uuid)
+            if app.replica.applied is not None:
+                # So catching up with the log does not load them for changes they have
+                finished = self.persistence.load({'_saved': True, '_applied': {'$exists': True}},
+                                                 {'_applied': True})
+                for _uuid, snapshot in finished.items():
+                    self.positions[_uuid] = snapshot['_applied']
+        except PyMongoError as e:
+            print('Could not load the snapshots from Mongo: {!r}'.format(e), file=stderr)
+        self.reupload = None  # type: Reupload
+        """The last upload again of the failed snapshots."""
+        self.retrying = {}
+        """
+        The snapshots that the submitter is retrying to upload
+        due a connection error (ex. no WiFi) and their failed
+        attempts.
+        """
+        self.outcomes = OrderedDict()
+        """
+        The id of the last patches we applied: the new version of
+        the snapshot, or the conflict that prevented applying them.
+        """
+        self.outcomes_lock = Lock()
+        self.evict()
+        Thread(target=self.update_from_submitter, args=(self.receiver_queue,), daemon=True).start()
+        Thread(target=self.evict_periodically, daemon=True).start()
+        self.expose_metrics(app.metrics)
+        app.replica.on('snapshot', self.apply_patch)
+        app.replica.on('upload', self.apply_upload)
+        app.replica.on_lead(self.start_submitter, self.stop_submitter)
         app.add_url_rule('/snapshots/<uuid:_uuid>', view_func=self.view_phase,
                          methods={'PATCH', 'GET'})
+        app.add_url_rule('/snapshots/batch', view_func=self.view_batch, methods={'PATCH'})
+        app.add_url_rule('/snapshots/archive', view_func=self.view_archive, methods={'GET'})
+        app.add_url_rule('/snapshots/failed', view_func=self.view_reupload,
+                         methods={'POST', 'GET'})
 
     def view_phase(self, _uuid: UUID):
         """
         Updates or creates a Snapshot.
         When the Snapshot is completed this will save it to a file
         and upload it to a DeviceHub.
+
+        The body of PATCH is merged into the snapshot (see
+        :func:`workbench_server.merge.merge`) or, with its
+        Content-Type, it is a JSON Merge Patch or a JSON Patch,
+        so clients send only what changed (see
+        :mod:`workbench_server.patch`). Bodies can be gzipped.
+
+        Both methods return the version of the snapshot in the ETag.
+        Send it in ``If-Match`` to PATCH only if the snapshot is still
+        in that version, getting a 409 otherwise.
         """
         _uuid = str(_uuid)
         if request.method == 'GET':
-            try:
-                snapshot_to_send = self.snapshots[_uuid].copy()
-                remove_auxiliary_properties(snapshot_to_send)
-                return jsonify(snapshot_to_send)
-            except KeyError:
-                raise NotFound()
+            data, headers = compress(self.get_public(_uuid), request.accept_encodings,
+                                     self.app.config['GZIP_MIN_SIZE'])
+            response = Response(data, mimetype='application/json', headers=headers)
+            version = self.version(_uuid)
+            if version is not None:
+                response.set_etag(str(version))
+            return response
         else:  # PATCH
-            snapshot = request.get_json()
-            # Client could have wrong timing so we override it with ours
-            snapshot['date'] = now()
-
-            # We can receive two PATCH at the same time:
-            # from Workbench and DeviceHubClient
-            # We merge the dictionaries to avoid data loss
-            # and to avoid forcing DeviceHubClient
-            # to send all full snapshot
-            snapshot = merge(self.snapshots[_uuid], snapshot)
-            # We create control variables under
-            # lock so modifying them later does not change dict size
-            snapshot['_error'] = snapshot['_uploaded'] = snapshot['_saved'] = None
-
-            # Note that _phases might not exist if we link
-            # before we get the snapshot from the first phase
-            if snapshot.get('_phases') and snapshot['_phases'] == snapshot['_totalPhases'] \
-                    and (snapshot.get('_linked') or not self.app.configuration.link):
-                # todo devicehub won't allow us to link again a device
-                # that has been already uploaded as it will have the
-                # same _uuid
-                self.sender_queue.put((snapshot, self.app.auth, self.app.device_hub, self.app.db))
-                # Save copy of snapshot
-                snapshot_to_send = snapshot.copy()
-                remove_auxiliary_properties(snapshot_to_send)
-                DeviceHubSubmitter.to_json_file(snapshot_to_send, self.snapshot_folder)
-
-            return Response(status=204)
-
-    def get_snapshots(self) -> list:
+            version = self.patch(_uuid, request.get_json(), request.mimetype,
+                                 parse_base(request.headers.get('If-Match')))
+            response = Response(status=204)
+            response.set_etag(str(version))
+            return response
+
+    def get_public(self, _uuid: str) -> bytes:
+        """Gets the JSON of the snapshot without the auxiliary properties."""
+        if _uuid in self.snapshots:
+            self.retention.touch(_uuid)
+            with suppress(KeyError):  # Unless we removed it meanwhile
+                return self.snapshots.encoded(_uuid, public=True)
+        snapshot = self.load(_uuid)
+        if snapshot is None:
+            raise NotFound()
+        return encode(snapshot, public=True, codec=self.app.codec)
+
+    def view_batch(self):
+        """
+        Updates or creates many snapshots, and tells WorkbenchServer
+        that pen-drives are still plugged-in, in one request.
+
+        The body is like::
+
+            {
+                "snapshots": [{"_uuid": "...", "patch": {...}}, ...],
+                "usbs": [{"hid": "...", "usb": {...}}, ...]
+            }
+
+        Where ``usb`` is ``null`` for unplugged pen-drives. Items are
+        applied in order and independently, returning a list of
+        ``{"status": ...}`` for each one, with an ``error`` message
+        if the status is not 204.
+        """
+        data, headers = compress(self.app.codec.dumps(self.batch(request.get_json())),
+                                 request.accept_encodings, self.app.config['GZIP_MIN_SIZE'])
+        return Response(data, mimetype='application/json', headers=headers)
+
+    def batch(self, batch: dict) -> dict:
+        """Applies the items of :meth:`.view_batch`, returning their status."""
+        if not isinstance(batch, dict):
+            raise BadRequest('Expected an object with "snapshots" and "usbs" lists.')
+        snapshots, usbs = batch.get('snapshots', []), batch.get('usbs', [])
+        if not isinstance(snapshots, list) or not isinstance(usbs, list):
+            raise BadRequest('"snapshots" and "usbs" must be lists.')
+        result = {'snapshots': [], 'usbs': []}
+        for item in snapshots:
+            try:
+                _uuid = str(UUID(item['_uuid']))
+                if not isinstance(item['patch'], dict):
+                    raise TypeError('patch must be an object')
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                result['snapshots'].append({'status': 400, 'error': repr(e)})
+                continue
+            try:
+                self.patch(_uuid, item['patch'])
+            except HTTPException as e:  # Like a 409 of a JSON Patch
+                result['snapshots'].append({'_uuid': _uuid, 'status': e.code})
+            else:
+                result['snapshots'].append({'_uuid': _uuid, 'status': 204})
+        for item in usbs:
+            try:
+                usb_hid, usb = item['hid'], item.get('usb')
+                if usb is None:
+                    self.app.usbs.unplug(usb_hid)
+                else:
+                    self.app.usbs.plug(usb_hid, usb)
+            except (KeyError, TypeError) as e:
+                result['usbs'].append({'status': 400, 'error': repr(e)})
+            else:
+                result['usbs'].append({'hid': usb_hid, 'status': 204})
+        return result
+
+    def view_archive(self):
+        """
+        Searches the archived snapshots (see
+        :class:`workbench_server.archive.Archive`), newest first.
+
+        Filter them with the ``serial``, ``hid`` and ``status``
+        query parameters, and by date with ``from`` and ``to``, which
+        are the start of dates like ``2018-01-22T19:26:54`` (ex.
+        ``2018-01``). Get more with ``page`` and ``max_results``.
+
+        The response is like ``{"_items": [...], "_meta": {"page": 1,
+        "max_results": 25, "total": 90}}``, where the items are the
+        index of the snapshots; get the full ones through
+        ``GET /snapshots/<uuid>``.
+        """
+        query = {}
+        for param, field in ('serial', 'serialNumber'), ('hid', 'hid'), ('status', 'status'):
+            if param in request.args:
+                query[field] = request.args[param]
+        date = {}
+        if 'from' in request.args:
+            date['$gte'] = request.args['from']
+        if 'to' in request.args:
+            # The end of the dates that start with 'to'
+            date['$lte'] = request.args['to'] + '\uffff'
+        if date:
+            query['date'] = date
+        page = request.args.get('page', default=1, type=int)
+        max_results = request.args.get('max_results', default=25, type=int)
+        if page < 1 or not 0 < max_results <= 500:
+            raise BadRequest('page must be 1 or more and max_results from 1 to 500.')
+        index, total = self.archive.find(query, page, max_results)
+        items = [dict(item, _uuid=item.pop('_id')) for item in index]
+        return self.app.json_response({
+            '_items': items,
+            '_meta': {'page': page, 'max_results': max_results, 'total': total}
+        })
+
+    def view_reupload(self):
+        """
+        POST starts uploading again the snapshots in ``Failed
+        Snapshots`` (see :class:`workbench_server.reupload.Reupload`)
+        and GET gets how it goes.
+        """
+        if not self.app.replica.leader:
+            raise ServiceUnavailable('Another process of WorkbenchServer uploads the snapshots. '
+                                     'Try again.')
+        if request.method == 'POST':
+            if self.reupload is not None and self.reupload.running:
+                raise Conflict('We are already uploading again the failed snapshots.')
+            if not self.app.auth:
+                raise BadRequest('We do not have the credentials of DeviceHub yet. '
+                                 'Connect DeviceHubClient and try again.')
+            credentials = self.app.auth, self.app.device_hub, self.app.db
+            self.reupload = Reupload(self.snapshot_error_folder,
+                                     lambda s: self.sender_queue.put((s,) + credentials),
+                                     self.app.config['REUPLOAD_CONCURRENCY'], self.app.codec)
+            return self.app.json_response(self.reupload.progress(), status=202)
+        else:  # GET
+            if self.reupload is None:
+                raise NotFound('We have not uploaded again the failed snapshots.')
+            return self.app.json_response(self.reupload.progress())
+
+    def patch(self, _uuid: str, patch, content_type: str = 'application/json',
+              base: int = None) -> int:
+        """
+        Applies ``patch`` to the stored snapshot, uploading
+        the result if it is completed.
+
+        :param content_type: The format of the patch; see
+        :attr:`.PATCH_TYPES`.
+        :param base: Only apply the patch if the snapshot
+        is in this version.
+        :return: The new version of the snapshot.
+        :raise Conflict: The snapshot is not in version ``base``, or
+        a JSON Patch cannot be applied to it.
+        """
+        _type = self.PATCH_TYPES.get(content_type)
+        if _type is None:
+            raise UnsupportedMediaType('PATCH a JSON object, a JSON Merge Patch or a JSON Patch.')
+        # Client could have wrong timing so we override it with ours
+        if _type == 'json-patch':
+            try:
+                validate(patch)
+            except PatchError as e:
+                raise BadRequest(str(e))
+            patch = patch + [{'op': 'add', 'path': '/date', 'value': now()}]
+        else:
+            if not isinstance(patch, dict):
+                raise BadRequest('The patch must be an object.')
+            patch['date'] = now()
+        change = {'_uuid': _uuid, 'patch': patch, 'id': uuid4().hex}
+        if _type != 'merge':
+            change['type'] = _type
+        if base is not None:
+            change['base'] = base
+        self.app.replica.publish('snapshot', change)
+        with self.outcomes_lock:
+            outcome = self.outcomes.pop(change['id'], None)
+        if outcome is None:  # Applying it failed, and SharedReplica only logged it
+            raise InternalServerError('Could not apply the patch.')
+        version, conflict = outcome
+        if conflict:
+            raise Conflict(conflict)
+        return version
+
+    def apply_patch(self, change: dict):
+        _uuid, patch, base = change['_uuid'], change['patch'], change.get('base')
+        _type = change.get('type', 'merge')
+
+        def change_snapshot(snapshot: dict) -> dict:
+            version = snapshot.get('_version', 0)
+            if base is not None and base != version:
+                raise PatchConflict('The snapshot is in version {}, not {}.'.format(version, base))
+            if _type == 'merge':
+                # We can receive two PATCH at the same time:
+                # from Workbench and DeviceHubClient
+                # We merge the dictionaries to avoid data loss
+                # and to avoid forcing DeviceHubClient
+                # to send all full snapshot
+                snapshot = merge(snapshot, patch)
+            elif _type == 'merge-patch':
+                snapshot = merge_patch(snapshot, patch)
+            else:
+                snapshot = json_patch(snapshot, patch)
+            if not isinstance(snapshot, dict):  # Ex. replacing the whole document
+                raise PatchConflict('The snapshot must be an object.')
+            return dict(snapshot, _error=None, _uploaded=None, _saved=None, _version=version + 1)
+
+        if _uuid not in self.snapshots and not self._replayed(_uuid):
+            # Merge with the snapshot if we removed it from memory
+            evicted = self.load(_uuid)
+            if evicted is not None and not self._replayed(_uuid):  # Now we know its position
+                self.snapshots.set(_uuid, evicted)
+        if self._replayed(_uuid):
+            self._outcome(change.get('id'), self.version(_uuid), None)
+            return
         try:
-            # We don't care for race conditions
+            snapshot = self.snapshots.transform(_uuid, change_snapshot)
+        except PatchConflict as e:
+            # Every process rejects it, as they apply the same changes in the same order
+            self._outcome(change.get('id'), None, str(e))
+            return
+        self.retention.forget(_uuid)
+        self.changes.update(_uuid)
+        self._outcome(change.get('id'), snapshot['_version'], None)
+        # Another thread could have modified the snapshot after us
+        self.save(_uuid)
+        if _type == 'merge':
+            control = {'_error': None, '_uploaded': None, '_saved': None,
+                       '_version': snapshot['_version']}
+            self.app.events.publish('snapshot', {'_uuid': _uuid, 'patch': dict(patch, **control)})
+        else:  # Patches that can remove values, which merging cannot
+            self.app.events.publish('snapshot', {'_uuid': _uuid, 'snapshot': snapshot})
+        if self.app.replica.leader and self.completed(snapshot):
+            # todo devicehub won't allow us to link again a device
+            # that has been already uploaded as it will have the
+            # same _uuid
+            self.upload(_uuid, snapshot)
+
+    def _outcome(self, _id: Optional[str], version: Optional[int], conflict: Optional[str]):
+        if _id is not None:
+            with self.outcomes_lock:
+                self.outcomes[_id] = version, conflict
+                while len(self.outcomes) > self.MAX_OUTCOMES:
+                    self.outcomes.popitem(last=False)
+
+    def _replayed(self, _uuid: str) -> bool:
+        """Whether the snapshot we loaded from Mongo has the change we apply."""
+        position, applied = self.positions.get(_uuid), self.app.replica.applied
+        if position is None or applied is None:
+            return False
+        if applied > position:
+            self.positions.pop(_uuid, None)  # We are past it for good
+            return False
+        return True
+
+    def save(self, _uuid: str):
+        """
+        Saves the snapshot to Mongo in a while, if we are the leader;
+        the other processes have the same changes.
+        """
+        if self.app.replica.leader:
+            self.persistence.mark(_uuid, self.snapshots[_uuid], self.app.replica.applied)
+
+    def version(self, _uuid: str) -> Optional[int]:
+        """The version of the snapshot, if it is in memory."""
+        snapshot = self.snapshots.get(_uuid)
+        return None if snapshot is None else snapshot.get('_version', 0)
+
+    def completed(self, snapshot: dict) -> bool:
+        """Is the snapshot ready to be uploaded?"""
+        # Note that _phases might not exist if we link
+        # before we get the snapshot from the first phase
+        return (bool(snapshot.get('_phases'))
+                and snapshot['_phases'] == snapshot.get('_totalPhases')
+                and (snapshot.get('_linked') or not self.app.configuration.link))
+
+    def upload(self, _uuid: str, snapshot: dict):
+        """Uploads the snapshot to DeviceHub and saves it in its file."""
+        with self.journal_lock:
+            if self.journal is None:  # We stopped being the leader; the new one uploads it
+                return
+            journal = self.journal
+            ticket = journal.put(_uuid, snapshot, wait=False)
+        # Wait for the fsync without the lock, which acknowledging and closing take
+        journal.wait(ticket)
+        self.sender_queue.put((snapshot, self.app.auth, self.app.device_hub, self.app.db))
+        # Save copy of snapshot
+        snapshot_to_send = snapshot.copy()
+        remove_auxiliary_properties(snapshot_to_send)
+        self.writer.write(snapshot_to_send, self.snapshot_folder)
+        self.archive.put(snapshot_to_send)
+
+    def start_submitter(self):
+        """
+        Starts uploading snapshots, as we are the leader
+        (see :class:`workbench_server.replica.Replica`).
+        """
+        path = self.public_folder.joinpath('.settings', 'upload-journal.jsonl')
+        with self.journal_lock:
+            self.journal = Journal(path, codec=self.app.codec)
+        self.submitter = DeviceHubSubmitter(self.public_folder, self.sender_queue,
+                                            self.receiver_queue, self.app.config)
+        self.submitter.start()
+        # Upload the snapshots that we could not upload before stopping.
+        # They wait until DeviceHubClient gives us credentials
+        for snapshot in self.journal.replay():
+            _uuid = str(snapshot['_uuid'])
+            if _uuid not in self.snapshots:
+                self.snapshots.set(_uuid, snapshot)
+                self.changes.update(_uuid)
+                self.save(_uuid)
+            self.sender_queue.put((snapshot, None, None, None))
+        # And the ones that were completed while there was no leader
+        for _uuid, snapshot in self.snapshots.items():
+            if self.app.replica.applied is not None:
+                # The last leader could have stopped before saving it
+                self.save(_uuid)
+            if self.completed(snapshot) and not snapshot.get('_saved') \
+                    and _uuid not in self.journal.pending:
+                self.upload(_uuid, snapshot)
+        if self.app.auth:
+            self.update_credentials()
+
+    def stop_submitter(self):
+        """Stops uploading snapshots, as another process is the leader."""
+        self.submitter.terminate()
+        with self.journal_lock:
+            self.journal.close()
+            self.submitter = self.journal = None
+
+    def get_snapshots(self, since: int = None) -> list:
+        """
+        Gets the snapshots.
+
+        :param since: Only get the snapshots that changed after this
+        sequence number. See :class:`workbench_server.changes.Changes`.
+        """
+        if since is None:
             return list(self.snapshots.values())
-        except RuntimeError:
-            print('runtimeError with Snapshots')
-            # A new snapshot was added while iterating
-            # This happens only very rarely. Just try again
-            return self.get_snapshots()
+        uuids = self.changes.updated_since(since)
+        return [s for uuid, s in self.snapshots.items() if uuid in uuids]
+
+    def get_encoded_snapshots(self, since: int = None) -> List[bytes]:
+        """Like :meth:`.get_snapshots` but already encoded in JSON."""
+        return self.snapshots.encoded_values(None if since is None
+                                             else self.changes.updated_since(since))
+
+    def load(self, _uuid: str) -> dict:
+        """
+        Gets a snapshot that is not in memory from Mongo, from
+        the archive or, if it is not there, from its file.
+        """
+        try:
+            snapshot = self.persistence.find_one(_uuid) or self.archive.get(_uuid)
+        except PyMongoError as e:
+            print('Could not load snapshot {} from Mongo: {!r}'.format(_uuid, e), file=stderr)
+            snapshot = None
+        if snapshot is not None and '_applied' in snapshot:
+            self.positions[_uuid] = snapshot.pop('_applied')
+        if snapshot is None:
+            path = next(self.snapshot_folder.glob('* {}.json*'.format(_uuid)), None)
+            if path:
+                snapshot = read_json_file(path, self.app.codec)
+        return snapshot
+
+    def evict(self):
+        """
+        Removes from memory the snapshots :attr:`.retention` says,
+        and the :attr:`.positions` of changes we will not get again.
+        """
+        for _uuid in self.retention.expired():
+            self.snapshots.remove(_uuid)
+            self.changes.remove(_uuid)
+            self.app.events.publish('snapshot-removed', {'_uuid': _uuid})
+        applied = self.app.replica.applied
+        if applied is not None:
+            # We won't get again the changes we applied
+            for _uuid, position in list(self.positions.items()):
+                if position <= applied:
+                    self.positions.pop(_uuid, None)
+
+    def evict_periodically(self):
+        while True:
+            sleep(60)
+            self.evict()
+
+    def stats(self) -> dict:
+        return {
+            'in_memory': len(self.snapshots),
+            'finished_in_memory': len(self.retention),
+            'memory_bytes': self.snapshots.memory_size()
+        }
+
+    def expose_metrics(self, metrics: Metrics):
+        """Exposes the state of the snapshots and of the submitter."""
+        metrics.callback('snapshots', 'Snapshots in memory.', 'gauge', lambda: len(self.snapshots))
+        metrics.callback('snapshots_finished', 'Finished snapshots in memory.', 'gauge',
+                         lambda: len(self.retention))
+        metrics.callback('snapshots_memory_bytes', 'Approximate bytes of the snapshots in memory.',
+                         'gauge', self.snapshots.memory_size)
+
+        def queues():
+            for name, queue in ('sender', self.sender_queue), ('receiver', self.receiver_queue):
+                try:
+                    size = queue.qsize()
+                except NotImplementedError:  # macOS
+                    size = float('nan')
+                yield '', {'queue': name}, size
+
+        metrics.callback('submitter_queue', 'Messages waiting in the queues of the submitter.',
+                         'gauge', queues)
+
+        # Only the leader has a submitter
+        def uploads():
+            if self.submitter is None:
+                return []
+            values = self.submitter.stats.values
+            return [('_total', {'outcome': outcome}, values[outcome].value)
+                    for outcome in ('uploaded', 'failed')]
+
+        def stat(field: str, suffix: str = ''):
+            return lambda: [] if self.submitter is None else \
+                [(suffix, {}, self.submitter.stats.values[field].value)]
+
+        def durations():
+            if self.submitter is None:
+                return []
+            stats = self.submitter.stats
+            return histogram_samples(BUCKETS, stats.durations[:], stats.values['seconds'].value)
+
+        metrics.callback('uploads', 'Snapshots uploaded to DeviceHub, or rejected by it.',
+                         'counter', uploads)
+        metrics.callback('upload_retries', 'Uploads retried after a connection error.', 'counter',
+                         stat('retries', '_total'))
+        metrics.callback('upload_connection_errors', 'Connection errors uploading snapshots.',
+                         'counter', stat('connection_errors', '_total'))
+        metrics.callback('uploads_queued', 'Snapshots waiting for the credentials of DeviceHub.',
+                         'gauge', stat('queued'))
+        metrics.callback('uploads_in_flight', 'Snapshots being uploaded.', 'gauge',
+                         stat('in_flight'))
+        metrics.callback('upload_duration_seconds', 'Time to upload a snapshot to DeviceHub.',
+                         'histogram', durations)
+
+    def update_credentials(self):
+        """
+        Tells the submitter the new credentials of DeviceHub,
+        so it uploads the snapshots waiting for them.
+        """
+        self.sender_queue.put((None, self.app.auth, self.app.device_hub, self.app.db))
+
+    @property
+    def attempts(self) -> int:
+        """
+        Failed attempts to connect to DeviceHub of the snapshot
+        that has been retrying for the longest.
+        """
+        return max(tuple(self.retrying.values()), default=0)
 
     def update_from_submitter(self, receiver_queue: Queue):
         while True:
-            self.attempts, snapshot = receiver_queue.get()
-            if snapshot:
-                self.snapshots[str(snapshot['_uuid'])] = snapshot
+            _uuid, changes = receiver_queue.get()
+            _uuid = str(_uuid)
+            if changes.get('_saved'):
+                with self.journal_lock:
+                    if self.journal is not None:  # Unless we stopped being the leader
+                        self.journal.ack(_uuid)
+                if '_uploaded' in changes:
+                    self.archive.set_status(_uuid, 'uploaded', uploaded=changes['_uploaded'])
+                else:
+                    self.archive.set_status(_uuid, 'failed', error=changes['_error'])
+            if self.reupload is not None:
+                self.reupload.outcome(_uuid, changes)
+            self.app.replica.publish('upload', {'_uuid': _uuid, 'changes': changes})
+
+    def apply_upload(self, upload: dict):
+        _uuid, changes = upload['_uuid'], upload['changes']
+        if _uuid not in self.snapshots:
+            # Don't bring back to memory the failed snapshots we upload again
+            return
+        if self._replayed(_uuid):
+            return
+        if changes.get('_saved'):
+            self.retrying.pop(_uuid, None)
+        else:
+            self.retrying[_uuid] = changes['_attempts']
+        self.snapshots.transform(_uuid, lambda s: dict(s, **changes))
+        self.changes.update(_uuid)
+        self.save(_uuid)
+        self.app.events.publish('upload', dict(changes, _uuid=_uuid))
+        if changes.get('_saved'):
+            self.retention.finish(_uuid)
+            self.evict()
 
 
 class DeviceHubSubmitter(Process):
-    def __init__(self, public_folder: Path, input_queue: Queue, output_queue: Queue):
-        self.snapshot_folder = public_folder.joinpath('Snapshots')
+    """
+    Uploads snapshots to DeviceHub in a separate process, through
+    a pool of threads that re-use the connections to DeviceHub.
+
+    Snapshots that could not be uploaded due a connection error
+    are retried with an exponential backoff, and we stop trying
+    to connect to a DeviceHub that keeps failing for a while
+    (see :class:`workbench_server.retry.CircuitBreaker`).
+
+    The submitter tells the changes of the snapshots through
+    ``output_queue`` as ``(_uuid, {property: value})``.
+    """
+
+    def __init__(self, public_folder: Path, input_queue: Queue, output_queue: Queue,
+                 settings: dict):
+        """
+        :param settings: The ``SUBMITTER_*``, ``SNAPSHOTS_FILE_*`` and
+        ``JSON_CODEC`` values of
+        :attr:`workbench_server.flaskapp.WorkbenchServer.default_config`.
+        """
         self.snapshot_error_folder = public_folder.joinpath('Failed Snapshots')
         self.snapshot_error_folder.mkdir(exist_ok=True)
+        self.workers = settings['SUBMITTER_WORKERS']
+        self.host_concurrency = settings['SUBMITTER_HOST_CONCURRENCY']
+        self.max_attempts = settings['SUBMITTER_MAX_ATTEMPTS']
+        self.retry_base = settings['SUBMITTER_RETRY_BASE']
+        self.retry_cap = settings['SUBMITTER_RETRY_CAP']
+        self.breaker_threshold = settings['SUBMITTER_BREAKER_THRESHOLD']
+        self.breaker_cooldown = settings['SUBMITTER_BREAKER_COOLDOWN']
+        self.codec = get_codec(settings['JSON_CODEC'])
+        self.file_queue = settings['SNAPSHOTS_FILE_QUEUE']
+        self.compress = settings['SNAPSHOTS_FILE_COMPRESS']
         self.server = Session()
         self.server.headers.update({'Content-Type': 'application/json'})
         self.server.headers.update({'Accept': 'application/json'})
+        # Keep one connection open for each worker
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.workers)
+        self.server.mount('http://', adapter)
+        self.server.mount('https://', adapter)
         self.input_queue = input_queue
         self.output_queue = output_queue
+        self.stats = SubmitterStats()
         super().__init__(daemon=True)
 
     def run(self):
@@ -129,58 +709,171 @@ class DeviceHubSubmitter(Process):
         We keep accumulating snapshots until we have proper
         authentication to upload them to a DeviceHub.
         """
-        while True:
-            _uuid, auth, device_hub, db = self.input_queue.get()
-            snapshots.append(_uuid)
-            if auth:
-                while snapshots:
-                    snapshot = snapshots.popleft()
-                    self._to_devicehub(snapshot, auth, device_hub, db, attempts=0)
-
-    def _to_devicehub(self, snapshot: dict, auth, device_hub, db, attempts=0):
+        self.writer = SnapshotWriter(self.codec, self.file_queue, self.compress)
+        self.hosts = defaultdict(lambda: BoundedSemaphore(self.host_concurrency))
+        self.breakers = defaultdict(lambda: CircuitBreaker(self.breaker_threshold,
+                                                           self.breaker_cooldown))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.scheduler = RetryScheduler(lambda upload: executor.submit(self._upload, upload),
+                                            self.retry_base, self.retry_cap)
+            Thread(target=self.scheduler.run, daemon=True).start()
+            while True:
+                # Without snapshot when we only get new credentials
+                snapshot, auth, device_hub, db = self.input_queue.get()
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    self.stats.add('queued')
+                if auth:
+                    while snapshots:
+                        snapshot = snapshots.popleft()
+                        self.stats.add('queued', -1)
+                        self.scheduler.schedule(Upload(snapshot, auth, device_hub, db))
+
+    def _upload(self, upload: 'Upload'):
+        breaker = self.breakers[upload.url]
+        if not breaker.allow():
+            # Don't count it as an attempt; DeviceHub is known to be down
+            self.scheduler.schedule(upload, breaker.retry_in())
+            return
+        with self.hosts[urlparse(upload.device_hub).netloc]:
+            self.stats.add('in_flight')
+            try:
+                self._to_devicehub(upload, breaker)
+            except Exception as e:
+                # Don't let the executor swallow the error
+                print('Error uploading Snapshot {}: {!r}'.format(upload.snapshot['_uuid'], e),
+                      file=stderr)
+            finally:
+                self.stats.add('in_flight', -1)
+
+    def _to_devicehub(self, upload: 'Upload', breaker: CircuitBreaker):
+        snapshot, url = upload.snapshot, upload.url
         _uuid = snapshot['_uuid']
         snapshot_to_send = snapshot.copy()
         remove_auxiliary_properties(snapshot_to_send)
 
-        self.server.headers.update({'Authorization': auth})
-        url = '{}/{}/events/devices/snapshot'.format(device_hub, db)
+        data = self.codec.dumps(snapshot_to_send)
+        start = time()
         try:
-            r = self.server.post(url, data=json.dumps(snapshot_to_send, cls=DeviceHubJSONEncoder))
+            # Headers of the session are shared between workers
+            r = self.server.post(url, data=data, headers={'Authorization': upload.auth})
             r.raise_for_status()
         except (requests.ConnectionError, Timeout):
-            print('Connection error for Snapshot {} & URL {}. Retrying in 4s.'.format(_uuid, url))
-            sleep(4)
-            self.output_queue.put((attempts, None))
-            self._to_devicehub(snapshot, auth, device_hub, db, attempts + 1)  # Try again
+            breaker.failure()
+            self.stats.add('connection_errors')
+            upload.attempts += 1
+            if self.max_attempts and upload.attempts >= self.max_attempts:
+                print('Connection error for Snapshot {} & URL {}. Giving up after {} attempts.'
+                      .format(_uuid, url, upload.attempts), file=stderr)
+                self.stats.add_upload('failed', time() - start)
+                self.writer.write(snapshot_to_send, self.snapshot_error_folder)
+                error = 'Could not connect to DeviceHub after {} attempts.'.format(upload.attempts)
+                self.output_queue.put((_uuid, {'_attempts': upload.attempts, '_error': error,
+                                               '_saved': True}))
+            else:
+                delay = self.scheduler.backoff(upload.attempts)
+                print('Connection error for Snapshot {} & URL {}. Retrying in {:.0f}s.'
+                      .format(_uuid, url, delay))
+                self.stats.add('retries')
+                self.output_queue.put((_uuid, {'_attempts': upload.attempts}))
+                self.scheduler.schedule(upload, delay)  # Try again
         except HTTPError as e:
+            breaker.success()
+            self.stats.add_upload('failed', time() - start)
             t = 'HTTPError for Snapshot {}, ID {} and url {}:\n{}' \
                 .format(_uuid, snapshot['device'].get('_id', '(not linked)'), url, e)
             print(t, file=stderr)
-            self.to_json_file(snapshot_to_send, self.snapshot_error_folder)
+            self.writer.write(snapshot_to_send, self.snapshot_error_folder)
             error = e.response.content.decode()
             try:
-                snapshot['_error'] = json.loads(error)
-            except JSONDecodeError:
-                snapshot['_error'] = error
-            snapshot['_saved'] = True
-            self.output_queue.put((0, snapshot))
+                error = self.codec.loads(error)
+            except ValueError:
+                pass
+            self.output_queue.put((_uuid, {'_attempts': upload.attempts, '_error': error,
+                                           '_saved': True}))
         else:
+            breaker.success()
+            self.stats.add_upload('uploaded', time() - start)
             print('Uploaded Snapshot {}, ID {} to url {}'
                   .format(_uuid, snapshot['device'].get('_id', '(not linked)'), url))
-            self.to_json_file(snapshot_to_send, self.snapshot_folder)
-            snapshot['_uploaded'] = r.json()['_id']
-            snapshot['_saved'] = True
-            self.output_queue.put((0, snapshot))
-
-    @staticmethod
-    def to_json_file(snapshot: dict, folder: Path):
-        device = snapshot['device']
-        un = 'Unknown'
-        name = Naming.hid(device['manufacturer'] or un, device['serialNumber'] or un,
-                          device['model'] or un)
-        name = '{} {}'.format(name, snapshot['_uuid'])
-        with folder.joinpath(name + '.json').open('w') as f:
-            json.dump(snapshot, f, indent=2, sort_keys=True, cls=DeviceHubJSONEncoder)
+            # Snapshots.upload already saved it in its file
+            self.output_queue.put((_uuid, {'_attempts': upload.attempts,
+                                           '_uploaded': r.json()['_id'], '_saved': True}))
+
+
+class Upload:
+    """A snapshot to upload to a DeviceHub."""
+
+    def __init__(self, snapshot: dict, auth: str, device_hub: str, db: str) -> None:
+        self.snapshot = snapshot
+        self.auth = auth
+        self.device_hub = device_hub
+        self.url = '{}/{}/events/devices/snapshot'.format(device_hub, db)
+        self.attempts = 0
+        """Failed attempts to connect to DeviceHub."""
+
+
+class SubmitterStats:
+    """
+    Counters of :class:`.DeviceHubSubmitter`, shared between
+    its process and the process of WorkbenchServer.
+    """
+    FIELDS = 'queued', 'in_flight', 'uploaded', 'failed', 'connection_errors', 'retries', \
+             'seconds', 'max_seconds'
+
+    def __init__(self) -> None:
+        self.values = {field: Value('d', 0) for field in self.FIELDS}
+        self.durations = Array('d', len(BUCKETS) + 1)
+        """The uploads per bucket of :data:`workbench_server.metrics.BUCKETS`."""
+        self.started = time()
+
+    def add(self, field: str, amount: float = 1):
+        value = self.values[field]
+        with value.get_lock():
+            value.value += amount
+
+    def add_upload(self, outcome: str, seconds: float):
+        """Registers a finished upload that took ``seconds``."""
+        self.add(outcome)
+        self.add('seconds', seconds)
+        with self.durations.get_lock():
+            self.durations[bisect_left(BUCKETS, seconds)] += 1
+        max_seconds = self.values['max_seconds']
+        with max_seconds.get_lock():
+            max_seconds.value = max(max_seconds.value, seconds)
+
+    def to_dict(self) -> dict:
+        stats = {field: value.value for field, value in self.values.items()}
+        done = stats['uploaded'] + stats['failed']
+        stats['uploads_per_minute'] = done / (time() - self.started) * 60
+        stats['mean_seconds'] = stats['seconds'] / done if done else 0
+        return stats
+
+
+def encode(snapshot: dict, public: bool = False, codec: JSONCodec = stdlib) -> bytes:
+    """
+    Encodes the snapshot in JSON.
+
+    :param public: Without the auxiliary properties; see
+    :func:`.remove_auxiliary_properties`.
+    """
+    if public:
+        snapshot = snapshot.copy()
+        remove_auxiliary_properties(snapshot)
+    return codec.dumps(snapshot)
+
+
+def parse_base(if_match: Optional[str]) -> Optional[int]:
+    """Gets the version of the snapshot in an ``If-Match`` header."""
+    if if_match is None or if_match.strip() == '*':
+        return None
+    etag = if_match.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    try:
+        return int(etag.strip('"'))
+    except ValueError:
+        raise BadRequest('If-Match must be the ETag of the snapshot.')
 
 
 def remove_auxiliary_properties(snapshot: dict):
@@ -189,5 +882,6 @@ def remove_auxiliary_properties(snapshot: dict):
 
     Mutates snapshot.
     """
-    for attr in '_phases', '_totalPhases', '_linked', '_error', '_uploaded', '_saved':
+    for attr in '_phases', '_totalPhases', '_linked', '_error', '_uploaded', '_saved', \
+                '_attempts', '_version':
         snapshot.pop(attr, None)
@@ -1,11 +1,18 @@
-from cachetools import TTLCache
-from ereuse_utils.usb_flash_drive import plugged_usbs
-from flask import Response, jsonify, request
+from collections import OrderedDict
+from contextlib import suppress
+from threading import Lock, Thread
+from time import sleep
+
+from flask import Response, request
 from pydash import find
 from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
 from werkzeug.exceptions import BadRequest
 
 from workbench_server import flaskapp
+from workbench_server.changes import Changes
+from workbench_server.heartbeats import Heartbeats
+from workbench_server.host_usbs import HostUSBs, PyUSBSource
 
 
 class USBs:
@@ -18,15 +25,37 @@ class USBs:
     def __init__(self, app: 'flaskapp.WorkbenchServer') -> None:
         self.app = app
         self.named_usbs = app.mongo_db.named_usbs  # type: Collection
-        self.client_plugged = TTLCache(maxsize=100, ttl=5)
+        self.client_plugged = Heartbeats(app.config['USBS_PLUGGED_TTL'],
+                                         on_expire=self.on_client_plugged_expired)
+        """
+        The pen-drives plugged in clients by ``hid``. The ones that
+        clients do not report to be still plugged-in in
+        ``USBS_PLUGGED_TTL`` seconds are removed.
         """
-        Clients that have plugged-in USBs. All USBs that have not
-        been reported to still be plugged-in in 5 seconds ore more
-        are removed from the dict, keeping the values updated.
-        
-        Note that `maxsize` is just required, and limits the number
-        of plugged-in USBs to 100. Can safely be increased if needed.  
+        self.plugged_changes = Changes(app.sequence)
+        self.named_changes = Changes(app.sequence)
+        self.named = None
         """
+        The named pen-drives by ``_id``. We load them once from Mongo
+        and keep them updated when naming, so :class:`.Info` does not
+        need to query Mongo. See :meth:`.get_named`.
+        """
+        self.names = {}
+        """The names of the pen-drives by ``serialNumber``."""
+        self.named_lock = Lock()
+        source = app.config['HOST_USBS_SOURCE']
+        self.host = HostUSBs(PyUSBSource() if source == 'pyusb' else source,
+                             app.config['HOST_USBS_POLL'],
+                             app.metrics.histogram('host_usbs_enumeration_seconds',
+                                                   'Time to enumerate the USBs of this machine.'))
+        """The pen-drives plugged in this machine."""
+        with suppress(PyMongoError):
+            self.named_usbs.create_index('serialNumber')
+        Thread(target=self.expire_periodically, daemon=True).start()
+        Thread(target=self.watch_named_usbs, daemon=True).start()
+        app.replica.on('usb-plugged', self.apply_plug)
+        app.replica.on('usb-unplugged', self.apply_unplug)
+        app.replica.on('usb-named', self.index_named)
         app.add_url_rule('/usbs', view_func=self.view_usbs, methods={'GET'})
         app.add_url_rule('/usbs/named', view_func=self.view_name_usb, methods={'POST'})
         app.add_url_rule('/usbs/plugged/<usb_hid>', view_func=self.view_client_plug,
@@ -34,10 +63,13 @@ class USBs:
 
     def view_usbs(self) -> str:
         """Gets plugged-in and named pen-drives."""
-        return jsonify({
-            'plugged': list(plugged_usbs()),
+        return self.app.json_response(self.usbs())
+
+    def usbs(self) -> dict:
+        return {
+            'plugged': list(self.host.get()),
             'named': self.get_all_named_usbs()
-        })
+        }
 
     def view_name_usb(self):
         """
@@ -47,18 +79,32 @@ class USBs:
         Pen-drive must be plugged-in in the
         **machine executing WorkbenchServer**.
         """
-        incoming_usb = request.get_json()
+        self.name(request.get_json())
+        return Response(status=204)
+
+    def name(self, incoming_usb: dict):
+        """Names the pen-drive with the ``_id`` and ``name``."""
         name = incoming_usb['name']
-        result = self.named_usbs.update_one({'_id': incoming_usb['_id']}, update={'name': name})
-        if result.modified_count == 0:
+        mongo_time = self.app.mongo_time
+        with mongo_time.time('named_usbs', 'update_one'):
+            result = self.named_usbs.update_one({'_id': incoming_usb['_id']},
+                                                update={'$set': {'name': name}})
+        if result.matched_count == 0:
             # Add new USB to the named_usbs
-            usb = find(list(plugged_usbs()), {'_id': incoming_usb['_id']})
+            usb = find(list(self.host.get()), {'_id': incoming_usb['_id']})
+            if usb is None:  # Maybe we did not enumerate it yet
+                usb = find(list(self.host.enumerate()), {'_id': incoming_usb['_id']})
             if usb is None:
                 raise BadRequest('Only already named USB pen-drives can be named without '
                                  'plugging them in. Plug the pen-drive and try again.')
-            usb['name'] = name
-            self.named_usbs.insert_one(usb)
-        return Response(status=204)
+            usb = dict(usb, name=name)  # Don't modify the enumeration
+            with mongo_time.time('named_usbs', 'insert_one'):
+                self.named_usbs.insert_one(usb)
+        else:
+            with mongo_time.time('named_usbs', 'find_one'):
+                usb = self.named_usbs.find_one({'_id': incoming_usb['_id']})
+        # Every process indexes it, not only the ones watching Mongo
+        self.app.replica.publish('usb-named', usb)
 
     def view_client_plug(self, usb_hid: str):
         """
@@ -66,35 +112,127 @@ class USBs:
         in a client. From this moment, the pen-drive will be shown in
         :attr:`.USBs.view_usbs` inside the `plugged` dict property.
         """
-        usb = request.get_json()
         if request.method == 'POST':
-            self.client_plugged[usb_hid] = usb
+            self.plug(usb_hid, request.get_json())
         else:  # Delete
-            self.client_plugged.pop(usb_hid, None)
+            self.unplug(usb_hid)
         return Response(status=204)
 
-    def get_all_named_usbs(self) -> list:
-        return list(self.named_usbs.find())
+    def plug(self, usb_hid: str, usb: dict):
+        """Sets the pen-drive as plugged-in in a client."""
+        if not isinstance(usb, dict):
+            raise TypeError('usb must be an object')
+        self.app.replica.publish('usb-plugged', {'hid': usb_hid, 'usb': usb})
 
-    def get_client_plugged_usbs(self) -> list:
+    def unplug(self, usb_hid: str):
+        """Sets the pen-drive as unplugged from its client."""
+        self.app.replica.publish('usb-unplugged', {'hid': usb_hid})
+
+    def apply_plug(self, plug: dict):
+        usb_hid, usb = plug['hid'], plug['usb']
+        # Clients keep re-posting the USB to tell us it is still
+        # plugged-in; this is not a change
+        if self.client_plugged.put(usb_hid, usb):
+            self.plugged_changes.update(usb_hid)
+            self.app.events.publish('usb-plugged', dict(usb, hid=usb_hid))
+
+    def apply_unplug(self, unplug: dict):
+        usb_hid = unplug['hid']
+        if self.client_plugged.pop(usb_hid) is not None:
+            self.plugged_changes.remove(usb_hid)
+            self.app.events.publish('usb-unplugged', {'hid': usb_hid})
+
+    def get_all_named_usbs(self, since: int = None) -> list:
+        """
+        Gets the named pen-drives.
+
+        :param since: Only get the pen-drives that were named
+        after this sequence number.
+        """
+        named = self.get_named()
+        if since is None:
+            return list(named.values())
+        ids = self.named_changes.updated_since(since)
+        return [usb for _id, usb in tuple(named.items()) if _id in ids]
+
+    def get_named(self) -> OrderedDict:
+        """Gets :attr:`.named`, loading them the first time."""
+        if self.named is None:
+            with self.named_lock:
+                if self.named is None:
+                    with self.app.mongo_time.time('named_usbs', 'find'):
+                        named = OrderedDict((usb['_id'], usb) for usb in self.named_usbs.find())
+                    self.names = {usb['serialNumber']: usb['name'] for usb in named.values()}
+                    self.named = named
+        return self.named
+
+    def index_named(self, usb: dict):
+        """Updates :attr:`.named` with a named pen-drive."""
+        named = self.get_named()
+        with self.named_lock:
+            previous = named.get(usb['_id'])
+            if previous == usb:  # Named again with the same name
+                return
+            if previous:
+                self.names.pop(previous['serialNumber'], None)
+            named[usb['_id']] = usb
+            self.names[usb['serialNumber']] = usb['name']
+        self.named_changes.update(usb['_id'])
+        # Plugged-in USBs show their name, so they changed too
+        for usb_hid, plugged_usb in self.client_plugged.snapshot().items():
+            serial_number = plugged_usb.get('serialNumber')
+            if serial_number and serial_number == usb['serialNumber']:
+                self.plugged_changes.update(usb_hid)
+
+    def watch_named_usbs(self):
+        """
+        Keeps :attr:`.named` updated with the changes done in Mongo
+        outside WorkbenchServer, when Mongo supports change streams
+        (replica sets). Our processes get the pen-drives they name
+        through :attr:`workbench_server.flaskapp.WorkbenchServer.replica`.
+        """
+        with suppress(PyMongoError):  # Only we can name pen-drives
+            with self.named_usbs.watch(full_document='updateLookup') as stream:
+                for change in stream:
+                    if change.get('fullDocument'):
+                        self.index_named(change['fullDocument'])
+
+    def expire_client_plugged(self):
+        """Removes the pen-drives that clients stopped reporting."""
+        self.client_plugged.expire()
+
+    def on_client_plugged_expired(self, usb_hid: str, usb: dict):
+        self.plugged_changes.remove(usb_hid)
+        self.app.events.publish('usb-unplugged', {'hid': usb_hid})
+
+    def expire_periodically(self):
+        """
+        Expires the plugged-in USBs every second, so the subscribers
+        of :class:`workbench_server.views.events.Events` know when
+        a client stops reporting a pen-drive.
+        """
+        while True:
+            sleep(1)
+            self.expire_client_plugged()
+
+    def get_client_plugged_usbs(self, since: int = None) -> list:
         """
         Get the pen-drives that are plugged in the client
         executing Workbench.
+
+        :param since: Only get the pen-drives that changed after
+        this sequence number.
         """
 
+        self.get_named()
+
         def add_usb_name(usb):
-            named_usb = self.named_usbs.find_one({'serialNumber': usb['serialNumber']})
-            if named_usb:
-                usb['name'] = named_usb['name']
-            return usb
-
-        def get():
-            # If we plug / unplug an USB while we are iterating
-            # we could get a runtimeError. In that case just try again
-            try:
-                return tuple(self.client_plugged.values())
-            except RuntimeError:
-                print('runtimeError with USBs')
-                return get()
-
-        return [add_usb_name(usb) for usb in get()]
+            name = self.names.get(usb['serialNumber'])
+            # Don't modify the USB so we know when clients send a new one
+            return dict(usb, name=name) if name else usb
+
+        plugged = self.client_plugged.snapshot()
+        if since is None:
+            return [add_usb_name(usb) for usb in plugged.values()]
+        hids = self.plugged_changes.updated_since(since)
+        return [add_usb_name(usb) for hid, usb in plugged.items() if hid in hids]